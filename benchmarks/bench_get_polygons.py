@@ -0,0 +1,67 @@
+"""Compare the iterative and vectorized engines of ReadCOG.get_polygons.
+
+Usage: python benchmarks/bench_get_polygons.py [--size 600] [--block 3] [--repeat 3]
+
+The default size approximates a 30,000 ha polygon at the native MapBiomas
+resolution (~30 m pixels).
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from shapely.geometry import Point, mapping
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from model.read_cog import ReadCOG
+from mapbiomas_classes import mapbiomas_classes
+from synthetic import PIXEL_SIZE, synthetic_classes, synthetic_transform, area_per_class
+
+
+def synthetic_window(size, block, seed=0):
+    image = synthetic_classes(size, block, seed, list(mapbiomas_classes))
+    transform = synthetic_transform((-45.0, -21.0))
+    center = transform * (size / 2, size / 2)
+    polygon = Point(center).buffer(PIXEL_SIZE * size / 2 * 0.98, quad_segs=64)
+    mask = np.full((size, size), 255, dtype="uint8")
+    feature = {"type": "Feature", "properties": {}, "geometry": mapping(polygon)}
+    return feature, image[np.newaxis, :, :], mask, transform
+
+
+def run(reader, window, repeat):
+    feature, image, mask, transform = window
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = reader.get_polygons(feature, image, mask, transform, mapbiomas_classes, 2022)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=600)
+    parser.add_argument("--block", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    window = synthetic_window(args.size, args.block)
+    iterative_time, iterative = run(ReadCOG(engine="iterative"), window, args.repeat)
+    print(f"iterative:             {iterative_time:.3f}s ({len(iterative['features'])} features)")
+
+    engines = {
+        "vectorized": ReadCOG(engine="vectorized"),
+        "vectorized, edge mask": ReadCOG(engine="vectorized", edge_mask=True),
+        "vectorized, projected": ReadCOG(engine="vectorized", area_engine="projected"),
+    }
+    for name, reader in engines.items():
+        engine_time, result = run(reader, window, args.repeat)
+        same_areas = area_per_class(result) == area_per_class(iterative)
+        print(
+            f"{name + ':':<22} {engine_time:.3f}s ({len(result['features'])} features) "
+            f"speedup {iterative_time / engine_time:.2f}x, same area per class: {same_areas}")
+
+
+if __name__ == "__main__":
+    main()
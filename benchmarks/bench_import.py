@@ -0,0 +1,124 @@
+"""Import time of the app and command line entry points.
+
+Usage:
+    python benchmarks/bench_import.py [--runs 5] [--budget-ms main=1000 cli=500]
+        [--save benchmarks/results/import.json] [--compare benchmarks/results/import.json]
+
+Each run imports the module in a fresh interpreter with `python -X importtime`
+and takes the cumulative time of its import, the median of the runs is
+checked against the budget. The app must also render the upload page without
+any of HEAVY_MODULES, they are imported by the code paths using them. Exits
+with 1 when a budget is exceeded, a heavy module is loaded or, with
+--compare, a case regressed.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from bench_results import get_commit, compare
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+HEAVY_MODULES = [
+    "pandas", "geopandas", "folium", "streamlit_folium", "rasterio", "rio_tiler",
+    "pyproj", "scipy", "pyarrow", "pyogrio"
+]
+BUDGETS_MS = {"main": 1000, "cli": 500}
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)")
+
+
+def parse_import_time(stderr, module):
+    # Direct imports of the module are the lines one level deeper right
+    # before its own line.
+    children = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if not match:
+            continue
+        cumulative_us, indent, name = int(match.group(1)), len(match.group(2)), match.group(3)
+        if indent == 2:
+            children.append((name, cumulative_us / 1e6))
+        elif indent == 0:
+            if name == module:
+                return cumulative_us / 1e6, sorted(children, key=lambda child: child[1], reverse=True)
+            children = []
+    raise ValueError(f"{module} not found in the import time output")
+
+
+def measure(module):
+    code = (
+        f"import {module}, sys, json, resource; "
+        f"print(json.dumps({{'heavy': sorted(set(sys.modules) & set({HEAVY_MODULES!r})), "
+        "'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000}))"
+    )
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+    seconds, children = parse_import_time(process.stderr, module)
+    return {"seconds": seconds, "children": children, **json.loads(process.stdout.splitlines()[-1])}
+
+
+def parse_budgets(values):
+    budgets = dict(BUDGETS_MS)
+    for value in values or []:
+        module, budget_ms = value.split("=")
+        budgets[module] = float(budget_ms)
+    return budgets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modules", nargs="+", default=list(BUDGETS_MS))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", nargs="+", help="per module budgets, e.g. main=1000")
+    parser.add_argument("--top", type=int, default=8, help="slowest direct imports listed")
+    parser.add_argument("--save", help="write the results as json, e.g. as a baseline")
+    parser.add_argument("--compare", help="baseline json to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative increase reported as regression")
+    args = parser.parse_args()
+
+    budgets = parse_budgets(args.budget_ms)
+    results = {"commit": get_commit(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "cases": {}}
+    failures = []
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.runs)]
+        seconds = statistics.median(run["seconds"] for run in runs)
+        peak_mb = statistics.median(run["peak_mb"] for run in runs)
+        slowest = min(runs, key=lambda run: abs(run["seconds"] - seconds))
+        budget_ms = budgets.get(module)
+        print(f"import {module:<10} {seconds * 1000:.0f}ms (budget {budget_ms}ms), peak rss {peak_mb:.0f}MB")
+        for name, child_seconds in slowest["children"][:args.top]:
+            print(f"    {name:<40} {child_seconds * 1000:.0f}ms")
+        if slowest["heavy"]:
+            print(f"    heavy modules loaded: {', '.join(slowest['heavy'])}")
+            failures.append(module)
+        if budget_ms is not None and seconds * 1000 > budget_ms:
+            failures.append(module)
+        results["cases"][f"import_{module}"] = {"stages": {"import": {"seconds": seconds, "peak_mb": peak_mb}}}
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\ncompared with {args.compare} (commit {baseline.get('commit')})")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} case(s) regressed above {args.threshold:.0%}")
+            sys.exit(1)
+
+    if failures:
+        print(f"startup budget exceeded: {', '.join(sorted(set(failures)))}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Peak RSS of ReadCOG.render_mapbiomas_from_cog on large windows.
+
+Usage:
+    python benchmarks/bench_memory.py [--sizes 4096 8192] [--block 16] [--coverage 0.95]
+        [--save benchmarks/results/memory.json] [--compare benchmarks/results/memory.json]
+
+Each case runs in a fresh process, so the reported peak is the growth of
+the process resident set over the imports, for one extraction of a
+generated COG (see bench_pipeline.py). tracemalloc misses GDAL and GEOS
+allocations, peak RSS does not. render_rio_tiler reads the window through
+rio-tiler feature() as ReadCOG did before its windowed band read, for the
+old against new peak on the same tree.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from bench_pipeline import get_dataset, make_feature
+from bench_results import get_commit, compare
+from model.read_cog import ReadCOG
+from mapbiomas_classes import mapbiomas_classes
+
+
+# render_rio_tiler reads as ReadCOG did before its windowed band read, the
+# old and new peaks come from one run of this tree.
+CASES = (("render", False, "window"), ("render_aligned", True, "window"), ("render_rio_tiler", False, "rio-tiler"))
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000
+
+
+def render_rio_tiler(reader, params):
+    # The read ReadCOG did before its windowed band read: a rio-tiler
+    # feature() masked array, then the same polygons.
+    feature = params["feature_geojson"]
+    with reader.open_reader(params["src_path"]) as cog:
+        image_data = cog.feature(feature, max_size=None, align_bounds_with_dataset=params["align_to_dataset"])
+    mask = ~np.ma.getmaskarray(image_data.array)[0]
+    return reader.get_polygons(
+        feature, image_data.array.data, mask, image_data.transform, params["classes_names"], params["year"])
+
+
+def run_render(src_path, size, coverage, align_to_dataset, read, queue):
+    reader = ReadCOG()
+    params = {
+        "src_path": src_path,
+        "feature_geojson": make_feature(size, coverage),
+        "classes_names": mapbiomas_classes,
+        "max_size": None,
+        "year": 2022,
+        "align_to_dataset": align_to_dataset
+    }
+    baseline = max_rss_mb()
+    start = time.perf_counter()
+    if read == "rio-tiler":
+        polygons = render_rio_tiler(reader, params)
+    else:
+        polygons = reader.render_mapbiomas_from_cog(params)
+    queue.put({
+        "seconds": time.perf_counter() - start,
+        "peak_mb": max_rss_mb() - baseline,
+        "features": len(polygons["features"])
+    })
+
+
+def measure(src_path, size, coverage, align_to_dataset, read):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=run_render, args=(src_path, size, coverage, align_to_dataset, read, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[4096, 8192])
+    parser.add_argument("--block", type=int, default=16)
+    parser.add_argument("--coverage", type=float, default=0.95)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "mapbiomas_benchmark"))
+    parser.add_argument("--save", help="write the results as json, e.g. as a baseline")
+    parser.add_argument("--compare", help="baseline json to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative increase reported as regression")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {"commit": get_commit(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "cases": {}}
+    for size in args.sizes:
+        src_path = get_dataset(args.data_dir, size, args.block)
+        case_id = f"{size}px_block{args.block}_cover{args.coverage}"
+        stages = {}
+        for stage, align_to_dataset, read in CASES:
+            result = measure(src_path, size, args.coverage, align_to_dataset, read)
+            stages[stage] = {"seconds": result["seconds"], "peak_mb": result["peak_mb"]}
+            print(
+                f"{case_id:<32} {stage:<16} {result['features']:>7} features "
+                f"{result['seconds']:.2f}s, peak rss +{result['peak_mb']:.0f}MB")
+        results["cases"][case_id] = {"stages": stages}
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\ncompared with {args.compare} (commit {baseline.get('commit')})")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} case(s) regressed above {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Offline benchmark of the extraction pipeline, stage by stage.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--sizes 512 1024] [--blocks 4 16 64] [--coverages 0.5 0.95]
+        [--repeat 3] [--save benchmarks/results/baseline.json] [--compare benchmarks/results/baseline.json]
+
+MapBiomas-like categorical COGs (512px internal tiles, overviews) are
+generated once per size and fragmentation level (block size in pixels, small
+blocks mean a fragmented landscape) under --data-dir. For every polygon
+coverage each stage is timed (best of --repeat) and its peak traced memory
+recorded: read, polygonize, clip, area, build_features, get_polygons,
+render (read included) and export. The read to build_features stages are
+the ones ReadCOG reports to instrumentation during render, read_rio_tiler
+is the rio-tiler feature() read it replaced for EPSG:4326 datasets, kept
+as reference. Save a run as baseline on one
+commit and compare on another, stages slower than --threshold are listed
+and the exit code is 1.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import tracemalloc
+import resource
+import tempfile
+import math
+import numpy as np
+import rasterio
+import shapely
+from shapely.geometry import Point, mapping
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from model.read_cog import ReadCOG
+from model.instrumentation import instrumentation
+from model.export_writers import available_formats, export_features
+from mapbiomas_classes import mapbiomas_classes
+from synthetic import PIXEL_SIZE, write_synthetic_coverage
+from bench_results import get_commit, compare
+
+ORIGIN = (-45.0, -21.0)
+
+
+def get_dataset(data_dir, size, block):
+    # 512px tiles and overviews down to a single tile, as the COG driver.
+    path = os.path.join(data_dir, f"coverage_{size}px_block{block}.tif")
+    if not os.path.exists(path):
+        overviews = [2 ** level for level in range(1, max(0, math.ceil(math.log2(size / 512))) + 1)]
+        write_synthetic_coverage(
+            path, 0, size, block, list(mapbiomas_classes), ORIGIN, blocksize=512, overviews=overviews)
+    return path
+
+
+def make_feature(size, coverage):
+    center = (ORIGIN[0] + PIXEL_SIZE * size / 2, ORIGIN[1] - PIXEL_SIZE * size / 2)
+    polygon = Point(center).buffer(PIXEL_SIZE * size / 2 * coverage, quad_segs=64)
+    return {"type": "Feature", "properties": {}, "geometry": mapping(polygon)}
+
+
+def measure(function, repeat):
+    tracemalloc.start()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return {"seconds": min(timings), "peak_mb": peak / 1_000_000}, result
+
+
+def measure_stages(function, repeat):
+    # The stages ReadCOG reports to instrumentation while function runs, as
+    # measure: peak traced memory on a first run, best of repeat untraced.
+    # The whole run is the "total" stage, it keeps the peak of the stages
+    # nested in it. An untraced run first keeps the lazy imports and the
+    # GDAL setup of the first read out of the peaks.
+    function()
+    logging.getLogger("mapbiomas.instrumentation").addHandler(logging.NullHandler())
+    instrumentation.configure(enabled=True, trace_memory=True)
+    with instrumentation.trace("benchmark") as trace, instrumentation.stage("total"):
+        result = function()
+    tracemalloc.stop()
+    peaks = {name: stage["allocated_bytes"] for name, stage in trace.stages.items()}
+
+    instrumentation.configure(enabled=True)
+    timings = {name: [] for name in peaks}
+    for _ in range(repeat):
+        with instrumentation.trace("benchmark") as trace, instrumentation.stage("total"):
+            result = function()
+        for name in peaks:
+            timings[name].append(trace.stages.get(name, {"seconds": 0.0})["seconds"])
+    instrumentation.configure(enabled=False)
+    return {
+        name: {"seconds": min(seconds), "peak_mb": peaks[name] / 1_000_000} for name, seconds in timings.items()
+    }, result
+
+
+def run_case(reader, src_path, feature, repeat):
+    stages = {}
+
+    render_stages, _ = measure_stages(lambda: reader.render_mapbiomas_from_cog({
+        "src_path": src_path,
+        "feature_geojson": feature,
+        "classes_names": mapbiomas_classes,
+        "max_size": None,
+        "year": 2022,
+        "align_to_dataset": True
+    }), repeat)
+    # The stages as ReadCOG runs them, polygonize is timed twice with the
+    # edge mask and summed. The iterative engine only reports the read.
+    for stage in ("read", "polygonize", "clip", "area", "build_features"):
+        if stage in render_stages:
+            stages[stage] = render_stages[stage]
+
+    def read_rio_tiler():
+        with reader.open_reader(src_path) as cog:
+            return cog.feature(feature, max_size=None, align_bounds_with_dataset=True)
+    stages["read_rio_tiler"], image_data = measure(read_rio_tiler, repeat)
+    image, mask, transform = image_data.data[0], image_data.mask, image_data.transform
+
+    stages["get_polygons"], polygons = measure(
+        lambda: reader.get_polygons(feature, image_data.data, mask, transform, mapbiomas_classes, 2022), repeat)
+    stages["render"] = render_stages["total"]
+
+    # A copy per run, a result keeps its GeoJSON features once built.
+    for export_format in available_formats():
+        stages[f"export_{export_format.lower()}"], _ = measure(
+            lambda: export_features(polygons.take(slice(None)), export_format), repeat)
+    return {"features": polygons.feature_count, "pixels": int(image.size), "stages": stages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024])
+    parser.add_argument("--blocks", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--coverages", type=float, nargs="+", default=[0.5, 0.95])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--engine", default="vectorized", choices=["vectorized", "iterative"])
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "mapbiomas_benchmark"))
+    parser.add_argument("--save", help="write the results as json, e.g. as a baseline")
+    parser.add_argument("--compare", help="baseline json to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown reported as regression")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    reader = ReadCOG(engine=args.engine)
+    results = {
+        "commit": get_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "engine": args.engine,
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "versions": {
+            "gdal": rasterio.__gdal_version__,
+            "rasterio": rasterio.__version__,
+            "shapely": shapely.__version__,
+            "numpy": np.__version__
+        },
+        "cases": {}
+    }
+
+    for size in args.sizes:
+        for block in args.blocks:
+            src_path = get_dataset(args.data_dir, size, block)
+            for coverage in args.coverages:
+                case_id = f"{size}px_block{block}_cover{coverage}"
+                case = run_case(reader, src_path, make_feature(size, coverage), args.repeat)
+                results["cases"][case_id] = case
+                stages = ", ".join(
+                    f"{stage} {timing['seconds']:.3f}s/{timing['peak_mb']:.0f}MB"
+                    for stage, timing in case["stages"].items())
+                print(f"{case_id:<32} {case['features']:>7} features: {stages}")
+
+    results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000
+    print(f"max rss: {results['max_rss_mb']:.0f}MB")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\ncompared with {args.compare} (commit {baseline.get('commit')})")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} stage(s) regressed above {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Baseline comparison shared by the benchmarks.
+
+Kept apart from bench_pipeline.py so that importing it loads neither the
+raster stack nor the app, bench_import.py measures those imports.
+"""
+import os
+import subprocess
+
+NOISE_FLOOR_SECONDS = 0.02
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for case_id, case in results["cases"].items():
+        baseline_case = baseline["cases"].get(case_id)
+        if not baseline_case:
+            continue
+        for stage, current in case["stages"].items():
+            previous = baseline_case["stages"].get(stage)
+            if not previous:
+                continue
+            ratio = current["seconds"] / max(previous["seconds"], 1e-9)
+            slower = current["seconds"] - previous["seconds"] > NOISE_FLOOR_SECONDS and ratio > 1 + threshold
+            more_memory = current["peak_mb"] > previous["peak_mb"] * (1 + threshold) + 1
+            marker = " REGRESSION" if slower or more_memory else ""
+            print(
+                f"{case_id:<32} {stage:<20} {previous['seconds']:.3f}s -> {current['seconds']:.3f}s "
+                f"({ratio:.2f}x), {previous['peak_mb']:.1f}MB -> {current['peak_mb']:.1f}MB{marker}")
+            if marker:
+                regressions.append((case_id, stage))
+    return regressions
@@ -0,0 +1,55 @@
+"""Synthetic MapBiomas-like coverages, shared by the benchmarks and the tests.
+
+Square blocks of random classes, small blocks make a fragmented landscape.
+Coverages are tiled GeoTIFFs with internal overviews, as the COGs read from
+the bucket.
+"""
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+
+PIXEL_SIZE = 0.000269494585236
+ORIGIN = (-45.14, -21.155)
+CLASSES = (3, 4, 12, 15, 21, 33)
+
+
+def synthetic_classes(size, block, seed=0, classes=CLASSES):
+    rng = np.random.default_rng(seed)
+    blocks = rng.choice(np.array(classes, dtype="uint8"), size=(-(-size // block), -(-size // block)))
+    return np.kron(blocks, np.ones((block, block), dtype="uint8"))[:size, :size]
+
+
+def synthetic_transform(origin=ORIGIN):
+    return Affine(PIXEL_SIZE, 0.0, origin[0], 0.0, -PIXEL_SIZE, origin[1])
+
+
+def write_synthetic_coverage(
+        path, seed, size=128, block=8, classes=CLASSES, origin=ORIGIN, blocksize=64, overviews=(2, 4)):
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint8",
+        "count": 1,
+        "width": size,
+        "height": size,
+        "crs": "EPSG:4326",
+        "transform": synthetic_transform(origin),
+        "nodata": 0,
+        "tiled": True,
+        "blockxsize": blocksize,
+        "blockysize": blocksize,
+        "compress": "deflate",
+    }
+    with rasterio.open(path, "w", **profile) as dataset:
+        dataset.write(synthetic_classes(size, block, seed, classes), 1)
+        if overviews:
+            dataset.build_overviews(list(overviews), Resampling.nearest)
+    return path
+
+
+def area_per_class(polygons, decimals=3):
+    areas = {}
+    for feature in polygons["features"]:
+        pixel_value = feature["properties"]["pixel_value"]
+        areas[pixel_value] = areas.get(pixel_value, 0) + feature["properties"]["area_ha"]
+    return {pixel_value: round(area, decimals) for pixel_value, area in areas.items()}
@@ -3,7 +3,8 @@ from datetime import datetime
 
 class AppConfig:
     def __init__(self):
-        self.url_mapbiomas = os.getenv("URL_MAPBIOMAS", "https://storage.googleapis.com/mapbiomas-public/initiatives/brasil/collection_8/lclu/coverage")
+        self.url_mapbiomas = self.__get_source(os.getenv("URL_MAPBIOMAS", "https://storage.googleapis.com/mapbiomas-public/initiatives/brasil/collection_8/lclu/coverage"))
+        self.class_legend_path = os.getenv("CLASS_LEGEND_PATH", "")
         self.url_mapbiomas_legend = os.getenv("URL_MAPBIOMAS_LEGEND", "https://brasil.mapbiomas.org/wp-content/uploads/sites/4/2023/08/Legenda-Colecao-8-LEGEND-CODE.pdf")
         self.mapbiomas_start_year = int(os.getenv("MAPBIOMAS_START_YEAR", "1985"))
         self.mapbiomas_end_year = int(os.getenv("MAPBIOMAS_END_YEAR", "2022"))
@@ -13,4 +14,46 @@ class AppConfig:
         self.map_feature_atributes_alias = os.getenv("MAP_FEATURE_ATRIBUTES_ALIAS", "Type,Name,Area (ha),Pixel Value").split(",")
         self.open_street_maps = os.getenv("OSM_BASEMAP", "https://tile.openstreetmap.org/{z}/{x}/{y}.png")
         self.google_basemap = os.getenv("GOOGLE_BASEMAP", "https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}")
-        self.esri_basemap = os.getenv("ESRI_BASEMAP", "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}")
\ No newline at end of file
+        self.esri_basemap = os.getenv("ESRI_BASEMAP", "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}")
+        self.result_cache_path = os.getenv("RESULT_CACHE_PATH", "")
+        self.result_cache_max_size_mb = float(os.getenv("RESULT_CACHE_MAX_SIZE_MB", "512"))
+        self.max_workers = int(os.getenv("MAX_WORKERS", "4"))
+        self.max_tiled_polygon_clip_area_ha = float(os.getenv("MAX_TILED_POLYGON_CLIP_AREA_HA", "0"))
+        self.tile_size = int(os.getenv("TILE_SIZE", "2048"))
+        self.reader_pool_max_handles = int(os.getenv("READER_POOL_MAX_HANDLES", "16"))
+        self.reader_pool_idle_timeout = float(os.getenv("READER_POOL_IDLE_TIMEOUT", "300"))
+        self.preview_pixel_budget = int(os.getenv("PREVIEW_PIXEL_BUDGET", "250000"))
+        self.max_batch_features = int(os.getenv("MAX_BATCH_FEATURES", "500"))
+        self.map_width_px = int(os.getenv("MAP_WIDTH_PX", "1200"))
+        self.map_max_vertices = int(os.getenv("MAP_MAX_VERTICES", "250000"))
+        self.map_image_max_size = int(os.getenv("MAP_IMAGE_MAX_SIZE", "1024"))
+        self.map_zoom_levels = int(os.getenv("MAP_ZOOM_LEVELS", "4"))
+        self.stream_map_interval_seconds = float(os.getenv("STREAM_MAP_INTERVAL_SECONDS", "5"))
+        self.streamed_results_max_entries = int(os.getenv("STREAMED_RESULTS_MAX_ENTRIES", "4"))
+        self.area_engine = os.getenv("AREA_ENGINE", "rows")
+        self.histogram_pyramid_dir = os.getenv("HISTOGRAM_PYRAMID_DIR", "")
+        self.block_cache_path = os.getenv("BLOCK_CACHE_PATH", "")
+        self.block_cache_max_size_mb = float(os.getenv("BLOCK_CACHE_MAX_SIZE_MB", "2048"))
+        self.block_cache_port = int(os.getenv("BLOCK_CACHE_PORT", "8765"))
+        self.scheduler_workers = int(os.getenv("SCHEDULER_WORKERS", "0"))
+        self.scheduler_max_running_pixels = int(os.getenv("SCHEDULER_MAX_RUNNING_PIXELS", "12000000"))
+        self.scheduler_max_queued_jobs = int(os.getenv("SCHEDULER_MAX_QUEUED_JOBS", "20"))
+        self.mapbiomas_resolution_m = float(os.getenv("MAPBIOMAS_RESOLUTION_M", "30"))
+        self.instrumentation = os.getenv("INSTRUMENTATION", "false").lower() == "true"
+        self.instrumentation_trace_memory = os.getenv("INSTRUMENTATION_TRACE_MEMORY", "false").lower() == "true"
+        self.profiler = os.getenv("PROFILER", "")
+        self.profile_dir = os.getenv("PROFILE_DIR", "profiles")
+        self.metrics_port = int(os.getenv("METRICS_PORT", "0"))
+
+    @staticmethod
+    def __get_source(url):
+        # A local directory (or file:// url) with the brasil_coverage_{year}.tif
+        # files works as well, e.g. a mirror of the bucket.
+        if url.startswith("file://"):
+            url = url[len("file://"):]
+        if "://" not in url:
+            url = os.path.abspath(os.path.expanduser(url))
+        return url.rstrip("/")
+
+    def get_url_mapbiomas(self, year):
+        return f"{self.url_mapbiomas}/brasil_coverage_{year}.tif"
@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import sqlite3
+import logging
+import argparse
+import shapely
+from contextlib import closing
+from shapely.geometry import mapping, shape
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from app_config import AppConfig
+from model.export_writers import write_ndjson
+from model.block_cache import BlockCache, is_remote, prefetch as prefetch_blocks, serve_block_cache, start_block_cache_server
+from model.class_table import load_class_table
+
+app_config_data = AppConfig()
+logger = logging.getLogger("mapbiomas_cli")
+
+GPKG_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+
+def parse_years(values):
+    years = []
+    for value in values:
+        for part in value.split(","):
+            if "-" in part:
+                start, end = part.split("-")
+                years.extend(range(int(start), int(end) + 1))
+            elif part:
+                years.append(int(part))
+    return sorted(set(years))
+
+
+def gpkg_to_wkb(blob):
+    flags = blob[3]
+    envelope_size = GPKG_ENVELOPE_SIZES[(flags >> 1) & 0b111]
+    return bytes(blob[8 + envelope_size:])
+
+
+def read_geopackage(path):
+    with closing(sqlite3.connect(path)) as connection:
+        tables = connection.execute(
+            "SELECT c.table_name, g.column_name, g.srs_id FROM gpkg_contents c "
+            "JOIN gpkg_geometry_columns g ON c.table_name = g.table_name "
+            "WHERE c.data_type = 'features'").fetchall()
+        for table_name, geometry_column, srs_id in tables:
+            if srs_id != 4326:
+                raise ValueError(f"{table_name}: only EPSG:4326 GeoPackages are supported, got srs_id {srs_id}")
+            cursor = connection.execute(f'SELECT * FROM "{table_name}"')
+            columns = [column[0] for column in cursor.description]
+            for row in cursor:
+                properties = dict(zip(columns, row))
+                blob = properties.pop(geometry_column)
+                if blob is None:
+                    continue
+                geometry = shapely.from_wkb(gpkg_to_wkb(blob))
+                yield {
+                    "type": "Feature",
+                    "id": properties.get("fid"),
+                    "properties": properties,
+                    "geometry": mapping(geometry)
+                }
+
+
+def read_ndjson(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_features(path):
+    if path == "-":
+        yield from read_ndjson(sys.stdin)
+        return
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".gpkg":
+        yield from read_geopackage(path)
+    elif extension in (".ndjson", ".jsonl", ".geojsonl"):
+        with open(path, encoding="utf-8") as stream:
+            yield from read_ndjson(stream)
+    else:
+        with open(path, encoding="utf-8") as stream:
+            input_json = json.load(stream)
+        if input_json.get("type") == "FeatureCollection":
+            yield from input_json.get("features", [])
+        else:
+            yield input_json
+
+
+class Checkpoint:
+    def __init__(self, output_path):
+        self.path = f"{output_path}.checkpoint"
+        self.done = set()
+        self.offset = 0
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as checkpoint:
+                for line in checkpoint:
+                    feature_index, year, offset = line.rstrip("\n").rsplit("\t", 2)
+                    self.done.add((int(feature_index), int(year)))
+                    self.offset = max(self.offset, int(offset))
+
+    def record(self, feature_index, year, offset):
+        with open(self.path, "a", encoding="utf-8") as checkpoint:
+            checkpoint.write(f"{feature_index}\t{year}\t{offset}\n")
+        self.done.add((feature_index, year))
+
+
+def extract_job(polygon_renderer, feature, year, output_options):
+    params = {
+        "src_path": app_config_data.get_url_mapbiomas(year),
+        "feature_geojson": feature,
+        "classes_names": load_class_table(app_config_data.class_legend_path),
+        "max_size": None,
+        "year": year,
+        **output_options
+    }
+    return polygon_renderer.render_mapbiomas(params)
+
+
+def as_feature(item):
+    if item.get("type") == "Feature":
+        return item
+    return {"type": "Feature", "properties": {}, "geometry": item}
+
+
+def iter_jobs(features, years, done):
+    # Jobs are checkpointed on the position of the feature in the input,
+    # ids may be missing or repeated.
+    from model.read_cog import ReadCOG
+    feature_ids = set()
+    for index, feature in enumerate(map(as_feature, features)):
+        if not feature.get("geometry"):
+            continue
+        feature_id = str(ReadCOG.get_feature_id(feature, index))
+        if feature_id in feature_ids:
+            logger.warning("feature %s: id %s is repeated in the input", index, feature_id)
+        feature_ids.add(feature_id)
+        for year in years:
+            if (index, year) not in done:
+                yield index, feature_id, feature, year
+
+
+def extract(args):
+    # Imported here, serve-cache starts without the raster stack.
+    from controller.polygon_renderer import PolygonRenderer
+    years = parse_years(args.years)
+    output_options = {
+        "min_pixels": args.min_pixels,
+        "min_area_ha": args.min_area_ha,
+        "dissolve": args.dissolve,
+        "smooth": args.smooth
+    }
+    if args.overwrite and os.path.exists(f"{args.output}.checkpoint"):
+        os.remove(f"{args.output}.checkpoint")
+    checkpoint = Checkpoint(args.output)
+    # Without a checkpoint the output was not written by a previous run.
+    if not checkpoint.done and not args.overwrite and os.path.exists(args.output) and os.path.getsize(args.output):
+        raise SystemExit(f"{args.output} exists and has no checkpoint, use --overwrite to replace it")
+    polygon_renderer = PolygonRenderer()
+
+    # Drop anything written after the last checkpoint, a job interrupted
+    # halfway is then extracted again from scratch.
+    with open(args.output, "a+b") as output:
+        output.truncate(checkpoint.offset)
+
+    jobs = iter_jobs(read_features(args.input), years, set(checkpoint.done))
+    max_pending = args.workers * 2
+    written = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor, open(args.output, "ab") as output:
+        pending = {}
+        for job in jobs:
+            feature_index, feature_id, feature, year = job
+            pending[executor.submit(extract_job, polygon_renderer, feature, year, output_options)] = (
+                feature_index, feature_id, year)
+            if len(pending) >= max_pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                written += write_results(finished, pending, output, checkpoint)
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            written += write_results(finished, pending, output, checkpoint)
+
+    logger.info("%s jobs written to %s", written, args.output)
+    return written
+
+
+def write_results(finished, pending, output, checkpoint):
+    written = 0
+    for future in finished:
+        feature_index, feature_id, year = pending.pop(future)
+        try:
+            polygons = future.result()
+        except Exception as error:
+            # Not checkpointed, the next run retries it.
+            logger.error("feature %s year %s failed: %s", feature_id, year, error)
+            continue
+        if polygons.get("busy"):
+            logger.error("feature %s year %s failed: scheduler queue full", feature_id, year)
+            continue
+        if "error" in polygons:
+            logger.warning("feature %s: area %sha above the allowed maximum, skipped", feature_id, polygons.get("area_ha"))
+        else:
+            for polygon in polygons.get("features", []):
+                polygon["properties"]["feature_id"] = feature_id
+            write_ndjson(polygons.get("features", []), output)
+            output.flush()
+        checkpoint.record(feature_index, year, output.tell())
+        written += 1
+    return written
+
+
+def prefetch(args):
+    years = parse_years(args.years)
+    geometries = [shape(feature["geometry"]) for feature in map(as_feature, read_features(args.input)) if feature.get("geometry")]
+    region = shapely.union_all(geometries)
+    max_size_bytes = int(args.max_size_mb * 1_000_000)
+    server_url = start_block_cache_server(args.cache_path, max_size_bytes, args.port)
+    cache = BlockCache(args.cache_path, max_size_bytes=max_size_bytes)
+
+    def prefetch_year(year):
+        src_path = app_config_data.get_url_mapbiomas(year)
+        if not is_remote(src_path):
+            return {"tiles": 0, "fetched_bytes": 0}
+        return prefetch_blocks(cache, server_url, src_path, region)
+
+    tiles = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for year, result in zip(years, executor.map(prefetch_year, years)):
+            logger.info("%s: %s tiles, %.1fMB fetched", year, result["tiles"], result["fetched_bytes"] / 1_000_000)
+            tiles += result["tiles"]
+
+    stats = cache.stats()
+    logger.info("block cache %s: %s blocks, %.1fMB", args.cache_path, stats["entries"], stats["size_bytes"] / 1_000_000)
+    return tiles
+
+
+def serve_cache(args):
+    logger.info("block cache %s served on %s:%s", args.cache_path, args.host, args.port)
+    serve_block_cache(args.cache_path, int(args.max_size_mb * 1_000_000), args.port, args.host)
+
+
+def build_pyramid(args):
+    from model.read_cog import ReadCOG
+    from model.histogram_pyramid import HistogramPyramid, get_pyramid_path
+    years = parse_years(args.years)
+    os.makedirs(args.output_dir, exist_ok=True)
+    cog_reader = ReadCOG(float_precision=app_config_data.float_precision)
+
+    built = 0
+    for year in years:
+        src_path = app_config_data.get_url_mapbiomas(year)
+        path = get_pyramid_path(args.output_dir, src_path)
+        # Existing pyramids are kept, running it again resumes.
+        if os.path.exists(path):
+            logger.info("%s: %s exists, skipped", year, path)
+            continue
+        pyramid = HistogramPyramid.build(cog_reader, src_path, args.block_size, args.workers)
+        pyramid.save(path)
+        logger.info("%s: %s levels, %.1fMB written to %s", year, len(pyramid.levels), os.path.getsize(path) / 1_000_000, path)
+        built += 1
+    return built
+
+
+def add_block_cache_arguments(parser):
+    parser.add_argument("--cache-path", default=app_config_data.block_cache_path or None,
+                        required=not app_config_data.block_cache_path, help="sqlite file, BLOCK_CACHE_PATH by default")
+    parser.add_argument("--max-size-mb", type=float, default=app_config_data.block_cache_max_size_mb)
+    parser.add_argument("--port", type=int, default=app_config_data.block_cache_port)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Mapbiomas Vector Extractor command line")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extract_parser = subparsers.add_parser("extract", help="extract Mapbiomas polygons for every input feature")
+    extract_parser.add_argument("input", help="GeoJSON, GeoPackage or NDJSON file, '-' for NDJSON from stdin")
+    extract_parser.add_argument("--years", nargs="+", default=[str(app_config_data.mapbiomas_end_year)],
+                                help="years or ranges, e.g. 1985-2000 2010,2022")
+    extract_parser.add_argument("--output", required=True, help="NDJSON output file, appended to on resume")
+    extract_parser.add_argument("--overwrite", action="store_true",
+                                help="replace an existing output and its checkpoint instead of resuming")
+    extract_parser.add_argument("--workers", type=int, default=app_config_data.max_workers)
+    extract_parser.add_argument("--min-pixels", type=int, default=0,
+                                help="merge regions smaller than this many pixels into their largest neighbour")
+    extract_parser.add_argument("--min-area-ha", type=float, default=0, help="drop polygons smaller than this area")
+    extract_parser.add_argument("--dissolve", action="store_true", help="one feature per class and input feature")
+    extract_parser.add_argument("--smooth", action="store_true", help="collapse pixel stair steps")
+    extract_parser.set_defaults(func=extract)
+
+    prefetch_parser = subparsers.add_parser("prefetch", help="warm the block cache for a region, every year by default")
+    prefetch_parser.add_argument("input", help="GeoJSON, GeoPackage or NDJSON file with the region, e.g. one state")
+    prefetch_parser.add_argument("--years", nargs="+",
+                                 default=[f"{app_config_data.mapbiomas_start_year}-{app_config_data.mapbiomas_end_year}"])
+    prefetch_parser.add_argument("--workers", type=int, default=app_config_data.max_workers)
+    add_block_cache_arguments(prefetch_parser)
+    prefetch_parser.set_defaults(func=prefetch)
+
+    pyramid_parser = subparsers.add_parser(
+        "build-pyramid", help="precompute the class area pyramids of the area summaries, every year by default")
+    pyramid_parser.add_argument("--years", nargs="+",
+                                default=[f"{app_config_data.mapbiomas_start_year}-{app_config_data.mapbiomas_end_year}"])
+    pyramid_parser.add_argument("--output-dir", default=app_config_data.histogram_pyramid_dir or None,
+                                required=not app_config_data.histogram_pyramid_dir,
+                                help="one npz file per year, HISTOGRAM_PYRAMID_DIR by default")
+    pyramid_parser.add_argument("--block-size", type=int, default=256, help="pixels per side of the finest blocks")
+    pyramid_parser.add_argument("--workers", type=int, default=app_config_data.max_workers)
+    pyramid_parser.set_defaults(func=build_pyramid)
+
+    serve_parser = subparsers.add_parser("serve-cache", help="run the block cache server shared by the app processes")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    add_block_cache_arguments(serve_parser)
+    serve_parser.set_defaults(func=serve_cache)
+    return parser
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = get_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    main()
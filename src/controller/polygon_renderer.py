@@ -1,19 +1,372 @@
+import os
 from model.read_cog import ReadCOG
+from model.result_cache import ResultCache
+from model.reader_pool import ReaderPool
+from model.block_cache import start_block_cache_server
+from model.job_scheduler import JobScheduler, job_key
+from model.histogram_pyramid import get_pyramid_path, load_histogram_pyramid
+from model.instrumentation import instrumentation
 from app_config import AppConfig
 app_config_data = AppConfig()
 
 class PolygonRenderer:
     def __init__(self,):
-        self.cog_reader = self.__model_read_cog()
+        self.__configure_instrumentation()
+        self.reader_pool = self.__model_reader_pool()
+        self.block_cache_url = self.__model_block_cache()
+        self.cog_reader = self.__model_read_cog(self.reader_pool, self.block_cache_url)
+        self.result_cache = self.__model_result_cache()
+        self.scheduler = self.__model_scheduler()
 
     @staticmethod
-    def __model_read_cog():
-        return ReadCOG(float_precision=app_config_data.float_precision)
+    def __configure_instrumentation():
+        instrumentation.configure(
+            enabled=app_config_data.instrumentation,
+            trace_memory=app_config_data.instrumentation_trace_memory,
+            profiler=app_config_data.profiler,
+            profile_dir=app_config_data.profile_dir,
+            metrics_port=app_config_data.metrics_port
+        )
 
+    @staticmethod
+    def __model_reader_pool():
+        if app_config_data.reader_pool_max_handles <= 0:
+            return None
+        return ReaderPool(
+            max_handles=app_config_data.reader_pool_max_handles,
+            idle_timeout=app_config_data.reader_pool_idle_timeout
+        )
+
+    @staticmethod
+    def __model_block_cache():
+        if not app_config_data.block_cache_path:
+            return None
+        return start_block_cache_server(
+            app_config_data.block_cache_path,
+            max_size_bytes=int(app_config_data.block_cache_max_size_mb * 1_000_000),
+            port=app_config_data.block_cache_port
+        )
+
+    @staticmethod
+    def __model_read_cog(reader_pool, block_cache_url):
+        return ReadCOG(
+            float_precision=app_config_data.float_precision,
+            reader_pool=reader_pool,
+            area_engine=app_config_data.area_engine,
+            block_cache_url=block_cache_url
+        )
+
+    @staticmethod
+    def __model_result_cache():
+        if not app_config_data.result_cache_path:
+            return None
+        return ResultCache(
+            app_config_data.result_cache_path,
+            max_size_bytes=int(app_config_data.result_cache_max_size_mb * 1_000_000),
+            float_precision=app_config_data.float_precision
+        )
+
+    @staticmethod
+    def __model_scheduler():
+        if app_config_data.scheduler_workers <= 0:
+            return None
+        return JobScheduler(
+            max_workers=app_config_data.scheduler_workers,
+            max_running_cost=app_config_data.scheduler_max_running_pixels,
+            max_queued_jobs=app_config_data.scheduler_max_queued_jobs
+        )
+
+    @staticmethod
+    def estimate_cost(geom_area, params):
+        # Pixels read, the polygon area at the coverage resolution or the
+        # preview size.
+        pixels = geom_area * 10_000 / app_config_data.mapbiomas_resolution_m ** 2
+        if params.get("max_size"):
+            pixels = min(pixels, params.get("max_size") ** 2)
+        return int(pixels)
+
+    @staticmethod
+    def __get_render_params(params, geom_area):
+        if geom_area <= app_config_data.max_polygon_clip_area_ha or params.get("max_size"):
+            return params
+        return {
+            **params,
+            "tile_size": app_config_data.tile_size,
+            "max_workers": app_config_data.max_workers
+        }
+
+    def __get_job_params(self, params):
+        # Callbacks stay in the session, the worker builds its own reader.
+        job_params = {key: value for key, value in params.items() if not callable(value)}
+        job_params["reader_options"] = self.cog_reader.reader_options
+        return job_params
+
+    def __submit_job(self, render_params, geom_area, stream=False):
+        job_params = self.__get_job_params(render_params)
+        # Streamed or not, the same extraction shares one job.
+        return self.scheduler.submit(
+            job_key("render_mapbiomas", job_params), self.estimate_cost(geom_area, render_params),
+            stream_job if stream else render_job, job_params, stream=stream)
+
+    def __get_busy_error(self):
+        return {"error":True, "busy":True, "queued":self.scheduler.stats()["queued"]}
+
+    def __render_polygons(self, params, geom_area):
+        render_params = self.__get_render_params(params, geom_area)
+        if not self.scheduler:
+            return render_polygons(self.cog_reader, render_params)
+
+        job = self.__submit_job(render_params, geom_area)
+        if job is None:
+            return self.__get_busy_error()
+        return self.scheduler.wait(job, params.get("progress_callback"))
+
+    def __stream_polygons(self, params, geom_area):
+        # Tiles are yielded as they finish, by the scheduler workers too,
+        # single window extractions come as one final chunk.
+        render_params = self.__get_render_params(params, geom_area)
+        if not render_params.get("tile_size"):
+            yield final_chunk(self.__render_polygons(params, geom_area))
+            return
+        if not self.scheduler:
+            yield from self.cog_reader.iter_mapbiomas_tiled(render_params)
+            return
+
+        job = self.__submit_job(render_params, geom_area, stream=True)
+        if job is None:
+            yield final_chunk(self.__get_busy_error())
+            return
+        yield from self.scheduler.iter_chunks(job, params.get("progress_callback"))
+        yield final_chunk(self.scheduler.wait(job))
+
+    @staticmethod
+    def __get_max_area():
+        return max(app_config_data.max_polygon_clip_area_ha, app_config_data.max_tiled_polygon_clip_area_ha)
+
+    @instrumentation.traced("render_mapbiomas")
     def render_mapbiomas(self, params):
+        geom = params.get("feature_geojson").get("geometry")
+        geom_area = self.cog_reader.area_ha(geom)
+        if geom_area > self.__get_max_area():
+            return {"error":True, "area_ha":geom_area}
+
+        if not self.result_cache:
+            return self.__render_polygons(params, geom_area)
+
+        cache_key = self.result_cache.make_key(params, self.cog_reader.reader_options)
+        polygons = self.result_cache.get(cache_key, params)
+        if polygons is not None:
+            return polygons
+
+        polygons = self.__render_polygons(params, geom_area)
+        if polygons and "error" not in polygons:
+            self.result_cache.set(cache_key, polygons)
+        return polygons
+
+    @instrumentation.traced_stream("stream_mapbiomas")
+    def stream_mapbiomas(self, params):
+        # As render_mapbiomas, as chunks: partial results while the tiles of
+        # large polygons finish and the complete result as the final chunk.
+        geom = params.get("feature_geojson").get("geometry")
+        geom_area = self.cog_reader.area_ha(geom)
+        if geom_area > self.__get_max_area():
+            yield final_chunk({"error":True, "area_ha":geom_area})
+            return
+
+        if not self.result_cache:
+            yield from self.__stream_polygons(params, geom_area)
+            return
+
+        cache_key = self.result_cache.make_key(params, self.cog_reader.reader_options)
+        polygons = self.result_cache.get(cache_key, params)
+        if polygons is not None:
+            yield final_chunk(polygons)
+            return
+
+        for chunk in self.__stream_polygons(params, geom_area):
+            if chunk["final"] and chunk["polygons"] and "error" not in chunk["polygons"]:
+                self.result_cache.set(cache_key, chunk["polygons"])
+            yield chunk
+
+    def get_preview_max_size(self, params):
+        return self.cog_reader.get_adaptive_max_size(
+            params.get("src_path"),
+            params.get("feature_geojson"),
+            app_config_data.preview_pixel_budget
+        )
+
+    @staticmethod
+    def get_histogram_pyramid(src_path):
+        if not app_config_data.histogram_pyramid_dir:
+            return None
+        path = get_pyramid_path(app_config_data.histogram_pyramid_dir, src_path)
+        if not os.path.exists(path):
+            return None
+        return load_histogram_pyramid(path)
+
+    @instrumentation.traced("render_zonal_stats")
+    def render_zonal_stats(self, params):
+        # With a pyramid only the boundary is read, any area is allowed.
+        pyramid = self.get_histogram_pyramid(params.get("src_path"))
+        if pyramid:
+            return self.cog_reader.zonal_stats_from_pyramid(pyramid, {**params, "max_workers": app_config_data.max_workers})
+
+        geom = params.get("feature_geojson").get("geometry")
+        geom_area = self.cog_reader.area_ha(geom)
+        if geom_area > app_config_data.max_polygon_clip_area_ha:
+            return {"error":True, "area_ha":geom_area}
+
+        return self.cog_reader.zonal_stats(params)
+
+    @instrumentation.traced("render_transition_matrix")
+    def render_transition_matrix(self, params):
         geom = params.get("feature_geojson").get("geometry")
         geom_area = self.cog_reader.area_ha(geom)
         if geom_area > app_config_data.max_polygon_clip_area_ha:
             return {"error":True, "area_ha":geom_area}
 
-        return self.cog_reader.render_mapbiomas_from_cog(params)
+        return self.cog_reader.transition_matrix(params)
+
+    @instrumentation.traced("render_mapbiomas_batch")
+    def render_mapbiomas_batch(self, params):
+        features = params.get("features")
+        if len(features) > app_config_data.max_batch_features:
+            return {"error":True, "feature_count":len(features)}
+
+        for index, feature in enumerate(features):
+            geom_area = self.cog_reader.area_ha(feature.get("geometry"))
+            if geom_area > app_config_data.max_polygon_clip_area_ha:
+                return {"error":True, "area_ha":geom_area, "feature_id":self.cog_reader.get_feature_id(feature, index)}
+
+        batch_params = {
+            **params,
+            "max_group_area_ha": app_config_data.max_polygon_clip_area_ha,
+            "max_workers": app_config_data.max_workers
+        }
+        if not self.scheduler:
+            return self.cog_reader.render_mapbiomas_batch(batch_params)
+
+        # One job for the batch, its threads read up to max_workers groups
+        # of at most max_polygon_clip_area_ha at once.
+        job_params = self.__get_job_params(batch_params)
+        cost_area = min(
+            sum(self.cog_reader.area_ha(feature.get("geometry")) for feature in features),
+            app_config_data.max_polygon_clip_area_ha * app_config_data.max_workers)
+        job = self.scheduler.submit(
+            job_key("render_mapbiomas_batch", job_params), self.estimate_cost(cost_area, params),
+            batch_job, job_params, stream=True)
+        if job is None:
+            return self.__get_busy_error()
+        progress_callback = params.get("progress_callback")
+        for chunk in self.scheduler.iter_chunks(job, params.get("job_status_callback")):
+            if progress_callback:
+                progress_callback(chunk["done"], chunk["total"])
+        return self.scheduler.wait(job)
+
+    @instrumentation.traced("render_mapbiomas_timeseries")
+    def render_mapbiomas_timeseries(self, params, years):
+        for chunk in self.__iter_mapbiomas_timeseries(params, years):
+            if chunk["final"]:
+                return chunk["polygons"]
+
+    @instrumentation.traced_stream("stream_mapbiomas_timeseries")
+    def stream_mapbiomas_timeseries(self, params, years):
+        # As render_mapbiomas_timeseries, yielding each year as it finishes,
+        # cached years first, and all of them as the final chunk.
+        yield from self.__iter_mapbiomas_timeseries(params, years)
+
+    def __iter_mapbiomas_timeseries(self, params, years):
+        geom = params.get("feature_geojson").get("geometry")
+        geom_area = self.cog_reader.area_ha(geom)
+        if geom_area > app_config_data.max_polygon_clip_area_ha:
+            yield final_chunk({"error":True, "area_ha":geom_area})
+            return
+
+        polygons_per_year = {}
+        cache_keys = {}
+        if self.result_cache:
+            for year in years:
+                year_params = {**params, "src_path": app_config_data.get_url_mapbiomas(year), "year": year}
+                cache_keys[year] = self.result_cache.make_key(year_params, self.cog_reader.reader_options)
+                polygons = self.result_cache.get(cache_keys[year], year_params)
+                if polygons is not None:
+                    polygons_per_year[year] = polygons
+                    yield {"polygons": polygons, "year": year, "done": len(polygons_per_year), "total": len(years), "final": False}
+
+        missing_years = [year for year in years if year not in polygons_per_year]
+        if missing_years:
+            timeseries_params = {
+                **params,
+                "src_paths": {year: app_config_data.get_url_mapbiomas(year) for year in missing_years},
+                "max_workers": app_config_data.max_workers,
+                "combine": False
+            }
+            for chunk in self.__iter_timeseries_years(timeseries_params, missing_years, geom_area):
+                if chunk["final"]:
+                    if chunk["polygons"].get("busy"):
+                        yield chunk
+                        return
+                    break
+                year, polygons = chunk["year"], chunk["polygons"]
+                if self.result_cache and polygons:
+                    self.result_cache.set(cache_keys[year], polygons)
+                polygons_per_year[year] = polygons
+                yield {**chunk, "done": len(polygons_per_year), "total": len(years)}
+
+        if params.get("combine"):
+            yield final_chunk(self.cog_reader.combine_years(polygons_per_year))
+        else:
+            yield final_chunk({year: polygons_per_year[year] for year in years})
+
+    def __iter_timeseries_years(self, params, years, geom_area):
+        if not self.scheduler:
+            yield from self.cog_reader.iter_mapbiomas_timeseries(params, years)
+            return
+
+        # One job for the years, its threads read up to max_workers of them
+        # at once and its chunks come back as each year finishes.
+        job_params = {**self.__get_job_params(params), "years": years}
+        cost_area = geom_area * min(len(years), app_config_data.max_workers)
+        job = self.scheduler.submit(
+            job_key("render_mapbiomas_timeseries", job_params), self.estimate_cost(cost_area, params),
+            timeseries_job, job_params, stream=True)
+        if job is None:
+            yield final_chunk(self.__get_busy_error())
+            return
+        yield from self.scheduler.iter_chunks(job, params.get("progress_callback"))
+        yield final_chunk(self.scheduler.wait(job))
+
+
+def final_chunk(polygons):
+    return {"polygons": polygons, "done": 1, "total": 1, "final": True}
+
+
+def render_polygons(cog_reader, params):
+    if params.get("tile_size"):
+        return cog_reader.render_mapbiomas_tiled(params)
+    return cog_reader.render_mapbiomas_from_cog(params)
+
+
+def render_job(params):
+    return render_polygons(ReadCOG(**params.get("reader_options", {})), params)
+
+
+def put_chunks(chunk_queue, chunks):
+    for chunk in chunks:
+        if chunk["final"]:
+            return chunk["polygons"]
+        chunk_queue.put(chunk)
+
+
+def stream_job(chunk_queue, params):
+    return put_chunks(chunk_queue, ReadCOG(**params.get("reader_options", {})).iter_mapbiomas_tiled(params))
+
+
+def timeseries_job(chunk_queue, params):
+    cog_reader = ReadCOG(**params.get("reader_options", {}))
+    return put_chunks(chunk_queue, cog_reader.iter_mapbiomas_timeseries(params, params.get("years")))
+
+
+def batch_job(chunk_queue, params):
+    params = {**params, "progress_callback": lambda done, total: chunk_queue.put({"done": done, "total": total})}
+    return ReadCOG(**params.get("reader_options", {})).render_mapbiomas_batch(params)
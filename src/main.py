@@ -1,15 +1,18 @@
 import json
-import folium
-import pandas as pd
-import geopandas as gpd
+import time
+import hashlib
 import streamlit as st
 from io import StringIO
-from streamlit_folium import st_folium
 from app_config import AppConfig
-from controller.polygon_renderer import PolygonRenderer
-from mapbiomas_classes import mapbiomas_classes
+from model.instrumentation import instrumentation
+from model.class_table import load_class_table
+
+# pandas, folium and the raster stack (rasterio, rio-tiler, pyproj, scipy)
+# are imported by the functions using them, the page renders and waits for
+# an upload without loading them (see benchmarks/bench_import.py).
 
 app_config_data = AppConfig()
+class_table = load_class_table(app_config_data.class_legend_path)
 
 st.set_page_config(
     page_title="Mapbiomas Vector Extractor",
@@ -17,51 +20,280 @@ st.set_page_config(
     layout="wide"
 )
 
-worker_image_renderer = PolygonRenderer()
+@st.cache_resource
+def get_polygon_renderer():
+    from controller.polygon_renderer import PolygonRenderer
+    return PolygonRenderer()
+
+def show_job_status(status_bar, year, job_status):
+    if job_status["state"] == "queued":
+        status_bar.progress(
+            0.0, text=f"Waiting for {year}: position {job_status['position']} in the queue, {job_status['running']} running")
+    elif job_status["progress"] is None:
+        status_bar.progress(0.0, text=f"Processing {year}")
+    else:
+        status_bar.progress(job_status["progress"], text=f"Processing {year}: ~{job_status['progress']:.0%}")
 
 @st.cache_data
-def mapbiomas_clip(image_url, feature_geojson, year):
+def mapbiomas_clip(image_url, feature_geojson, year, max_size=None, output_options=None):
+    status_bar = st.empty()
     params = {
         "src_path": image_url,
         "feature_geojson": feature_geojson.get("features")[0],
-        "classes_names": mapbiomas_classes,
+        "classes_names": class_table,
+        "max_size": max_size,
+        "year": year,
+        "progress_callback": lambda job_status: show_job_status(status_bar, year, job_status),
+        **(output_options or {})
+    }
+
+    polygons = get_polygon_renderer().render_mapbiomas(params)
+    status_bar.empty()
+    if polygons.get("busy"):
+        # Not cached, the same request may be admitted on the next run.
+        st.warning(f"The server is busy ({polygons.get('queued')} extractions waiting), please try again in a few minutes")
+        st.stop()
+    if "error" in polygons:
+        max_area = max(app_config_data.max_polygon_clip_area_ha, app_config_data.max_tiled_polygon_clip_area_ha)
+        st.write(
+            f"Polygon area ({polygons.get('area_ha')}ha) must be smaller than {max_area}ha")
+        return {}
+
+    return polygons
+
+@st.cache_data
+def mapbiomas_preview_max_size(image_url, feature_geojson):
+    params = {
+        "src_path": image_url,
+        "feature_geojson": feature_geojson.get("features")[0]
+    }
+    return get_polygon_renderer().get_preview_max_size(params)
+
+@st.cache_data
+def mapbiomas_clip_batch(image_url, feature_geojson, year, output_options=None):
+    progress_bar = st.progress(0.0, text=f"Processing {year}")
+    params = {
+        "src_path": image_url,
+        "features": feature_geojson.get("features"),
+        "classes_names": class_table,
         "max_size": None,
-        "year": year
+        "year": year,
+        "progress_callback": lambda done, total: progress_bar.progress(
+            done / total, text=f"Processing {year}: {done}/{total} groups of nearby features"),
+        "job_status_callback": lambda job_status: show_job_status(progress_bar, year, job_status),
+        **(output_options or {})
+    }
+
+    polygons = get_polygon_renderer().render_mapbiomas_batch(params)
+    if polygons.get("busy"):
+        st.warning(f"The server is busy ({polygons.get('queued')} extractions waiting), please try again in a few minutes")
+        st.stop()
+    if "error" in polygons:
+        if "feature_count" in polygons:
+            st.write(
+                f"Feature count ({polygons.get('feature_count')}) must be at most {app_config_data.max_batch_features}")
+        else:
+            st.write(
+                f"Feature {polygons.get('feature_id')} area ({polygons.get('area_ha')}ha) must be smaller than {app_config_data.max_polygon_clip_area_ha}ha")
+        return {}
+
+    return polygons
+
+def get_streamed_result(*args):
+    # Streamed extractions draw their chunks as they arrive, outside
+    # st.cache_data, and keep their last complete results in the session.
+    result_key = hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return result_key, st.session_state.get("streamed_results", {}).get(result_key)
+
+def set_streamed_result(result_key, polygons):
+    streamed_results = st.session_state.setdefault("streamed_results", {})
+    streamed_results.pop(result_key, None)
+    streamed_results[result_key] = polygons
+    while len(streamed_results) > app_config_data.streamed_results_max_entries:
+        del streamed_results[next(iter(streamed_results))]
+    return polygons
+
+def mapbiomas_clip_streamed(image_url, feature_geojson, year, output_options=None):
+    result_key, polygons = get_streamed_result("mapbiomas_clip", image_url, feature_geojson, year, output_options)
+    if polygons is not None:
+        return polygons
+
+    status_bar = st.empty()
+    params = {
+        "src_path": image_url,
+        "feature_geojson": feature_geojson.get("features")[0],
+        "classes_names": class_table,
+        "max_size": None,
+        "year": year,
+        "progress_callback": lambda job_status: show_job_status(status_bar, year, job_status),
+        **(output_options or {})
     }
+    polygons = show_partial_results(get_polygon_renderer().stream_mapbiomas(params), feature_geojson, year, "tiles")
+    status_bar.empty()
+    if polygons.get("busy"):
+        st.warning(f"The server is busy ({polygons.get('queued')} extractions waiting), please try again in a few minutes")
+        st.stop()
+    if "error" in polygons:
+        max_area = max(app_config_data.max_polygon_clip_area_ha, app_config_data.max_tiled_polygon_clip_area_ha)
+        st.write(
+            f"Polygon area ({polygons.get('area_ha')}ha) must be smaller than {max_area}ha")
+        return {}
 
-    polygons = worker_image_renderer.render_mapbiomas(params)
+    return set_streamed_result(result_key, polygons)
+
+def mapbiomas_clip_timeseries(feature_geojson, years, output_options=None):
+    result_key, polygons = get_streamed_result("mapbiomas_clip_timeseries", feature_geojson, years, output_options)
+    if polygons is not None:
+        return polygons
+
+    years_name = f"{years[0]}-{years[-1]}"
+    status_bar = st.empty()
+    params = {
+        "feature_geojson": feature_geojson.get("features")[0],
+        "classes_names": class_table,
+        "max_size": None,
+        "combine": True,
+        "progress_callback": lambda job_status: show_job_status(status_bar, years_name, job_status),
+        **(output_options or {})
+    }
+    chunks = get_polygon_renderer().stream_mapbiomas_timeseries(params, years)
+    polygons = show_partial_results(chunks, feature_geojson, years_name, "years", map_year=years[-1])
+    status_bar.empty()
+    if polygons.get("busy"):
+        st.warning(f"The server is busy ({polygons.get('queued')} extractions waiting), please try again in a few minutes")
+        st.stop()
     if "error" in polygons:
         st.write(
             f"Polygon area ({polygons.get('area_ha')}ha) must be smaller than {app_config_data.max_polygon_clip_area_ha}ha")
         return {}
 
-    return polygons
+    return set_streamed_result(result_key, polygons)
+
+def show_partial_results(chunks, geometry, years_name, unit, map_year=None):
+    # Map, area table and progress of the chunks received so far, replaced
+    # by the complete result once the final chunk arrives. The tables add
+    # up the areas of each chunk. Timeseries draw map_year once it is done,
+    # tiles redraw the map at most every STREAM_MAP_INTERVAL_SECONDS and only
+    # then concatenate the tiles received.
+    import pandas as pd
+    from model.polygon_result import PolygonResult, as_polygon_result
+    partial_area = st.empty()
+    results = []
+    class_areas = {}
+    year_areas = []
+    map_drawn_at = None
+    for chunk in chunks:
+        if chunk["final"]:
+            break
+        if not results:
+            with partial_area.container():
+                progress_bar = st.progress(0.0)
+                col1, col2 = st.columns(2)
+                map_area, table_area = col1.empty(), col2.empty()
+        polygons = as_polygon_result(chunk["polygons"])
+        results.append(polygons)
+        progress_bar.progress(
+            chunk["done"] / chunk["total"], text=f"Processing {years_name}: {chunk['done']}/{chunk['total']} {unit}")
+        # Tiles without coverage and years outside it come without polygons.
+        if polygons.feature_count:
+            with table_area.container():
+                if map_year is None:
+                    add_class_areas(class_areas, summarize_polygons(polygons))
+                    plot_area_table(sorted(class_areas.values(), key=lambda row: row["area_ha"], reverse=True))
+                else:
+                    year_areas.append(polygons.to_dataframe().groupby(["class_name", "year"], as_index=False)["area_ha"].sum())
+                    plot_timeseries_table(pd.concat(year_areas))
+
+        if map_year is None:
+            draw_map = map_drawn_at is None or time.monotonic() - map_drawn_at >= app_config_data.stream_map_interval_seconds
+            map_polygons = PolygonResult.concat(results) if draw_map else None
+        else:
+            draw_map = chunk.get("year") == map_year
+            map_polygons = polygons
+        if draw_map and map_polygons.feature_count:
+            with map_area.container():
+                st.markdown(f"### Map: {years_name if map_year is None else map_year} ({chunk['done']}/{chunk['total']} {unit})")
+                plot_map(map_polygons, geometry, key=f"partial_map_{years_name}_{chunk['done']}")
+            map_drawn_at = time.monotonic()
+    partial_area.empty()
+    return chunk["polygons"]
+
+def add_class_areas(class_areas, stats):
+    # Classes keep the color of the chunk they first came in.
+    for row in stats:
+        total = class_areas.setdefault(row["class_name"], {**row, "area_ha": 0.0, "polygon_count": 0})
+        total["area_ha"] += row["area_ha"]
+        total["polygon_count"] += row["polygon_count"]
 
-def geojson_to_csv(geojson_data):
-    properties = [feature["properties"] for feature in geojson_data["features"]]
-    df = pd.DataFrame(properties)
-    csv_string = df.to_csv(index=False)
-    return csv_string
+@st.cache_data
+def mapbiomas_zonal_stats(image_url, feature_geojson, year):
+    params = {
+        "src_path": image_url,
+        "feature_geojson": feature_geojson.get("features")[0],
+        "classes_names": class_table,
+        "max_size": None,
+        "year": year
+    }
 
-def create_download_button(polygons_data, name, file_name):
-    file_name_sufix = file_name.split(".")[0]
-    col1, col2 = st.columns(2)
-    with col1:
-        st.download_button(
-            label="Download GeoJson",
-            data=json.dumps(polygons_data, indent=4, ensure_ascii=False),
-            file_name=f"mapbiomas_{name}_{file_name_sufix}.geojson",
-            mime="application/geojson"
-        )
-    with col2:
-        csv_data = geojson_to_csv(polygons_data)
+    zonal_stats = get_polygon_renderer().render_zonal_stats(params)
+    if "error" in zonal_stats:
+        st.write(
+            f"Polygon area ({zonal_stats.get('area_ha')}ha) must be smaller than {app_config_data.max_polygon_clip_area_ha}ha")
+        return {}
+
+    return zonal_stats
+
+@st.cache_data
+def mapbiomas_transitions(feature_geojson, year_from, year_to, polygonize_changes):
+    params = {
+        "src_path_from": app_config_data.get_url_mapbiomas(year_from),
+        "src_path_to": app_config_data.get_url_mapbiomas(year_to),
+        "feature_geojson": feature_geojson.get("features")[0],
+        "classes_names": class_table,
+        "max_size": None,
+        "year_from": year_from,
+        "year_to": year_to,
+        "polygonize_changes": polygonize_changes
+    }
+
+    transitions = get_polygon_renderer().render_transition_matrix(params)
+    if "error" in transitions:
+        st.write(
+            f"Polygon area ({transitions.get('area_ha')}ha) must be smaller than {app_config_data.max_polygon_clip_area_ha}ha")
+        return {}
 
-        st.download_button(
-            label="Download CSV",
-            data=csv_data,
-            file_name=f"mapbiomas_{name}_{file_name_sufix}.csv",
-            mime="text/csv"
-        )
+    return transitions
+
+@st.cache_data(max_entries=32)
+def export_polygons(_polygons_data, result_key, export_format):
+    from model.export_writers import export_features
+    return export_features(_polygons_data, export_format)
+
+def create_download_button(polygons_data, name, file_name, geometry, output_options=None):
+    from model.export_writers import EXPORT_FORMATS, available_formats
+    file_name_sufix = file_name.split(".")[0]
+    export_format = st.selectbox(
+        "Download format",
+        options=available_formats(),
+        index=None,
+        placeholder="Choose a format to prepare the download",
+        key=f"export_format_{name}_{file_name}"
+    )
+    if export_format is None:
+        return
+
+    # Exports are only built once a format is chosen and are cached per
+    # result, the input geometry and output options, reruns of the page do
+    # not serialize the polygons again.
+    result_hash = hashlib.sha256(
+        json.dumps([geometry, output_options], sort_keys=True).encode("utf-8")).hexdigest()
+    data = export_polygons(polygons_data, f"{name}_{result_hash}", export_format)
+    st.download_button(
+        label=f"Download {export_format}",
+        data=data,
+        file_name=f"mapbiomas_{name}_{file_name_sufix}.{EXPORT_FORMATS[export_format]['extension']}",
+        mime=EXPORT_FORMATS[export_format]["mime"]
+    )
 
 def style_function(feature):
     return {
@@ -71,6 +303,14 @@ def style_function(feature):
         "fillOpacity": 0.6
     }
 
+def input_style_function(feature):
+    return {
+        "color": "red",
+        "weight": 2,
+        "fill": False,
+        "fillOpacity": 0.0
+    }
+
 def highlight_function(feature):
     return  {
         "color": "red",
@@ -78,44 +318,66 @@ def highlight_function(feature):
         "fillOpacity": 0
     }
 
-def plot_map(polygons, input_polygon):
+@instrumentation.timed("map")
+def plot_map(polygons, input_polygon, key=None):
+    import folium
+    from streamlit_folium import st_folium
+    from model.display_geometry import prepare_display
 
     web_map = folium.Map(location=[0, 0], zoom_start=2, tiles=None)
 
     input_polygon_group = folium.FeatureGroup(name="Input Polygon")
     features_group = folium.FeatureGroup(name="Mabiomas")
 
-    features = folium.GeoJson(
+    display = prepare_display(
         polygons,
-        style_function=style_function,
-        highlight_function=highlight_function,
-        tooltip=folium.GeoJsonTooltip(
-            fields=app_config_data.map_feature_atributes,
-            aliases=app_config_data.map_feature_atributes_alias,
-            sticky=False,
-            labels=True,
-    ),
-        popup=folium.GeoJsonPopup(
-            fields=app_config_data.map_feature_atributes,
-            aliases=app_config_data.map_feature_atributes_alias),
-        popup_keep_highlighted=True,
+        map_width_px=app_config_data.map_width_px,
+        max_vertices=app_config_data.map_max_vertices,
+        image_max_size=app_config_data.map_image_max_size,
+        float_precision=app_config_data.float_precision,
+        zoom_levels=app_config_data.map_zoom_levels
     )
-
-    inverted_coordinates = [(lat, lon) for lon, lat in input_polygon["features"][0]["geometry"]["coordinates"][0]]
-
-    folium.Polygon(
-        locations=inverted_coordinates,
-        color="red",
-        weight=2,
-        fill=False,
-        fill_opacity=0.0
+    if display["mode"] == "image":
+        st.caption("Large result drawn as an image, download the data for the exact polygons")
+        layers = [folium.raster_layers.ImageOverlay(
+            image=display["image"],
+            bounds=display["bounds"],
+            opacity=0.6
+        )]
+    else:
+        # One layer per level of detail, the map shows the one for its zoom.
+        layers = [
+            folium.GeoJson(
+                level["polygons"],
+                style_function=style_function,
+                highlight_function=highlight_function,
+                tooltip=folium.GeoJsonTooltip(
+                    fields=app_config_data.map_feature_atributes,
+                    aliases=app_config_data.map_feature_atributes_alias,
+                    sticky=False,
+                    labels=True,
+            ),
+                popup=folium.GeoJsonPopup(
+                    fields=app_config_data.map_feature_atributes,
+                    aliases=app_config_data.map_feature_atributes_alias),
+                popup_keep_highlighted=True,
+            )
+            for level in display["levels"]
+        ]
+
+    folium.GeoJson(
+        input_polygon,
+        style_function=input_style_function
     ).add_to(input_polygon_group)
 
-    features.add_to(features_group)
+    for layer in layers:
+        layer.add_to(features_group)
     features_group.add_to(web_map)
     input_polygon_group.add_to(web_map)
+    if display["mode"] == "vector":
+        add_zoom_levels(web_map, features_group, layers, [level["tolerance"] for level in display["levels"]])
 
-    bounds = features.get_bounds()
+    bounds = display["bounds"] if display["mode"] == "image" else layers[0].get_bounds()
     web_map.fit_bounds(bounds, padding=(30, 30))
 
     web_map = add_base_map(web_map, app_config_data.google_basemap, "google satellite", "google", show=True)
@@ -127,10 +389,53 @@ def plot_map(polygons, input_polygon):
     st_folium(
         web_map,
         use_container_width=True,
-        returned_objects=[]
+        returned_objects=[],
+        key=key
     )
 
+ZOOM_LEVELS_SCRIPT = """
+{% macro script(this, kwargs) %}
+(function() {
+    var map = {{ this._parent.get_name() }};
+    var group = {{ this.group.get_name() }};
+    var layers = [{% for layer in this.layers %}{{ layer.get_name() }}, {% endfor %}];
+    var tolerances = {{ this.tolerances|tojson }};
+    function showLevel() {
+        // Half a screen pixel in degrees, the first level simplified within it.
+        var halfPixel = 180 * Math.cos(map.getCenter().lat * Math.PI / 180) / (256 * Math.pow(2, map.getZoom()));
+        var level = 0;
+        while (level < tolerances.length - 1 && tolerances[level] > halfPixel) {
+            level++;
+        }
+        layers.forEach(function(layer, index) {
+            if (index === level) {
+                group.addLayer(layer);
+            } else {
+                group.removeLayer(layer);
+            }
+        });
+    }
+    map.on("zoomend", showLevel);
+    showLevel();
+})();
+{% endmacro %}
+"""
+
+
+def add_zoom_levels(web_map, group, layers, tolerances):
+    # Shows the level of detail simplified for the zoom of the map, coarser
+    # levels are drawn when zoomed out and finer ones when zoomed in.
+    from branca.element import MacroElement, Template
+    zoom_levels = MacroElement()
+    zoom_levels._template = Template(ZOOM_LEVELS_SCRIPT)
+    zoom_levels.group = group
+    zoom_levels.layers = layers
+    zoom_levels.tolerances = tolerances
+    zoom_levels.add_to(web_map)
+
+
 def add_base_map(web_map, tile_url, name, attribution, max_zoom=30, max_native_zoom=18, show=False):
+    import folium
     folium.raster_layers.TileLayer(
         name=name,
         tiles=tile_url,
@@ -142,17 +447,37 @@ def add_base_map(web_map, tile_url, name, attribution, max_zoom=30, max_native_z
     ).add_to(web_map)
     return web_map
 
+@instrumentation.timed("summary_table")
+def plot_area_table(stats):
+    import pandas as pd
+    area_per_class = pd.DataFrame(stats)
+    area_per_class.rename(columns={"hex_color":"Legend", "class_name":"Class Name", "area_ha":"Area (ha)", "polygon_count": "Polygon count"}, inplace=True)
+    area_per_class = area_per_class.style.applymap(lambda color: f'background-color: {color}', subset=["Legend"])
+    st.dataframe(area_per_class, column_order=["Legend", "Class Name", "Area (ha)", "Polygon count"], hide_index=True)
+
+@instrumentation.timed("summary_table")
+def plot_timeseries_table(properties):
+    import pandas as pd
+    properties = pd.DataFrame(properties)
+    area_per_year = properties.pivot_table(
+        index="class_name", columns="year", values="area_ha", aggfunc="sum", fill_value=0).reset_index()
+    area_per_year.rename(columns={"class_name": "Class Name"}, inplace=True)
+    area_per_year.columns = [str(column) for column in area_per_year.columns]
+    st.markdown("### Area (ha) per year")
+    st.dataframe(area_per_year, hide_index=True)
+
 def parse_input_file(string_data):
     try:
         input_json = json.loads(string_data)
         if not "type" in input_json:
             return None
         if input_json.get("type") == "FeatureCollection":
-            if len(input_json.get("features",[])) == 0:
+            features = [feature for feature in input_json.get("features", []) if feature.get("geometry")]
+            if len(features) == 0:
                 return None
             return {
                 "type": "FeatureCollection",
-                "features": [input_json.get("features")[0]]
+                "features": features
             }
         if input_json.get("type") == "Feature":
             return {
@@ -162,18 +487,43 @@ def parse_input_file(string_data):
     except Exception as e:
         return None
 
+def get_output_options():
+    with st.expander("Output options"):
+        min_area_ha = st.number_input("Minimum mapping unit (ha)", min_value=0.0, value=0.0, step=0.1)
+        dissolve = st.checkbox("Dissolve into one feature per class")
+        smooth = st.checkbox("Smooth pixel edges")
+    return {"min_area_ha": min_area_ha, "dissolve": dissolve, "smooth": smooth}
+
 def main():
     st.title("Mapbiomas Vector Extractor")
 
     st.write("Upload your polygon as .geojson to get mapbiomas data as vector")
     st.write(f"Maximum area allowed: {app_config_data.max_polygon_clip_area_ha}ha")
+    if app_config_data.max_tiled_polygon_clip_area_ha > app_config_data.max_polygon_clip_area_ha:
+        st.write(f"Single year polygons up to {app_config_data.max_tiled_polygon_clip_area_ha}ha are processed in tiles")
+    if app_config_data.histogram_pyramid_dir:
+        st.write("Area summaries of years with a precomputed pyramid have no area limit")
 
     uploaded_file = st.file_uploader("Choose a geojson file", type="geojson")
 
     years = [year for year in range(app_config_data.mapbiomas_start_year, app_config_data.mapbiomas_end_year+1)]
-    years = sorted(years, reverse=True)
-    year_selected = st.selectbox("Select year", options=years)
-    url_year = f"{app_config_data.url_mapbiomas}/brasil_coverage_{year_selected}.tif"
+    output_mode = st.radio("Output", options=["Polygons", "Area summary", "Transition matrix"], horizontal=True)
+    year_mode = None
+    if output_mode == "Transition matrix":
+        year_from, year_selected = st.select_slider(
+            "Select years to compare", options=years, value=(years[0], years[-1]))
+        years_selected = [year_from, year_selected]
+    else:
+        year_mode = st.radio("Years", options=["Single year", "Range of years"], horizontal=True)
+    if year_mode == "Range of years":
+        start_year, year_selected = st.select_slider(
+            "Select range of years", options=years, value=(years[-2], years[-1]))
+        years_selected = [year for year in years if start_year <= year <= year_selected]
+    elif year_mode == "Single year":
+        year_selected = st.selectbox("Select year", options=sorted(years, reverse=True))
+        years_selected = [year_selected]
+    url_year = app_config_data.get_url_mapbiomas(year_selected)
+    output_options = get_output_options() if output_mode == "Polygons" else None
 
     if uploaded_file is not None:
         stringio = StringIO(uploaded_file.getvalue().decode("utf-8"))
@@ -183,29 +533,19 @@ def main():
             st.write("Could not read GeoJson!")
             return False
 
-        polygons = mapbiomas_clip(
-            url_year,
-            geometry,
-            year_selected
-        )
-
-        if polygons:
-            st.markdown("------------------------------")
-            st.markdown(f"## Year: {year_selected}")
-            create_download_button(polygons, year_selected, uploaded_file.name)
-            col1, col2 = st.columns(2)
-            with col1:
-                plot_map(polygons, geometry)
-            with col2:
-
-                gdf = gpd.GeoDataFrame.from_features(polygons)
-                gdf["count"] = 1
-                area_per_class = gdf[["count", "area_ha", "class_name"]].groupby("class_name").agg(sum).reset_index().sort_values(by="area_ha", ascending=False)
-                # Merge with hex_code from raw gdf
-                area_per_class = area_per_class.merge(gdf[["class_name", "hex_color"]].drop_duplicates(), on="class_name")
-                area_per_class.rename(columns={"hex_color":"Legend", "class_name":"Class Name", "area_ha":"Area (ha)", "count": "Polygon count"}, inplace=True)
-                area_per_class = area_per_class.style.applymap(lambda color: f'background-color: {color}', subset=["Legend"])
-                st.dataframe(area_per_class, column_order=["Legend", "Class Name", "Area (ha)", "Polygon count"], hide_index=True)
+        if len(geometry["features"]) > 1:
+            if output_mode == "Polygons":
+                show_batch(geometry, years_selected, uploaded_file.name, output_options)
+                return True
+            st.write(f"{output_mode} uses only the first of {len(geometry['features'])} features")
+            geometry = {"type": "FeatureCollection", "features": geometry["features"][:1]}
+
+        if output_mode == "Transition matrix":
+            show_transitions(geometry, years_selected, uploaded_file.name)
+        elif output_mode == "Area summary":
+            show_zonal_stats(geometry, years_selected)
+        else:
+            show_polygons(geometry, years_selected, uploaded_file.name, output_options)
 
     with st.expander("Links to raw data"):
         st.write(f"[Download complete raster data]({url_year})")
@@ -213,5 +553,156 @@ def main():
 
     return True
 
+def show_zonal_stats(geometry, years_selected):
+    stats = []
+    for year in years_selected:
+        stats.extend(mapbiomas_zonal_stats(app_config_data.get_url_mapbiomas(year), geometry, year).get("stats", []))
+    if not stats:
+        return
+
+    st.markdown("------------------------------")
+    if len(years_selected) > 1:
+        st.markdown(f"## Year: {years_selected[0]}-{years_selected[-1]}")
+        plot_timeseries_table(stats)
+    else:
+        st.markdown(f"## Year: {years_selected[0]}")
+        plot_area_table(stats)
+    st.write("Select the polygons output to map and download the vectors")
+
+def show_transitions(geometry, years_selected, file_name):
+    import pandas as pd
+    year_from, year_to = years_selected
+    map_changes = st.checkbox("Map changed areas")
+    transitions = mapbiomas_transitions(geometry, year_from, year_to, map_changes)
+    if not transitions:
+        return
+
+    st.markdown("------------------------------")
+    st.markdown(f"## Transitions: {year_from} -> {year_to}")
+    transitions_data = pd.DataFrame(transitions["transitions"])
+    file_name_sufix = file_name.split(".")[0]
+    st.download_button(
+        label="Download CSV",
+        data=transitions_data.to_csv(index=False),
+        file_name=f"mapbiomas_transitions_{year_from}_{year_to}_{file_name_sufix}.csv",
+        mime="text/csv"
+    )
+    transition_matrix = transitions_data.pivot_table(
+        index="from_class_name", columns="to_class_name", values="area_ha", aggfunc="sum", fill_value=0)
+    st.markdown(f"### Area (ha) from {year_from} (rows) to {year_to} (columns)")
+    st.dataframe(transition_matrix)
+
+    changes = transitions.get("changes")
+    if changes and changes["features"]:
+        plot_map(changes, geometry)
+
+def show_batch(geometry, years_selected, file_name, output_options=None):
+    from model.polygon_result import PolygonResult
+    results = []
+    for year in years_selected:
+        polygons = mapbiomas_clip_batch(app_config_data.get_url_mapbiomas(year), geometry, year, output_options)
+        if not polygons:
+            return
+        results.append(polygons)
+    polygons = PolygonResult.concat(results)
+    years_name = f"{years_selected[0]}-{years_selected[-1]}" if len(years_selected) > 1 else years_selected[0]
+
+    st.markdown("------------------------------")
+    st.markdown(f"## Year: {years_name} ({len(geometry['features'])} features)")
+    create_download_button(polygons, years_name, file_name, geometry, output_options)
+
+    properties = polygons.to_dataframe()
+    if properties.empty:
+        return
+    area_per_feature = properties.pivot_table(
+        index=["feature_id", "year"], columns="class_name", values="area_ha", aggfunc="sum", fill_value=0)
+    area_per_feature.insert(0, "Total", area_per_feature.sum(axis=1))
+    st.markdown("### Area (ha) per feature")
+    st.dataframe(area_per_feature.reset_index(), hide_index=True)
+
+    year_selected = years_selected[-1]
+    st.markdown(f"### Map: {year_selected}")
+    plot_map(polygons.take(polygons.year == year_selected), geometry)
+
+def show_preview(image_url, geometry, year, max_size, full_resolution_key, output_options=None):
+    polygons = mapbiomas_clip(image_url, geometry, year, max_size, output_options)
+    if not polygons:
+        return
+
+    st.markdown("------------------------------")
+    st.markdown(f"## Year: {year} (preview)")
+    st.write(f"Preview read at a reduced resolution ({max_size}px), areas are approximate.")
+    if st.button("Compute full resolution and download"):
+        st.session_state[full_resolution_key] = True
+        st.rerun()
+    col1, col2 = st.columns(2)
+    with col1:
+        plot_map(polygons, geometry)
+    with col2:
+        plot_area_table(summarize_polygons(polygons))
+
+def summarize_polygons(polygons):
+    from model.polygon_result import as_polygon_result
+    return as_polygon_result(polygons).summary()
+
+def show_polygons(geometry, years_selected, file_name, output_options=None):
+    year_selected = years_selected[-1]
+    if len(years_selected) > 1:
+        polygons = mapbiomas_clip_timeseries(geometry, years_selected, output_options)
+        years_name = f"{years_selected[0]}-{years_selected[-1]}"
+    else:
+        image_url = app_config_data.get_url_mapbiomas(year_selected)
+        preview_max_size = mapbiomas_preview_max_size(image_url, geometry)
+        full_resolution_key = f"full_resolution_{year_selected}_{file_name}"
+        if preview_max_size and not st.session_state.get(full_resolution_key):
+            show_preview(image_url, geometry, year_selected, preview_max_size, full_resolution_key, output_options)
+            return
+        polygons = mapbiomas_clip_streamed(image_url, geometry, year_selected, output_options)
+        years_name = year_selected
+
+    if not polygons:
+        return
+
+    st.markdown("------------------------------")
+    st.markdown(f"## Year: {years_name}")
+    create_download_button(polygons, years_name, file_name, geometry, output_options)
+    if len(years_selected) > 1:
+        plot_timeseries_table(polygons.to_dataframe())
+        st.markdown(f"### Map: {year_selected}")
+        polygons = polygons.take(polygons.year == year_selected)
+    col1, col2 = st.columns(2)
+    with col1:
+        plot_map(polygons, geometry)
+    with col2:
+        plot_area_table(summarize_polygons(polygons))
+
+def show_debug_panel():
+    import pandas as pd
+    with st.expander("Debug: instrumentation"):
+        traces = list(instrumentation.recent_traces)[::-1]
+        if traces:
+            st.markdown("### Recent traces")
+            st.dataframe(pd.DataFrame([
+                {
+                    "trace": trace["trace"],
+                    "year": trace.get("year"),
+                    "seconds": trace["seconds"],
+                    **trace["counters"],
+                    **{f"{name} (s)": stage["seconds"] for name, stage in trace["stages"].items()}
+                }
+                for trace in traces
+            ]), hide_index=True)
+
+        snapshot = instrumentation.metrics.snapshot()
+        st.markdown("### Stages since start")
+        st.dataframe(pd.DataFrame([
+            {"stage": name, **stage} for name, stage in snapshot["stages"].items()
+        ]).sort_values(by="seconds", ascending=False) if snapshot["stages"] else pd.DataFrame(), hide_index=True)
+        st.markdown("### Prometheus metrics")
+        st.code(instrumentation.metrics.render_prometheus(), language="text")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with instrumentation.trace("page"):
+        main()
+    if app_config_data.instrumentation:
+        show_debug_panel()
\ No newline at end of file
@@ -0,0 +1,338 @@
+import os
+import sys
+import math
+import time
+import atexit
+import socket
+import sqlite3
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from contextlib import closing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BLOCK_SIZE = 1 << 18
+CLI_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cli.py")
+REMOTE_SCHEMES = ("http://", "https://")
+
+
+def is_remote(src_path):
+    return str(src_path).startswith(REMOTE_SCHEMES)
+
+
+def get_cached_url(server_url, src_path):
+    # http://host:port/https/storage.googleapis.com/... keeps the file name
+    # last, GDAL only opens urls with an allowed extension.
+    scheme, rest = src_path.split("://", 1)
+    return f"{server_url}/{scheme}/{rest}"
+
+
+def get_source_url(path):
+    scheme, rest = path.lstrip("/").split("/", 1)
+    if scheme not in ("http", "https"):
+        raise ValueError(f"unsupported scheme {scheme}")
+    return f"{scheme}://{rest}"
+
+
+class BlockCache:
+    def __init__(self, path, max_size_bytes=2_000_000_000, block_size=BLOCK_SIZE, timeout=60):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.block_size = block_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.fetched_bytes = 0
+        self.__lock = threading.Lock()
+        self.__create_tables()
+
+    def __connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def __create_tables(self):
+        with self.__connect() as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS blocks ("
+                "url TEXT NOT NULL, block INTEGER NOT NULL, data BLOB NOT NULL, "
+                "size INTEGER NOT NULL, last_access REAL NOT NULL, PRIMARY KEY (url, block))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS blocks_last_access ON blocks(last_access)")
+            connection.execute("CREATE TABLE IF NOT EXISTS files (url TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+
+    def __request(self, url, method="GET", byte_range=None):
+        request = urllib.request.Request(url, method=method)
+        if byte_range:
+            request.add_header("Range", f"bytes={byte_range[0]}-{byte_range[1]}")
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def file_size(self, url):
+        with self.__connect() as connection:
+            row = connection.execute("SELECT size FROM files WHERE url = ?", (url,)).fetchone()
+        if row:
+            return row[0]
+
+        with self.__request(url, method="HEAD") as response:
+            size = int(response.headers["Content-Length"])
+        with self.__connect() as connection, connection:
+            connection.execute("INSERT OR REPLACE INTO files (url, size) VALUES (?, ?)", (url, size))
+        return size
+
+    def __fetch(self, url, start, end):
+        with self.__request(url, byte_range=(start, end)) as response:
+            data = response.read()
+            if response.status == 200:
+                # Servers ignoring the range send the whole file.
+                data = data[start:end + 1]
+        with self.__lock:
+            self.fetched_bytes += len(data)
+        return data
+
+    def __get_blocks(self, url, first, last):
+        with self.__connect() as connection, connection:
+            rows = connection.execute(
+                "SELECT block, data FROM blocks WHERE url = ? AND block BETWEEN ? AND ?",
+                (url, first, last)).fetchall()
+            if rows:
+                connection.execute(
+                    "UPDATE blocks SET last_access = ? WHERE url = ? AND block BETWEEN ? AND ?",
+                    (time.time(), url, first, last))
+        return dict(rows)
+
+    def __set_blocks(self, url, blocks):
+        now = time.time()
+        with self.__connect() as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO blocks (url, block, data, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                [(url, block, sqlite3.Binary(data), len(data), now) for block, data in blocks.items()]
+            )
+            self.__evict(connection)
+
+    def __evict(self, connection):
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM blocks").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+
+        oldest = connection.execute("SELECT url, block, size FROM blocks ORDER BY last_access")
+        evicted = []
+        for url, block, size in oldest:
+            if total_size <= self.max_size_bytes:
+                break
+            evicted.append((url, block))
+            total_size -= size
+        connection.executemany("DELETE FROM blocks WHERE url = ? AND block = ?", evicted)
+
+    @staticmethod
+    def __runs(blocks):
+        runs = []
+        for block in blocks:
+            if runs and block == runs[-1][1] + 1:
+                runs[-1][1] = block
+            else:
+                runs.append([block, block])
+        return runs
+
+    def read(self, url, start, end):
+        size = self.file_size(url)
+        end = min(end, size - 1)
+        if end < start:
+            return b""
+
+        first, last = start // self.block_size, end // self.block_size
+        blocks = self.__get_blocks(url, first, last)
+        missing = [block for block in range(first, last + 1) if block not in blocks]
+        with self.__lock:
+            self.hits += len(blocks)
+            self.misses += len(missing)
+
+        # Consecutive missing blocks are fetched with a single range request.
+        for run_first, run_last in self.__runs(missing):
+            run_start = run_first * self.block_size
+            data = self.__fetch(url, run_start, min((run_last + 1) * self.block_size, size) - 1)
+            fetched = {
+                block: data[(block - run_first) * self.block_size:(block - run_first + 1) * self.block_size]
+                for block in range(run_first, run_last + 1)
+            }
+            self.__set_blocks(url, fetched)
+            blocks.update(fetched)
+
+        data = b"".join(blocks[block] for block in range(first, last + 1))
+        offset = start - first * self.block_size
+        return data[offset:offset + end - start + 1]
+
+    def stats(self):
+        with self.__connect() as connection:
+            entries, size = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blocks").fetchone()
+            files = connection.execute("SELECT COUNT(DISTINCT url) FROM blocks").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "fetched_bytes": self.fetched_bytes,
+            "entries": entries,
+            "files": files,
+            "size_bytes": size,
+        }
+
+
+class BlockCacheRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cache = None
+
+    def log_message(self, *args):
+        pass
+
+    def __get_range(self, size):
+        header = self.headers.get("Range")
+        if not header:
+            return None
+        start, end = header.removeprefix("bytes=").split(",")[0].split("-")
+        if not start:
+            return max(0, size - int(end)), size - 1
+        return int(start), min(int(end), size - 1) if end else size - 1
+
+    def __source(self):
+        try:
+            url = get_source_url(self.path)
+            return url, self.cache.file_size(url)
+        except ValueError:
+            self.send_error(400)
+        except urllib.error.HTTPError as error:
+            self.send_error(error.code)
+        except OSError:
+            self.send_error(502)
+        return None, None
+
+    def do_HEAD(self):
+        url, size = self.__source()
+        if url is None:
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        url, size = self.__source()
+        if url is None:
+            return
+        byte_range = self.__get_range(size)
+        start, end = byte_range or (0, size - 1)
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        try:
+            data = self.cache.read(url, start, end)
+        except OSError:
+            self.send_error(502)
+            return
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Accept-Ranges", "bytes")
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve_block_cache(path, max_size_bytes, port, host="127.0.0.1"):
+    cache = BlockCache(path, max_size_bytes=max_size_bytes)
+    handler = type("Handler", (BlockCacheRequestHandler,), {"cache": cache})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def is_serving(host, port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
+        client.settimeout(1)
+        return client.connect_ex((host, port)) == 0
+
+
+def start_block_cache_server(path, max_size_bytes, port, host="127.0.0.1", timeout=30):
+    # GDAL holds the GIL while opening a dataset, a server thread in the
+    # reading process would never answer it, so the server gets its own
+    # process. Any process finding the port taken reuses that server.
+    if not is_serving(host, port):
+        process = subprocess.Popen([
+            sys.executable, CLI_PATH, "serve-cache", "--cache-path", path,
+            "--max-size-mb", str(max_size_bytes / 1_000_000), "--port", str(port), "--host", host
+        ])
+        atexit.register(process.terminate)
+        deadline = time.monotonic() + timeout
+        while not is_serving(host, port):
+            if process.poll() is not None:
+                # A process starting at the same time took the port first,
+                # its server is the one to reuse.
+                if is_serving(host, port):
+                    break
+                raise RuntimeError(f"block cache server did not start on {host}:{port}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"block cache server did not start on {host}:{port}")
+            time.sleep(0.1)
+    return f"http://{host}:{port}"
+
+
+def get_block_ranges(dataset, geometry):
+    # Byte ranges of the tiles intersecting the geometry, at full resolution
+    # and on every overview. Asking GDAL for the tile offsets also reads the
+    # tile index, through the server when the dataset was opened from it.
+    import numpy as np
+    import shapely
+    from rasterio import windows
+    window = windows.from_bounds(*geometry.bounds, transform=dataset.transform)
+    block_height, block_width = dataset.block_shapes[0]
+    ranges = []
+    for overview, factor in [(None, 1)] + list(enumerate(dataset.overviews(1))):
+        width, height = math.ceil(dataset.width / factor), math.ceil(dataset.height / factor)
+        cols = range(
+            max(0, math.floor(window.col_off / factor / block_width)),
+            min(math.ceil(width / block_width), math.ceil((window.col_off + window.width) / factor / block_width)))
+        rows = range(
+            max(0, math.floor(window.row_off / factor / block_height)),
+            min(math.ceil(height / block_height), math.ceil((window.row_off + window.height) / factor / block_height)))
+        blocks = [(col, row) for row in rows for col in cols]
+        if not blocks:
+            continue
+
+        transform = dataset.transform
+        block_cols = np.array([col for col, _ in blocks])
+        block_rows = np.array([row for _, row in blocks])
+        x_size, y_size = block_width * factor * transform.a, block_height * factor * transform.e
+        boxes = shapely.box(
+            transform.c + block_cols * x_size, transform.f + (block_rows + 1) * y_size,
+            transform.c + (block_cols + 1) * x_size, transform.f + block_rows * y_size)
+        for (col, row), intersects in zip(blocks, shapely.intersects(geometry, boxes)):
+            if not intersects:
+                continue
+            offset = dataset.get_tag_item(f"BLOCK_OFFSET_{col}_{row}", "TIFF", bidx=1, ovr=overview)
+            size = dataset.get_tag_item(f"BLOCK_SIZE_{col}_{row}", "TIFF", bidx=1, ovr=overview)
+            if offset and size and int(size):
+                ranges.append((int(offset), int(offset) + int(size) - 1))
+    return ranges
+
+
+def merge_ranges(ranges, gap, max_length):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] <= gap and end - merged[-1][0] < max_length:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def prefetch(cache, server_url, src_path, geometry):
+    import rasterio
+    with rasterio.open(get_cached_url(server_url, src_path)) as dataset:
+        ranges = get_block_ranges(dataset, geometry)
+
+    fetched_bytes = cache.fetched_bytes
+    for start, end in merge_ranges(ranges, cache.block_size, 64 * cache.block_size):
+        cache.read(src_path, start, end)
+    return {"tiles": len(ranges), "fetched_bytes": cache.fetched_bytes - fetched_bytes}
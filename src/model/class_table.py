@@ -0,0 +1,104 @@
+import csv
+import json
+import functools
+from collections.abc import Mapping
+import numpy as np
+from mapbiomas_classes import mapbiomas_classes
+
+PIXEL_VALUES = 256
+
+
+def hex_to_rgb(hex_color):
+    hex_color = hex_color.lstrip("#")
+    return [int(hex_color[index:index + 2], 16) for index in (0, 2, 4)]
+
+
+class ClassTable(Mapping):
+    # The class attributes of the 0-255 pixel values as lookup arrays, so
+    # polygon attributes, stats and previews come from indexing them with
+    # the pixel values. Still a mapping of pixel value to attributes.
+    def __init__(self, classes_names, name="mapbiomas"):
+        self.name = name
+        self.classes_names = {int(pixel_value): dict(attributes) for pixel_value, attributes in classes_names.items()}
+        self.fields = list(dict.fromkeys(
+            field for attributes in self.classes_names.values() for field in attributes))
+        self.defined = np.zeros(PIXEL_VALUES, dtype=bool)
+        self.defined[list(self.classes_names)] = True
+
+        # Per field the distinct values and the index of each pixel value in
+        # them, e.g. the class name index used to group classes by name.
+        self.categories = {}
+        self.codes = {}
+        for field in self.fields:
+            categories = list(dict.fromkeys(attributes.get(field) for attributes in self.classes_names.values()))
+            category_index = {category: index for index, category in enumerate(categories)}
+            codes = np.zeros(PIXEL_VALUES, dtype="uint16")
+            for pixel_value, attributes in self.classes_names.items():
+                codes[pixel_value] = category_index[attributes.get(field)]
+            self.categories[field] = np.array(categories, dtype=object)
+            self.codes[field] = codes
+
+        self.rgba = np.zeros((PIXEL_VALUES, 4), dtype="uint8")
+        for pixel_value, attributes in self.classes_names.items():
+            if attributes.get("hex_color"):
+                self.rgba[pixel_value] = hex_to_rgb(attributes["hex_color"]) + [255]
+
+    @classmethod
+    def from_file(cls, path):
+        # A json object keyed by pixel value, as mapbiomas_classes, a json
+        # list or a csv file of rows with a pixel_value and the attributes.
+        with open(path, encoding="utf-8") as legend_file:
+            if path.endswith(".csv"):
+                rows = list(csv.DictReader(legend_file))
+            else:
+                rows = json.load(legend_file)
+        if isinstance(rows, list):
+            rows = {row.pop("pixel_value"): row for row in rows}
+        return cls(rows, name=path)
+
+    def __getitem__(self, pixel_value):
+        return self.classes_names[int(pixel_value)]
+
+    def __iter__(self):
+        return iter(self.classes_names)
+
+    def __len__(self):
+        return len(self.classes_names)
+
+    def __repr__(self):
+        return f"ClassTable({self.name!r})"
+
+    def validate(self, pixel_values):
+        undefined = ~self.defined[pixel_values]
+        if undefined.any():
+            raise KeyError(int(np.asarray(pixel_values)[undefined][0]))
+
+    def lookup(self, field, pixel_values):
+        return self.categories[field][self.codes[field][pixel_values]]
+
+    def columns(self, pixel_values):
+        return {field: self.lookup(field, pixel_values) for field in self.fields}
+
+    def colorize(self, image, mask=None):
+        rgba = self.rgba[image]
+        if mask is not None:
+            rgba[~mask] = 0
+        return rgba
+
+
+def as_class_table(classes_names):
+    if isinstance(classes_names, ClassTable):
+        return classes_names
+    return ClassTable(classes_names, name="custom")
+
+
+mapbiomas_class_table = ClassTable(mapbiomas_classes)
+
+
+@functools.lru_cache(maxsize=None)
+def load_class_table(path=""):
+    # Other legends, e.g. another collection or country, are read from a
+    # file, without one the Brazil legend in mapbiomas_classes is used.
+    if not path:
+        return mapbiomas_class_table
+    return ClassTable.from_file(path)
@@ -0,0 +1,159 @@
+import json
+import math
+import base64
+import numpy as np
+import shapely
+from rasterio.io import MemoryFile
+from rasterio.features import rasterize
+from rasterio.transform import from_bounds
+from shapely.geometry import shape
+from model.class_table import ClassTable
+from model.polygon_result import PolygonResult
+from model.shared_edges import get_shared_edges, simplify_shared_edges
+
+VERTICES_MARGIN = 1.25
+
+
+def get_display_tolerance(bounds, map_width_px):
+    minx, miny, maxx, maxy = bounds
+    degrees_per_px = max(maxx - minx, maxy - miny) / map_width_px
+    return degrees_per_px / 2
+
+
+def get_decimals(tolerance, float_precision):
+    if tolerance <= 0:
+        return float_precision
+    return min(float_precision, max(0, math.ceil(-math.log10(tolerance)) + 1))
+
+
+def to_geojson(geometries):
+    # One parse of the geometries written by GEOS, mapping or the
+    # __geo_interface__ of each geometry is many times slower.
+    return json.loads(f"[{','.join(shapely.to_geojson(geometries).tolist())}]")
+
+
+def get_zoom_tolerances(tolerance, zoom_levels):
+    # Each level is four times finer than the last, two zoom steps apart.
+    return [tolerance / 4 ** level for level in range(zoom_levels)]
+
+
+def render_image(pixel_values, class_table, geometries, bounds, image_max_size):
+    from pyproj import Transformer
+    geographic_to_web_mercator = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+    minx, miny, maxx, maxy = bounds
+    (west, east), (south, north) = geographic_to_web_mercator.transform([minx, maxx], [miny, maxy])
+    scale = image_max_size / max(east - west, north - south)
+    width = max(1, round((east - west) * scale))
+    height = max(1, round((north - south) * scale))
+
+    geometries_mercator = shapely.transform(
+        geometries, lambda coords: np.column_stack(geographic_to_web_mercator.transform(coords[:, 0], coords[:, 1])))
+
+    # Pixel values are burnt shifted by one, 0 is left for the background.
+    transform = from_bounds(west, south, east, north, width, height)
+    image = rasterize(
+        zip(to_geojson(geometries_mercator), (pixel_values.astype("uint16") + 1).tolist()),
+        out_shape=(height, width),
+        transform=transform,
+        fill=0,
+        dtype="uint16"
+    )
+
+    rgba = class_table.colorize((image - 1).astype("uint8"), mask=image > 0).transpose(2, 0, 1)
+
+    with MemoryFile() as memory_file:
+        with memory_file.open(
+                driver="PNG", width=width, height=height, count=4, dtype="uint8",
+                crs="EPSG:3857", transform=transform) as png:
+            png.write(rgba)
+        png_bytes = memory_file.read()
+    return f"data:image/png;base64,{base64.b64encode(png_bytes).decode('ascii')}"
+
+
+def get_properties(polygons, index):
+    if isinstance(polygons, PolygonResult):
+        return polygons.take(index).properties()
+    features = polygons["features"]
+    return [features[position]["properties"] for position in index.tolist()]
+
+
+def fits_vertices(geometries, tolerance, max_vertices):
+    # Shared edges are only built for results the map can draw as vectors.
+    # Each polygon simplified alone gives about the vertex count of the
+    # first level at a fraction of the cost, noding the edges adds the
+    # corners of the neighbours along straight sides, about a tenth more.
+    vertices = int(shapely.get_num_coordinates(geometries).sum())
+    if vertices > max_vertices / VERTICES_MARGIN:
+        vertices = int(shapely.get_num_coordinates(shapely.simplify(geometries, tolerance)).sum())
+    return vertices <= max_vertices / VERTICES_MARGIN
+
+
+def prepare_display(polygons, map_width_px=1200, max_vertices=250_000, image_max_size=1024, float_precision=6,
+                    zoom_levels=4):
+    # Columnar results give their geometries as they are, GeoJSON features
+    # are parsed first and their colors put in a class table.
+    if isinstance(polygons, PolygonResult):
+        geometries, pixel_values, class_table = polygons.geometries, polygons.pixel_value, polygons.class_table
+    else:
+        features = polygons.get("features", [])
+        geometries = np.array([shape(feature["geometry"]) for feature in features], dtype=object)
+        pixel_values = np.array([feature["properties"]["pixel_value"] for feature in features], dtype="uint8")
+        class_table = ClassTable({
+            feature["properties"]["pixel_value"]: {"hex_color": feature["properties"]["hex_color"]}
+            for feature in features
+        }, name="display")
+    if not len(geometries):
+        empty = {"type": "FeatureCollection", "features": []}
+        return {"mode": "vector", "polygons": empty, "levels": [{"tolerance": 0, "polygons": empty}]}
+
+    bounds = shapely.total_bounds(geometries)
+    tolerance = get_display_tolerance(bounds, map_width_px)
+    if not fits_vertices(geometries, tolerance, max_vertices):
+        return get_image_display(pixel_values, class_table, geometries, bounds, image_max_size)
+
+    edges = get_shared_edges(geometries)
+    edge_vertices = int(shapely.get_num_coordinates(edges).sum())
+
+    # Levels from the zoom the map opens on to finer ones while they fit in
+    # max_vertices together, the map switches between them on zoom.
+    levels = []
+    vertices = 0
+    for level_tolerance in get_zoom_tolerances(tolerance, zoom_levels):
+        # A tolerance that keeps every edge vertex gives the exact polygons,
+        # finer levels would be the same.
+        exact = int(shapely.get_num_coordinates(shapely.simplify(edges, level_tolerance)).sum()) == edge_vertices
+        # Rounding drops the digits that cannot be seen at the zoom of the
+        # level and shortens the geojson sent to the browser.
+        simplified = simplify_shared_edges(
+            geometries, edges, level_tolerance, get_decimals(level_tolerance, float_precision))
+        level_vertices = int(shapely.get_num_coordinates(simplified).sum())
+        if vertices + level_vertices > max_vertices:
+            break
+        vertices += level_vertices
+        keep = np.nonzero(~shapely.is_empty(simplified))[0]
+        levels.append({
+            "tolerance": level_tolerance,
+            "polygons": {
+                "type": "FeatureCollection",
+                "features": [
+                    {"type": "Feature", "geometry": geometry, "properties": feature_properties}
+                    for feature_properties, geometry in zip(
+                        get_properties(polygons, keep), to_geojson(simplified[keep]))
+                ]
+            }
+        })
+        if exact:
+            break
+
+    if levels:
+        return {"mode": "vector", "polygons": levels[0]["polygons"], "levels": levels, "vertices": vertices}
+    return get_image_display(pixel_values, class_table, geometries, bounds, image_max_size)
+
+
+def get_image_display(pixel_values, class_table, geometries, bounds, image_max_size):
+    minx, miny, maxx, maxy = bounds
+    return {
+        "mode": "image",
+        "image": render_image(pixel_values, class_table, geometries, bounds, image_max_size),
+        "bounds": [[miny, minx], [maxy, maxx]]
+    }
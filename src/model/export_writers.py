@@ -0,0 +1,194 @@
+import io
+import os
+import csv
+import json
+import tempfile
+import importlib.util
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from model.instrumentation import instrumentation
+from model.polygon_result import PolygonResult
+
+BATCH_SIZE = 10_000
+GEOMETRY_TYPE_NAMES = {
+    0: "Point", 1: "LineString", 3: "Polygon", 4: "MultiPoint",
+    5: "MultiLineString", 6: "MultiPolygon", 7: "GeometryCollection"
+}
+
+
+def iter_batches(features, batch_size=BATCH_SIZE):
+    for start in range(0, len(features), batch_size):
+        yield features[start:start + batch_size]
+
+
+def get_field_names(features):
+    field_names = {}
+    for feature in features:
+        field_names.update(dict.fromkeys(feature["properties"]))
+    return list(field_names)
+
+
+def get_geometries(features):
+    return np.array([shape(feature["geometry"]) for feature in features], dtype=object)
+
+
+def get_result_columns(polygons):
+    columns = {"pixel_value": polygons.pixel_value, "area_ha": polygons.area_ha, "year": polygons.year}
+    columns.update(polygons.class_columns())
+    columns.update(polygons.columns)
+    return columns
+
+
+def write_geojson(features, stream):
+    stream.write(b'{"type":"FeatureCollection","features":[')
+    for index, feature in enumerate(features):
+        if index:
+            stream.write(b",")
+        stream.write(json.dumps(feature, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    stream.write(b"]}")
+
+
+def write_ndjson(features, stream):
+    for feature in features:
+        stream.write(json.dumps(feature, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        stream.write(b"\n")
+
+
+def write_csv(features, stream):
+    text_stream = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    writer = csv.DictWriter(text_stream, fieldnames=get_field_names(features))
+    writer.writeheader()
+    for feature in features:
+        writer.writerow(feature["properties"])
+    text_stream.detach()
+
+
+def write_result_csv(polygons, stream):
+    # Rows straight from the columns, the GeoJSON features are never built.
+    columns = get_result_columns(polygons)
+    text_stream = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    writer = csv.writer(text_stream)
+    writer.writerow(columns)
+    for start in range(0, polygons.feature_count, BATCH_SIZE):
+        writer.writerows(zip(*[values[start:start + BATCH_SIZE].tolist() for values in columns.values()]))
+    text_stream.detach()
+
+
+def get_geo_metadata(geometry_types):
+    return {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {
+            "geometry": {
+                "encoding": "WKB",
+                "geometry_types": sorted(GEOMETRY_TYPE_NAMES[type_id] for type_id in geometry_types)
+            }
+        }
+    }
+
+
+def write_geoparquet(features, stream):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    field_names = get_field_names(features)
+    fields = [pa.field("geometry", pa.binary())]
+    for field_name in field_names:
+        values = [feature["properties"].get(field_name) for feature in features]
+        fields.append(pa.field(field_name, pa.infer_type(values)))
+
+    geometry_types = set()
+    for batch in iter_batches(features):
+        geometry_types.update(shapely.get_type_id(get_geometries(batch)).tolist())
+    schema = pa.schema(fields, metadata={"geo": json.dumps(get_geo_metadata(geometry_types))})
+
+    with pq.ParquetWriter(stream, schema, compression="zstd") as writer:
+        for batch in iter_batches(features):
+            columns = {"geometry": shapely.to_wkb(get_geometries(batch))}
+            for field_name in field_names:
+                columns[field_name] = [feature["properties"].get(field_name) for feature in batch]
+            writer.write_table(pa.table(columns, schema=schema))
+
+
+def write_result_geoparquet(polygons, stream):
+    import pyarrow.parquet as pq
+    geometry_types = set(shapely.get_type_id(polygons.geometries).tolist())
+    table = polygons.to_arrow().replace_schema_metadata({"geo": json.dumps(get_geo_metadata(geometry_types))})
+    pq.write_table(table, stream, row_group_size=BATCH_SIZE, compression="zstd")
+
+
+def write_flatgeobuf(features, stream):
+    field_names = get_field_names(features)
+    field_data = [
+        np.array([feature["properties"].get(field_name) for feature in features])
+        for field_name in field_names
+    ]
+    write_flatgeobuf_fields(get_geometries(features), field_data, field_names, stream)
+
+
+def write_result_flatgeobuf(polygons, stream):
+    columns = get_result_columns(polygons)
+    field_data = [np.array(values.tolist()) for values in columns.values()]
+    write_flatgeobuf_fields(polygons.geometries, field_data, list(columns), stream)
+
+
+def write_flatgeobuf_fields(geometries, field_data, field_names, stream):
+    import pyogrio.raw
+    # GDAL builds the packed R-tree index at close time and needs a real
+    # file for it, the bytes are copied to the stream afterwards.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "export.fgb")
+        pyogrio.raw.write(
+            path,
+            shapely.to_wkb(geometries),
+            field_data,
+            field_names,
+            driver="FlatGeobuf",
+            geometry_type="Unknown",
+            crs="EPSG:4326",
+            layer_options={"SPATIAL_INDEX": "YES"}
+        )
+        with open(path, "rb") as export_file:
+            while chunk := export_file.read(1 << 20):
+                stream.write(chunk)
+
+
+EXPORT_FORMATS = {
+    "GeoJSON": {"extension": "geojson", "mime": "application/geojson", "writer": write_geojson},
+    "NDJSON": {"extension": "ndjson", "mime": "application/x-ndjson", "writer": write_ndjson},
+    "GeoParquet": {
+        "extension": "parquet", "mime": "application/vnd.apache.parquet",
+        "writer": write_geoparquet, "result_writer": write_result_geoparquet
+    },
+    "FlatGeobuf": {
+        "extension": "fgb", "mime": "application/flatgeobuf",
+        "writer": write_flatgeobuf, "result_writer": write_result_flatgeobuf
+    },
+    "CSV": {"extension": "csv", "mime": "text/csv", "writer": write_csv, "result_writer": write_result_csv},
+}
+
+
+def available_formats():
+    # Optional writers are only imported when used, pyogrio alone takes
+    # about half a second.
+    formats = list(EXPORT_FORMATS)
+    if importlib.util.find_spec("pyarrow") is None:
+        formats.remove("GeoParquet")
+    if importlib.util.find_spec("pyogrio") is None:
+        formats.remove("FlatGeobuf")
+    return formats
+
+
+@instrumentation.timed("export")
+def export_features(features, export_format):
+    # Columnar formats and CSV are written from the result columns, the
+    # others from its GeoJSON features.
+    export = EXPORT_FORMATS[export_format]
+    stream = io.BytesIO()
+    if isinstance(features, PolygonResult):
+        if "result_writer" in export:
+            export["result_writer"](features, stream)
+            return stream.getvalue()
+        features = features.features
+    export["writer"](features, stream)
+    return stream.getvalue()
@@ -0,0 +1,189 @@
+import os
+import math
+import functools
+import numpy as np
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from rasterio import windows
+from rasterio.transform import Affine
+from model.class_table import PIXEL_VALUES
+from model.instrumentation import instrumentation
+
+# Blocks read together when building, along a row of blocks.
+BUILD_CHUNK_BLOCKS = 16
+
+
+def get_pyramid_path(directory, src_path):
+    name = os.path.splitext(os.path.basename(src_path))[0]
+    return os.path.join(directory, f"{name}.npz")
+
+
+class HistogramPyramid:
+    # Area (m2) per pixel value of the square blocks of a coverage COG at
+    # full resolution, level 0, and of each coarser level of 2x2 blocks of
+    # the level below. A level is stored sparse, most blocks hold a few
+    # classes: the classes and areas of block i are at offsets[i]:offsets[i+1].
+    def __init__(self, transform, width, height, block_size, levels):
+        self.transform = Affine(*transform[:6])
+        self.width = int(width)
+        self.height = int(height)
+        self.block_size = int(block_size)
+        self.levels = levels
+
+    @classmethod
+    def build(cls, cog_reader, src_path, block_size=256, max_workers=None):
+        with cog_reader.open_reader(src_path) as cog:
+            transform, width, height = cog.dataset.transform, cog.dataset.width, cog.dataset.height
+
+        pyramid = cls(transform, width, height, block_size, [])
+        row_areas = cog_reader.get_row_areas(transform, height)
+        grid_rows, grid_columns = pyramid.get_grid_shape(0)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            rows = list(executor.map(
+                lambda block_row: pyramid.__get_row_histograms(cog_reader, src_path, block_row, row_areas),
+                range(grid_rows)))
+        blocks, classes, areas = (np.concatenate(values) for values in zip(*rows))
+
+        pyramid.levels.append(cls.__to_offsets(blocks, classes, areas, grid_rows * grid_columns))
+        level = 0
+        while grid_rows > 1 or grid_columns > 1:
+            blocks, classes, areas = cls.__coarsen(blocks, classes, areas, grid_columns, pyramid.get_grid_shape(level + 1)[1])
+            level += 1
+            grid_rows, grid_columns = pyramid.get_grid_shape(level)
+            pyramid.levels.append(cls.__to_offsets(blocks, classes, areas, grid_rows * grid_columns))
+        return pyramid
+
+    def __get_row_histograms(self, cog_reader, src_path, block_row, row_areas):
+        row_off = block_row * self.block_size
+        height = min(self.block_size, self.height - row_off)
+        chunk_width = self.block_size * BUILD_CHUNK_BLOCKS
+        grid_columns = self.get_grid_shape(0)[1]
+        keys = []
+        areas = []
+        with cog_reader.open_reader(src_path) as cog:
+            dataset = cog.dataset
+            for col_off in range(0, self.width, chunk_width):
+                window = windows.Window(col_off, row_off, min(chunk_width, self.width - col_off), height)
+                image = dataset.read(1, window=window)
+                if dataset.nodata is not None:
+                    valid = image != dataset.nodata
+                else:
+                    valid = dataset.read_masks(1, window=window) > 0
+                # Every cell of a row has the same area, the block histograms
+                # are a bincount of block column and pixel value weighted by it.
+                block_columns = (col_off + np.arange(window.width)) // self.block_size
+                chunk_keys = block_columns * PIXEL_VALUES + image
+                chunk_areas = np.broadcast_to(row_areas[row_off:row_off + height, np.newaxis], image.shape)
+                chunk_areas = np.bincount(
+                    chunk_keys[valid], weights=chunk_areas[valid], minlength=(block_columns[-1] + 1) * PIXEL_VALUES)
+                chunk_keys = np.flatnonzero(chunk_areas)
+                keys.append(chunk_keys)
+                areas.append(chunk_areas[chunk_keys])
+        keys = np.concatenate(keys)
+        return (
+            block_row * grid_columns + keys // PIXEL_VALUES,
+            (keys % PIXEL_VALUES).astype("uint8"),
+            np.concatenate(areas)
+        )
+
+    @staticmethod
+    def __coarsen(blocks, classes, areas, grid_columns, parent_columns):
+        parents = (blocks // grid_columns // 2) * parent_columns + (blocks % grid_columns) // 2
+        keys, inverse = np.unique(parents * PIXEL_VALUES + classes, return_inverse=True)
+        return keys // PIXEL_VALUES, (keys % PIXEL_VALUES).astype("uint8"), np.bincount(inverse, weights=areas)
+
+    @staticmethod
+    def __to_offsets(blocks, classes, areas, block_count):
+        # Blocks come sorted, row by row.
+        return np.searchsorted(blocks, np.arange(block_count + 1)), classes, areas
+
+    def get_grid_shape(self, level):
+        size = self.block_size * 2 ** level
+        return math.ceil(self.height / size), math.ceil(self.width / size)
+
+    def save(self, path):
+        arrays = {
+            "transform": np.array(self.transform[:6]),
+            "shape": np.array([self.width, self.height, self.block_size]),
+        }
+        for level, (offsets, classes, areas) in enumerate(self.levels):
+            arrays.update({f"offsets_{level}": offsets, f"classes_{level}": classes, f"areas_{level}": areas})
+        # Written aside and moved, the app never loads a partial file.
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as pyramid_file:
+            np.savez(pyramid_file, **arrays)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            width, height, block_size = arrays["shape"].tolist()
+            levels = []
+            while f"offsets_{len(levels)}" in arrays:
+                level = len(levels)
+                levels.append((arrays[f"offsets_{level}"], arrays[f"classes_{level}"], arrays[f"areas_{level}"]))
+            return cls(arrays["transform"], width, height, block_size, levels)
+
+    def get_block_boxes(self, level, rows, columns):
+        size = self.block_size * 2 ** level
+        col_start, row_start = columns * size, rows * size
+        col_stop, row_stop = np.minimum(col_start + size, self.width), np.minimum(row_start + size, self.height)
+        left, top = self.transform * (col_start, row_start)
+        right, bottom = self.transform * (col_stop, row_stop)
+        return shapely.box(left, bottom, right, top)
+
+    def get_block_areas(self, level, rows, columns):
+        offsets, classes, areas = self.levels[level]
+        blocks = rows * self.get_grid_shape(level)[1] + columns
+        starts, stops = offsets[blocks], offsets[blocks + 1]
+        lengths = stops - starts
+        # Indices of the entries of every block, starts[i]..stops[i] in a row.
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.bincount(classes[entries], weights=areas[entries], minlength=PIXEL_VALUES)
+
+    def query(self, feature_geometry):
+        # Adds up the coarsest blocks covered by the feature, going down a
+        # level only for the blocks crossed by its boundary. Returns the
+        # areas per pixel value and the windows of the level 0 blocks
+        # crossed by the boundary, left to read at full resolution.
+        shapely.prepare(feature_geometry)
+        top = len(self.levels) - 1
+        grid_rows, grid_columns = self.get_grid_shape(top)
+        rows, columns = (index.ravel() for index in np.indices((grid_rows, grid_columns)))
+        pixel_areas = np.zeros(PIXEL_VALUES)
+        for level in range(top, -1, -1):
+            boxes = self.get_block_boxes(level, rows, columns)
+            covered = shapely.covers(feature_geometry, boxes)
+            crossed = ~covered & shapely.intersects(feature_geometry, boxes)
+            pixel_areas += self.get_block_areas(level, rows[covered], columns[covered])
+            instrumentation.count("pyramid_blocks", int(covered.sum()))
+            if not level:
+                break
+
+            grid_rows, grid_columns = self.get_grid_shape(level - 1)
+            rows = (2 * rows[crossed, np.newaxis] + np.array([0, 0, 1, 1])).ravel()
+            columns = (2 * columns[crossed, np.newaxis] + np.array([0, 1, 0, 1])).ravel()
+            inside_grid = (rows < grid_rows) & (columns < grid_columns)
+            rows, columns = rows[inside_grid], columns[inside_grid]
+
+        boundary_windows = [
+            windows.Window(
+                column * self.block_size, row * self.block_size,
+                min(self.block_size, self.width - column * self.block_size),
+                min(self.block_size, self.height - row * self.block_size))
+            for row, column in zip(rows[crossed].tolist(), columns[crossed].tolist())
+        ]
+        instrumentation.count("boundary_blocks", len(boundary_windows))
+        return pixel_areas, boundary_windows
+
+
+def load_histogram_pyramid(path):
+    # Cached per file version, a pyramid rebuilt by the command line while
+    # the app runs is loaded again.
+    stat = os.stat(path)
+    return load_histogram_pyramid_version(path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=8)
+def load_histogram_pyramid_version(path, mtime_ns, size):
+    return HistogramPyramid.load(path)
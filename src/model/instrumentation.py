@@ -0,0 +1,351 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import cProfile
+import functools
+import threading
+import contextvars
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger("mapbiomas.instrumentation")
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Metrics:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__stages = {}
+        self.__counters = {}
+
+    def observe_stage(self, name, seconds, allocated_bytes):
+        with self.__lock:
+            stage = self.__stages.setdefault(name, {"count": 0, "seconds": 0.0, "allocated_bytes": 0})
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            stage["allocated_bytes"] += allocated_bytes
+
+    def increment(self, name, value=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self.__lock:
+            return {
+                "stages": {name: dict(stage) for name, stage in self.__stages.items()},
+                "counters": dict(self.__counters)
+            }
+
+    def render_prometheus(self):
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP mapbiomas_stage_seconds Wall time spent in each extraction stage.",
+            "# TYPE mapbiomas_stage_seconds summary",
+        ]
+        for name, stage in sorted(snapshot["stages"].items()):
+            lines.append(f'mapbiomas_stage_seconds_sum{{stage="{name}"}} {stage["seconds"]:.6f}')
+            lines.append(f'mapbiomas_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+        lines.extend([
+            "# HELP mapbiomas_stage_allocated_bytes_total Peak Python allocations of each stage, when traced.",
+            "# TYPE mapbiomas_stage_allocated_bytes_total counter",
+        ])
+        for name, stage in sorted(snapshot["stages"].items()):
+            lines.append(f'mapbiomas_stage_allocated_bytes_total{{stage="{name}"}} {stage["allocated_bytes"]}')
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE mapbiomas_{name}_total counter")
+            lines.append(f"mapbiomas_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MemoryPeaks:
+    # tracemalloc keeps a single peak for the process while stages nest and
+    # run in parallel threads. Before a new stage resets it, the peak so far
+    # is folded into every stage still open, none of them loses its own.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__open = {}
+
+    def start(self):
+        with self.__lock:
+            current, peak = tracemalloc.get_traced_memory()
+            for token, stage_peak in self.__open.items():
+                self.__open[token] = max(stage_peak, peak)
+            tracemalloc.reset_peak()
+            token = object()
+            self.__open[token] = current
+        return token, current
+
+    def stop(self, token, start_memory):
+        with self.__lock:
+            peak = max(self.__open.pop(token), tracemalloc.get_traced_memory()[1])
+        return max(0, peak - start_memory)
+
+
+class Trace:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.time()
+        self.seconds = None
+        self.stages = {}
+        self.counters = {}
+        self.__lock = threading.Lock()
+
+    def add_stage(self, name, seconds, allocated_bytes):
+        with self.__lock:
+            stage = self.stages.setdefault(name, {"count": 0, "seconds": 0.0, "allocated_bytes": 0})
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            stage["allocated_bytes"] += allocated_bytes
+
+    def increment(self, name, value=1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self.__lock:
+            return {
+                "trace": self.name,
+                **self.attributes,
+                "started": self.started,
+                "seconds": self.seconds,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "counters": dict(self.counters)
+            }
+
+
+class GdalRequestHandler(logging.Handler):
+    # With CPL_DEBUG=VSICURL, rasterio forwards the GDAL curl debug messages
+    # to the rasterio._env logger, one line per range request.
+    DOWNLOAD_PATTERN = re.compile(r"VSICURL: Downloading (\d+)-(\d+)")
+
+    def __init__(self, instrumentation, parent):
+        super().__init__(level=logging.DEBUG)
+        self.instrumentation = instrumentation
+        self.parent = parent
+
+    def emit(self, record):
+        if record.levelno > logging.DEBUG:
+            self.parent.handle(record)
+            return
+        ranges = self.DOWNLOAD_PATTERN.findall(record.getMessage())
+        if ranges:
+            self.instrumentation.count("gdal_requests", 1)
+            self.instrumentation.count("gdal_bytes", sum(int(end) - int(start) + 1 for start, end in ranges))
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Instrumentation:
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.profiler = ""
+        self.profile_dir = "."
+        self.metrics = Metrics()
+        self.recent_traces = deque(maxlen=50)
+        self.__memory_peaks = MemoryPeaks()
+        self.__gdal_handler = None
+        self.__metrics_server = None
+
+    def configure(self, enabled=False, trace_memory=False, profiler="", profile_dir=".", metrics_port=0):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if enabled:
+            self.__install_gdal_handler()
+            if not logger.handlers:
+                handler = logging.StreamHandler(sys.stderr)
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                logger.addHandler(handler)
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+        if metrics_port and self.__metrics_server is None:
+            self.start_metrics_server(metrics_port)
+
+    def __install_gdal_handler(self):
+        if self.__gdal_handler:
+            return
+        # Only the VSICURL category, ON would also print every other GDAL
+        # debug message to stderr.
+        os.environ["CPL_DEBUG"] = "VSICURL"
+        gdal_logger = logging.getLogger("rasterio._env")
+        self.__gdal_handler = GdalRequestHandler(self, gdal_logger.parent)
+        gdal_logger.addHandler(self.__gdal_handler)
+        gdal_logger.setLevel(logging.DEBUG)
+        gdal_logger.propagate = False
+
+    def start_metrics_server(self, port, host="0.0.0.0"):
+        handler = type("Handler", (MetricsRequestHandler,), {"metrics": self.metrics})
+        self.__metrics_server = ThreadingHTTPServer((host, port), handler)
+        threading.Thread(target=self.__metrics_server.serve_forever, daemon=True).start()
+        return self.__metrics_server
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        self.metrics.increment(name, value)
+        trace = current_trace.get()
+        if trace:
+            trace.increment(name, value)
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            memory_token, start_memory = self.__memory_peaks.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            allocated_bytes = self.__memory_peaks.stop(memory_token, start_memory) if tracing else 0
+            self.metrics.observe_stage(name, seconds, allocated_bytes)
+            trace = current_trace.get()
+            if trace:
+                trace.add_stage(name, seconds, allocated_bytes)
+
+    def timed(self, name):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def __profile(self, name):
+        if self.profiler == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                profile.dump_stats(self.__profile_path(name, "prof"))
+        elif self.profiler == "pyinstrument":
+            from pyinstrument import Profiler
+            profile = Profiler()
+            profile.start()
+            try:
+                yield
+            finally:
+                profile.stop()
+                with open(self.__profile_path(name, "html"), "w") as profile_file:
+                    profile_file.write(profile.output_html())
+        else:
+            yield
+
+    def __profile_path(self, name, extension):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        return os.path.join(
+            self.profile_dir, f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{threading.get_ident()}.{extension}")
+
+    @contextmanager
+    def trace(self, name, **attributes):
+        if not self.enabled and not self.profiler:
+            yield None
+            return
+
+        trace = Trace(name, attributes)
+        token = current_trace.set(trace)
+        start = time.perf_counter()
+        try:
+            with self.__profile(name):
+                yield trace
+        finally:
+            trace.seconds = time.perf_counter() - start
+            current_trace.reset(token)
+            if self.enabled:
+                summary = trace.summary()
+                self.recent_traces.append(summary)
+                logger.info(json.dumps(summary, default=str))
+
+    def traced(self, name):
+        # For methods taking a params dict, as the controller entry points.
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(owner, params, *args, **kwargs):
+                with self.trace(name, year=params.get("year"), src_path=params.get("src_path")):
+                    result = function(owner, params, *args, **kwargs)
+                    self.__count_features(result)
+                    return result
+            return wrapper
+        return decorator
+
+    def traced_stream(self, name):
+        # As traced, for methods yielding chunks of results with the complete
+        # one last. The generator steps run in their own context, the trace
+        # spans them without collecting what the caller does between chunks.
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(owner, params, *args, **kwargs):
+                context = contextvars.copy_context()
+                chunks = self.__trace_chunks(name, function(owner, params, *args, **kwargs), params)
+                try:
+                    while True:
+                        try:
+                            chunk = context.run(next, chunks)
+                        except StopIteration:
+                            return
+                        yield chunk
+                finally:
+                    context.run(chunks.close)
+            return wrapper
+        return decorator
+
+    def __trace_chunks(self, name, chunks, params):
+        with self.trace(name, year=params.get("year"), src_path=params.get("src_path")):
+            for chunk in chunks:
+                if chunk["final"]:
+                    self.__count_features(chunk["polygons"])
+                yield chunk
+
+    def __count_features(self, result):
+        # Columnar results know their size without building the GeoJSON
+        # features.
+        feature_count = getattr(result, "feature_count", None)
+        if feature_count is None and isinstance(result, dict) and "features" in result:
+            feature_count = len(result["features"])
+        if feature_count is not None:
+            self.count("features", feature_count)
+
+    @staticmethod
+    def propagate(function):
+        # Executors do not copy context variables to their threads, stages
+        # run there would otherwise not reach the caller trace.
+        context = contextvars.copy_context()
+        return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,219 @@
+import json
+import time
+import queue
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+
+def get_process_context():
+    # Workers start from a single threaded server process. Forked from the
+    # app, they could copy a GDAL or logging lock held by another thread and
+    # wait on it forever. The server imports the raster stack once.
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["model.read_cog"])
+    return context
+
+
+def job_key(name, params):
+    # Callbacks are per session, everything else identifies the computation.
+    values = {key: value for key, value in params.items() if not callable(value)}
+    payload = json.dumps([name, values], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Job:
+    def __init__(self, key, cost, function, args):
+        self.key = key
+        self.cost = cost
+        self.function = function
+        self.args = args
+        self.future = Future()
+        self.started = None
+        self.executor = None
+        # Streamed jobs put their partial results on chunk_queue while they
+        # run, kept in chunks for every session waiting on the job.
+        self.chunk_queue = None
+        self.chunks = []
+        self.chunks_lock = threading.Lock()
+
+
+class JobScheduler:
+    def __init__(self, max_workers=2, max_running_cost=12_000_000, max_queued_jobs=20):
+        self.max_workers = max_workers
+        self.max_running_cost = max_running_cost
+        self.max_queued_jobs = max_queued_jobs
+        self.completed = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.__context = get_process_context()
+        self.__executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=self.__context)
+        self.__queue = deque()
+        self.__running = {}
+        self.__in_flight = {}
+        self.__running_cost = 0
+        self.__cost_per_second = None
+        self.__manager = None
+        self.__closed = False
+        # Reentrant, a process future already done runs its callback inside
+        # __dispatch.
+        self.__lock = threading.RLock()
+
+    def __replace_broken_executor(self):
+        # A worker died, e.g. killed out of memory, and took the pool with it.
+        self.__executor.shutdown(wait=False)
+        self.__executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.__context)
+
+    def __get_chunk_queue(self):
+        # The manager process holding the queues starts with the first
+        # streamed job.
+        if self.__manager is None:
+            self.__manager = self.__context.Manager()
+        return self.__manager.Queue()
+
+    def submit(self, key, cost, function, *args, stream=False):
+        # Streamed jobs are called with their chunk queue first.
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError("cannot submit jobs after shutdown")
+            job = self.__in_flight.get(key)
+            if job:
+                self.deduplicated += 1
+                return job
+            if len(self.__queue) >= self.max_queued_jobs:
+                self.rejected += 1
+                return None
+
+            job = Job(key, cost, function, args)
+            if stream:
+                job.chunk_queue = self.__get_chunk_queue()
+                job.args = (job.chunk_queue, *args)
+            self.__in_flight[key] = job
+            self.__queue.append(job)
+            self.__dispatch()
+        return job
+
+    def __dispatch(self):
+        # First in, first out: a job waits for the running cost to leave room
+        # for it, one above the whole budget runs alone.
+        while self.__queue and len(self.__running) < self.max_workers and not self.__closed:
+            job = self.__queue[0]
+            if self.__running and self.__running_cost + job.cost > self.max_running_cost:
+                return
+            self.__queue.popleft()
+            job.started = time.monotonic()
+            self.__running[job.key] = job
+            self.__running_cost += job.cost
+            try:
+                process_future = self.__executor.submit(job.function, *job.args)
+            except BrokenProcessPool:
+                self.__replace_broken_executor()
+                process_future = self.__executor.submit(job.function, *job.args)
+            job.executor = self.__executor
+            process_future.add_done_callback(lambda process_future, job=job: self.__finish(job, process_future))
+
+    def __finish(self, job, process_future):
+        # Cancelled on shutdown, exception() would raise the CancelledError.
+        exception = CancelledError() if process_future.cancelled() else process_future.exception()
+        with self.__lock:
+            del self.__running[job.key]
+            del self.__in_flight[job.key]
+            self.__running_cost -= job.cost
+            self.completed += 1
+            seconds = time.monotonic() - job.started
+            if isinstance(exception, BrokenProcessPool) and job.executor is self.__executor:
+                self.__replace_broken_executor()
+            if job.cost and seconds > 0 and not exception:
+                cost_per_second = job.cost / seconds
+                self.__cost_per_second = cost_per_second if self.__cost_per_second is None else (
+                    0.7 * self.__cost_per_second + 0.3 * cost_per_second)
+            self.__dispatch()
+
+        if isinstance(exception, CancelledError):
+            job.future.cancel()
+        elif exception:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(process_future.result())
+
+    def status(self, job):
+        with self.__lock:
+            if job.future.done():
+                return {"state": "done", "progress": 1.0}
+            if job.started is None:
+                position = next(index for index, queued in enumerate(self.__queue) if queued is job) + 1
+                return {"state": "queued", "position": position, "running": len(self.__running)}
+            progress = None
+            if self.__cost_per_second:
+                # Estimated from the throughput of the finished jobs, never
+                # reaches the end before the job does.
+                elapsed = time.monotonic() - job.started
+                progress = min(0.95, elapsed * self.__cost_per_second / max(job.cost, 1))
+            return {"state": "running", "progress": progress}
+
+    def wait(self, job, progress_callback=None, interval=0.25):
+        while progress_callback and not job.future.done():
+            progress_callback(self.status(job))
+            wait([job.future], timeout=interval)
+        return job.future.result()
+
+    @staticmethod
+    def __receive_chunks(job):
+        if job.chunk_queue is None:
+            return
+        with job.chunks_lock:
+            while True:
+                try:
+                    job.chunks.append(job.chunk_queue.get_nowait())
+                except queue.Empty:
+                    return
+
+    def iter_chunks(self, job, progress_callback=None, interval=0.25):
+        # The chunks of a streamed job as they arrive, from the first one for
+        # sessions joining it late. Ends when the job is done, wait() then
+        # returns its result.
+        received = 0
+        while True:
+            # Read first, a job done has put all of its chunks already.
+            done = job.future.done()
+            self.__receive_chunks(job)
+            while received < len(job.chunks):
+                yield job.chunks[received]
+                received += 1
+            if done:
+                return
+            if progress_callback:
+                progress_callback(self.status(job))
+            wait([job.future], timeout=interval)
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "queued": len(self.__queue),
+                "running": len(self.__running),
+                "running_cost": self.__running_cost,
+                "completed": self.completed,
+                "deduplicated": self.deduplicated,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self):
+        # Queued jobs are cancelled, every session waiting on one of them,
+        # deduplicated or not, gets a CancelledError instead of waiting
+        # forever. Running jobs finish.
+        with self.__lock:
+            self.__closed = True
+            queued = list(self.__queue)
+            self.__queue.clear()
+            for job in queued:
+                del self.__in_flight[job.key]
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        for job in queued:
+            job.future.cancel()
+        if self.__manager is not None:
+            self.__manager.shutdown()
@@ -0,0 +1,230 @@
+from collections.abc import Mapping
+import numpy as np
+import shapely
+from shapely.geometry import shape, mapping
+from model.class_table import as_class_table
+
+BASE_FIELDS = ("pixel_value", "area_ha", "year")
+
+
+def to_wkb_buffer(geometries):
+    geometries_wkb = shapely.to_wkb(geometries)
+    offsets = np.cumsum([0] + [len(geometry_wkb) for geometry_wkb in geometries_wkb], dtype="int64")
+    return b"".join(geometries_wkb), offsets
+
+
+def from_wkb_buffer(wkb, offsets):
+    return shapely.from_wkb(
+        np.array([wkb[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())], dtype=object))
+
+
+def as_object_array(values, length):
+    if np.ndim(values) == 0:
+        return np.full(length, values, dtype=object)
+    return np.asarray(values, dtype=object)
+
+
+class PolygonResult(Mapping):
+    # The polygons of an extraction as columns: geometries, one array per
+    # property and the class attributes once per class. It still reads as a
+    # GeoJSON FeatureCollection, the features are only built on first use.
+    def __init__(self, geometries, pixel_value, area_ha, year, classes_names, columns=None):
+        self.geometries = np.asarray(geometries, dtype=object)
+        length = len(self.geometries)
+        self.pixel_value = np.asarray(pixel_value, dtype="uint8")
+        self.area_ha = np.asarray(area_ha, dtype="float64")
+        self.year = np.full(length, year) if np.ndim(year) == 0 else np.asarray(year)
+        self.class_table = as_class_table(classes_names)
+        self.class_table.validate(self.pixel_value)
+        self.columns = {name: as_object_array(values, length) for name, values in (columns or {}).items()}
+        self.__features = None
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], None, {})
+
+    @classmethod
+    def from_geojson(cls, feature_collection, classes_names=None):
+        # Without classes_names every other property is taken as a class
+        # attribute of the first feature with that pixel value.
+        features = feature_collection.get("features", [])
+        properties = [feature["properties"] for feature in features]
+        pixel_values = [feature_properties["pixel_value"] for feature_properties in properties]
+        if classes_names is None:
+            classes_names = {}
+            for feature_properties in properties:
+                classes_names.setdefault(feature_properties["pixel_value"], {
+                    name: value for name, value in feature_properties.items() if name not in BASE_FIELDS})
+        class_fields = {name for pixel_value in set(pixel_values) for name in classes_names[pixel_value]}
+        column_names = dict.fromkeys(
+            name for feature_properties in properties for name in feature_properties
+            if name not in BASE_FIELDS and name not in class_fields)
+        return cls(
+            np.array([shape(feature["geometry"]) for feature in features], dtype=object),
+            pixel_values,
+            [feature_properties["area_ha"] for feature_properties in properties],
+            as_object_array([feature_properties.get("year") for feature_properties in properties], len(properties)),
+            classes_names,
+            {name: [feature_properties.get(name) for feature_properties in properties] for name in column_names}
+        )
+
+    @staticmethod
+    def concat(results):
+        results = [as_polygon_result(result) for result in results]
+        if not results:
+            return PolygonResult.empty()
+        column_names = dict.fromkeys(name for result in results for name in result.columns)
+        class_tables = list({
+            id(result.class_table): result.class_table for result in results if result.feature_count}.values())
+        if len(class_tables) > 1:
+            classes_names = {}
+            for class_table in class_tables:
+                classes_names.update(class_table)
+        elif class_tables:
+            classes_names = class_tables[0]
+        else:
+            # Without features, the first table that is not the empty one.
+            classes_names = next(
+                (result.class_table for result in results if len(result.class_table)), results[0].class_table)
+        return PolygonResult(
+            np.concatenate([result.geometries for result in results]),
+            np.concatenate([result.pixel_value for result in results]),
+            np.concatenate([result.area_ha for result in results]),
+            np.concatenate([result.year for result in results]),
+            classes_names,
+            {
+                name: np.concatenate([
+                    result.columns.get(name, np.full(result.feature_count, None, dtype=object)) for result in results])
+                for name in column_names
+            }
+        )
+
+    @property
+    def feature_count(self):
+        return len(self.geometries)
+
+    def take(self, index):
+        return PolygonResult(
+            self.geometries[index],
+            self.pixel_value[index],
+            self.area_ha[index],
+            self.year[index],
+            self.class_table,
+            {name: values[index] for name, values in self.columns.items()}
+        )
+
+    def with_geometries(self, geometries, area_ha):
+        return PolygonResult(geometries, self.pixel_value, area_ha, self.year, self.class_table, self.columns)
+
+    def with_column(self, name, value):
+        return PolygonResult(
+            self.geometries, self.pixel_value, self.area_ha, self.year, self.class_table, {**self.columns, name: value})
+
+    def class_columns(self):
+        return self.class_table.columns(self.pixel_value)
+
+    def properties(self):
+        columns = {"pixel_value": self.pixel_value, "area_ha": self.area_ha, "year": self.year}
+        columns.update(self.class_columns())
+        columns.update(self.columns)
+        names = list(columns)
+        return [dict(zip(names, values)) for values in zip(*[values.tolist() for values in columns.values()])]
+
+    @property
+    def features(self):
+        if self.__features is None:
+            self.__features = [
+                {"type": "Feature", "geometry": mapping(geometry), "properties": feature_properties}
+                for geometry, feature_properties in zip(self.geometries, self.properties())
+            ]
+        return self.__features
+
+    def __getitem__(self, key):
+        if key == "type":
+            return "FeatureCollection"
+        if key == "features":
+            return self.features
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(("type", "features"))
+
+    def __len__(self):
+        return 2
+
+    def to_geojson(self):
+        return {"type": "FeatureCollection", "features": self.features}
+
+    def to_dataframe(self, geometry=False):
+        import pandas as pd
+        data = {"pixel_value": self.pixel_value, "area_ha": self.area_ha, "year": self.year}
+        data.update(self.class_columns())
+        data.update(self.columns)
+        if geometry:
+            data["geometry"] = self.geometries
+        return pd.DataFrame(data)
+
+    def to_arrow(self):
+        # Class attributes are dictionary encoded with the class table codes.
+        import pyarrow as pa
+        columns = {
+            "geometry": pa.array(shapely.to_wkb(self.geometries), type=pa.binary()),
+            "pixel_value": pa.array(self.pixel_value),
+            "area_ha": pa.array(self.area_ha),
+            "year": pa.array(self.year.tolist()),
+        }
+        for name in self.class_table.fields:
+            indices = pa.array(self.class_table.codes[name][self.pixel_value].astype("int32"))
+            dictionary = pa.array(self.class_table.categories[name].tolist())
+            columns[name] = pa.DictionaryArray.from_arrays(indices, dictionary)
+        for name, column_values in self.columns.items():
+            columns[name] = pa.array(column_values.tolist())
+        return pa.table(columns)
+
+    def summary(self):
+        # Area and polygon count per class name, largest first.
+        name_codes = self.class_table.codes["class_name"]
+        codes = name_codes[self.pixel_value]
+        areas = np.bincount(codes, weights=self.area_ha)
+        counts = np.bincount(codes)
+        # Classes sharing a name take the color of the lowest pixel value.
+        pixel_values = np.unique(self.pixel_value)
+        class_codes, first = np.unique(name_codes[pixel_values], return_index=True)
+        stats = [
+            {"hex_color": hex_color, "class_name": class_name, "area_ha": area, "polygon_count": count}
+            for hex_color, class_name, area, count in zip(
+                self.class_table.lookup("hex_color", pixel_values[first]).tolist(),
+                self.class_table.categories["class_name"][class_codes].tolist(),
+                areas[class_codes].tolist(),
+                counts[class_codes].tolist())
+        ]
+        return sorted(stats, key=lambda row: row["area_ha"], reverse=True)
+
+    def __getstate__(self):
+        # One WKB buffer instead of a pickled object per geometry, results are
+        # pickled by st.cache_data and sent back from the worker processes.
+        wkb, offsets = to_wkb_buffer(self.geometries)
+        return {
+            "wkb": wkb,
+            "wkb_offsets": offsets,
+            "pixel_value": self.pixel_value,
+            "area_ha": self.area_ha,
+            "year": self.year,
+            "class_table": self.class_table,
+            "columns": self.columns,
+        }
+
+    def __setstate__(self, state):
+        self.geometries = from_wkb_buffer(state["wkb"], state["wkb_offsets"])
+        self.pixel_value = state["pixel_value"]
+        self.area_ha = state["area_ha"]
+        self.year = state["year"]
+        self.class_table = state["class_table"]
+        self.columns = state["columns"]
+        self.__features = None
+
+
+def as_polygon_result(polygons):
+    if isinstance(polygons, PolygonResult):
+        return polygons
+    return PolygonResult.from_geojson(polygons or {})
@@ -1,69 +1,233 @@
+import math
 import pyproj
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import shapely
 import numpy as np
-from rasterio import warp
-from rio_tiler.io import COGReader
-from rasterio.features import shapes
-from rasterio.transform import Affine
+from rasterio import windows
+from rasterio.enums import Resampling
+from rasterio.features import shapes, rasterize, sieve
+from rasterio.transform import Affine, from_bounds
 from shapely.ops import transform
 from shapely.geometry import shape, mapping
+from model.instrumentation import instrumentation
+from model.block_cache import is_remote, get_cached_url
+from model.job_scheduler import get_process_context
+from model.polygon_result import PolygonResult, as_polygon_result
+from model.class_table import as_class_table
+from model.shared_edges import get_shared_edges, simplify_shared_edges
 
 
 class ReadCOG:
-    def __init__(self, geographic_crs="EPSG:4326", projected_crs="EPSG:6933", float_precision=6):
+    def __init__(self, geographic_crs="EPSG:4326", projected_crs="EPSG:6933", float_precision=6, engine="vectorized", edge_mask=False, reader_pool=None, area_engine="rows", block_cache_url=None):
         self.default_crs = geographic_crs
         self.float_precision = float_precision
-        self.geographic_crs = pyproj.CRS(geographic_crs)
-        self.projected_crs = pyproj.CRS(projected_crs)
-        self.transform_geo_to_projected = self.__get_geo_transform(geographic_crs, projected_crs)
+        self.engine = engine
+        self.area_engine = area_engine
+        self.edge_mask = edge_mask
+        self.reader_pool = reader_pool
+        self.block_cache_url = block_cache_url
+        self.geographic_crs = geographic_crs
+        self.projected_crs = projected_crs
+        self.__transform_geo_to_projected = None
 
     @staticmethod
     def __get_geo_transform(origin_crs, destination_crs):
         return pyproj.Transformer.from_crs(origin_crs, destination_crs, always_xy=True).transform
 
-    @staticmethod
-    def __tiler(src_path, *args, **kwargs):
-        with COGReader(src_path) as cog:
-            return cog.feature(*args, **kwargs)
+    @property
+    def transform_geo_to_projected(self):
+        # Built on first use, loading the PROJ database is part of the cost.
+        if self.__transform_geo_to_projected is None:
+            self.__transform_geo_to_projected = self.__get_geo_transform(self.geographic_crs, self.projected_crs)
+        return self.__transform_geo_to_projected
+
+    @property
+    def reader_options(self):
+        # What a reader in another thread or process needs to give the same
+        # result, the reader pool stays with this one.
+        return {
+            "float_precision": self.float_precision,
+            "engine": self.engine,
+            "edge_mask": self.edge_mask,
+            "area_engine": self.area_engine,
+            "block_cache_url": self.block_cache_url
+        }
+
+    def get_read_path(self, src_path):
+        if self.block_cache_url and is_remote(src_path):
+            return get_cached_url(self.block_cache_url, src_path)
+        return src_path
+
+    def open_reader(self, src_path):
+        src_path = self.get_read_path(src_path)
+        if self.reader_pool:
+            return self.reader_pool.reader(src_path)
+        from rio_tiler.io import COGReader
+        return COGReader(src_path)
 
     def __transform_to_meters(self, input_geom):
         return transform(self.transform_geo_to_projected, input_geom)
 
+    def __project_coordinates(self, coordinates):
+        x, y = self.transform_geo_to_projected(coordinates[:, 0], coordinates[:, 1])
+        return np.column_stack((x, y))
+
+    @instrumentation.timed("area")
     def area_ha(self, polygon_geojson):
         polygon = shape(polygon_geojson)
         polygon_meters = self.__transform_to_meters(polygon)
         return round(polygon_meters.area/10_000, self.float_precision)
 
-    def __get_image_bounds(self, image):
-        left, bottom, right, top = [round(i,self.float_precision) for i in image.bounds]
-        bounds_4326 = warp.transform_bounds(
-            src_crs=image.crs,
-            dst_crs=self.default_crs,
-            left=left,
-            bottom=bottom,
-            right=right,
-            top=top
+    @instrumentation.timed("area")
+    def areas_m2(self, geometries):
+        geometries_meters = shapely.transform(geometries, self.__project_coordinates)
+        return shapely.area(geometries_meters)
+
+    def get_row_areas(self, transform, height):
+        # Every cell of a north-up geographic raster row has the same area,
+        # so the equal-area projection only runs once per row.
+        tops = transform.f + transform.e * np.arange(height)
+        row_cells = shapely.box(transform.c, tops + transform.e, transform.c + transform.a, tops)
+        return self.areas_m2(row_cells)
+
+    @staticmethod
+    def __ring_areas(rings, columns_of, area_above_of):
+        # Only horizontal edges of a pixel aligned ring add area: the edge
+        # width in columns times the area of one column above its row edge.
+        # Summed over the ring, this is the pixel count of each row times
+        # the row cell area.
+        coordinates, ring_index = shapely.get_coordinates(rings, return_index=True)
+        same_ring = ring_index[1:] == ring_index[:-1]
+        edge_areas = np.diff(columns_of(coordinates[:, 0])) * area_above_of(coordinates[:-1, 1])
+        return np.abs(np.bincount(ring_index[:-1][same_ring], weights=edge_areas[same_ring], minlength=len(rings)))
+
+    @instrumentation.timed("area")
+    def pixel_aligned_areas_m2(self, geometries, transform, row_areas):
+        area_above = np.concatenate([[0.0], np.cumsum(row_areas)])
+
+        def columns_of(x):
+            return (x - transform.c) / transform.a
+
+        def area_above_of(y):
+            return area_above[np.clip(np.rint((y - transform.f) / transform.e).astype(int), 0, len(row_areas))]
+
+        # Polygons without holes are a single ring, splitting the others in
+        # rings creates one geometry per ring and is much slower.
+        areas = np.empty(len(geometries), dtype="float64")
+        holes = shapely.get_num_interior_rings(geometries) > 0
+        areas[~holes] = self.__ring_areas(geometries[~holes], columns_of, area_above_of)
+        rings, ring_geometry = shapely.get_rings(geometries[holes], return_index=True)
+        ring_areas = self.__ring_areas(rings, columns_of, area_above_of)
+        exterior = np.concatenate([[True], ring_geometry[1:] != ring_geometry[:-1]])[:len(rings)]
+        areas[holes] = np.bincount(
+            ring_geometry, weights=np.where(exterior, ring_areas, -ring_areas), minlength=int(holes.sum()))
+        return areas
+
+    def __get_areas(self, geometries, inside, transform, height, row_areas=None):
+        if self.area_engine == "projected":
+            return self.areas_m2(geometries)
+
+        # Only polygons clipped by the feature boundary are projected
+        if row_areas is None:
+            row_areas = self.get_row_areas(transform, height)
+        areas = np.empty(len(geometries), dtype="float64")
+        areas[inside] = self.pixel_aligned_areas_m2(geometries[inside], transform, row_areas)
+        areas[~inside] = self.areas_m2(geometries[~inside])
+        return areas
+
+    def __round_areas_ha(self, areas_m2):
+        return [round(area / 10_000, self.float_precision) for area in areas_m2.tolist()]
+
+    def get_polygons(self, feature_geojson, image, mask, transform, classes_names, year, grid=None):
+        if self.engine == "iterative":
+            return self.__get_polygons_iterative(feature_geojson, image, mask, transform, classes_names, year)
+        return self.__get_polygons_vectorized(feature_geojson, image, mask, transform, classes_names, year, grid)
+
+    @instrumentation.timed("polygonize")
+    def __polygonize(self, image, mask, transform):
+        image_shapes = shapes(image, mask=mask, transform=transform)
+
+        geometries = []
+        pixel_values = []
+        for geom, pixel_value in image_shapes:
+            geometries.append(shape(geom))
+            pixel_values.append(int(pixel_value))
+
+        geometries = np.array(geometries, dtype=object)
+        instrumentation.count("shapes", len(geometries))
+        return geometries, np.array(pixel_values, dtype=image.dtype)
+
+    @staticmethod
+    @instrumentation.timed("clip")
+    def __clip_to_feature(geometries, feature_geometry):
+        # Shapes fully inside the prepared input polygon are kept as they are,
+        # disjoint ones are dropped and only the boundary ones are intersected.
+        shapely.prepare(feature_geometry)
+        inside = shapely.contains(feature_geometry, geometries)
+        crossing = ~inside & shapely.intersects(feature_geometry, geometries)
+
+        clipped = geometries.copy()
+        clipped[crossing] = shapely.intersection(geometries[crossing], feature_geometry)
+        keep = inside | (crossing & (shapely.area(clipped) > 0))
+        return clipped, inside, keep
+
+    @staticmethod
+    def __get_edge_coverage(feature_geometry, out_shape, transform, boundary=None):
+        # 1 marks pixels touching the polygon, 2 the ones crossed by its boundary
+        boundary = feature_geometry.boundary if boundary is None else boundary
+        return rasterize(
+            [(feature_geometry, 1), (boundary, 2)],
+            out_shape=out_shape,
+            transform=transform,
+            all_touched=True,
+            fill=0,
+            dtype="uint8"
         )
-        bounds_4326 = [round(i, self.float_precision) for i in bounds_4326]
-        return [[bounds_4326[1], bounds_4326[0]], [bounds_4326[3], bounds_4326[2]]]
 
-    def get_transform(self, transformed_bounds, width, height):
-        min_y, min_x = transformed_bounds[0]
-        max_y, max_x = transformed_bounds[1]
+    def __get_edge_mask(self, feature_geometry, mask, transform, boundary=None, coverage=None):
+        if coverage is None:
+            coverage = self.__get_edge_coverage(feature_geometry, mask.shape, transform, boundary)
+        valid = mask.astype(bool, copy=False)
+        return valid & (coverage == 1), valid & (coverage == 2)
+
+    def __polygonize_and_clip(self, image, mask, transform, feature_geometry, edge_coverage=None):
+        if self.edge_mask:
+            # Pixels not touched by the polygon boundary are fully inside it,
+            # so their shapes skip the clipping step entirely. Regions crossing
+            # the edge band are split in two features at the band limit.
+            interior_mask, edge_mask = self.__get_edge_mask(feature_geometry, mask, transform, coverage=edge_coverage)
+            interior_geometries, interior_values = self.__polygonize(image, interior_mask, transform)
+            edge_geometries, edge_values = self.__polygonize(image, edge_mask, transform)
+            edge_geometries, edge_inside, keep = self.__clip_to_feature(edge_geometries, feature_geometry)
+            geometries = np.concatenate([interior_geometries, edge_geometries[keep]])
+            inside = np.concatenate([np.ones(len(interior_values), dtype=bool), edge_inside[keep]])
+            pixel_values = np.concatenate([interior_values, edge_values[keep]])
+        else:
+            geometries, pixel_values = self.__polygonize(image, mask, transform)
+            geometries, inside, keep = self.__clip_to_feature(geometries, feature_geometry)
+            geometries, inside, pixel_values = geometries[keep], inside[keep], pixel_values[keep]
+        return geometries, inside, pixel_values
 
-        pixel_size_x = round((max_x - min_x) / width, self.float_precision)
-        pixel_size_y = round((max_y - min_y) / height, self.float_precision)
+    def __get_polygons_vectorized(self, feature_geojson, image, mask, transform, classes_names, year, grid=None):
+        image = image[0] if image.ndim == 3 else image
+        grid = grid or {}
+        feature_geometry = grid["feature_geometry"] if grid else shape(feature_geojson['geometry'])
 
-        transform = Affine(pixel_size_x, 0.0, min_x,
-                           0.0, -pixel_size_y, max_y)
-        return transform
+        geometries, inside, pixel_values = self.__polygonize_and_clip(
+            image.astype("uint8", copy=False), mask, transform, feature_geometry, grid.get("edge_coverage"))
+        areas = self.__get_areas(geometries, inside, transform, image.shape[0], grid.get("row_areas"))
 
-    def get_polygons(self, feature_geojson, image, mask, transform, classes_names, year):
-        mask_expanded = np.expand_dims(mask, axis=0)
+        with instrumentation.stage("build_features"):
+            return PolygonResult(geometries, pixel_values, self.__round_areas_ha(areas), year, classes_names)
 
-        image_shapes = shapes(image.astype('uint8'), mask=mask_expanded, transform=transform)
+    def __get_polygons_iterative(self, feature_geojson, image, mask, transform, classes_names, year):
+        image = image[0] if image.ndim == 3 else image
+        image_shapes = shapes(image.astype("uint8", copy=False), mask=mask, transform=transform)
         feature_geometry = shape(feature_geojson['geometry'])
 
-        features = []
+        geometries = []
+        pixel_values = []
+        areas = []
 
         for image_shape in image_shapes:
             pixel_value = int(image_shape[1])
@@ -71,45 +235,667 @@ class ReadCOG:
             image_geometry = shape(geom)
             intersection = image_geometry.intersection(feature_geometry)
 
-            intersection = mapping(intersection)
-            area = self.area_ha(intersection)
+            geometries.append(intersection)
+            pixel_values.append(pixel_value)
+            areas.append(self.area_ha(mapping(intersection)))
 
-            properties = {"pixel_value":pixel_value, "area_ha": area, "year": year}
-            properties.update(classes_names[pixel_value])
-            feature = {
-                "type": "Feature",
-                "geometry": intersection,
-                "properties": properties
-            }
-            features.append(feature)
+        return PolygonResult(geometries, pixel_values, areas, year, classes_names)
 
-        feat_collection = {
-            "type": "FeatureCollection",
-            "features": features
+    @staticmethod
+    @instrumentation.timed("sieve")
+    def sieve_image(image, mask, min_pixels):
+        # Regions smaller than min_pixels take the value of their largest
+        # neighbour, so the feature stays fully covered.
+        image = image[0] if image.ndim == 3 else image
+        return sieve(image, min_pixels, mask=mask.astype(bool, copy=False))
+
+    @staticmethod
+    def has_generalization(params):
+        return bool(params.get("dissolve") or params.get("min_area_ha") or params.get("smooth"))
+
+    @staticmethod
+    def __dissolve(geometries, class_index, class_count):
+        # Regions of one class from shapes() only touch at corners, so their
+        # parts already form a valid MultiPolygon. A union is only needed
+        # where regions were split, as in the edge mask or clipping cases.
+        parts, part_index = shapely.get_parts(geometries, return_index=True)
+        polygons = shapely.get_type_id(parts) == 3
+        parts, part_class = parts[polygons], class_index[part_index[polygons]]
+        order = np.argsort(part_class, kind="stable")
+        parts, part_class = parts[order], part_class[order]
+        dissolved = shapely.multipolygons(parts, indices=part_class, out=np.empty(class_count, dtype=object))
+        for index in np.nonzero(~shapely.is_valid(dissolved))[0].tolist():
+            dissolved[index] = shapely.union_all(parts[part_class == index])
+        return dissolved
+
+    @instrumentation.timed("generalize")
+    def generalize_polygons(self, polygons, feature_geometry, pixel_size, params):
+        polygons = as_polygon_result(polygons)
+        polygons = polygons.take(polygons.area_ha >= (params.get("min_area_ha") or 0))
+        if not polygons.feature_count:
+            return polygons
+
+        geometries = polygons.geometries
+        if params.get("dissolve"):
+            classes, first_index, class_index = np.unique(polygons.pixel_value, return_index=True, return_inverse=True)
+            geometries = self.__dissolve(geometries, class_index, len(classes))
+            polygons = polygons.take(first_index)
+
+        if params.get("smooth"):
+            # Stair steps are one pixel high, simplifying with that tolerance
+            # turns them into straight edges and clipping keeps them inside.
+            # Shared edges are simplified once, neighbours stay a coverage.
+            geometries = simplify_shared_edges(geometries, get_shared_edges(geometries), pixel_size)
+            shapely.prepare(feature_geometry)
+            outside = ~shapely.contains(feature_geometry, geometries)
+            geometries[outside] = shapely.intersection(geometries[outside], feature_geometry)
+
+        areas = self.areas_m2(geometries)
+        keep = areas > 0
+        return polygons.take(keep).with_geometries(geometries[keep], self.__round_areas_ha(areas[keep]))
+
+    def get_adaptive_max_size(self, src_path, feature_geojson, pixel_budget):
+        with self.open_reader(src_path) as cog:
+            pixel_width, pixel_height = cog.dataset.res
+            overview_factors = cog.dataset.overviews(1)
+
+        min_x, min_y, max_x, max_y = shape(feature_geojson["geometry"]).bounds
+        width = (max_x - min_x) / pixel_width
+        height = (max_y - min_y) / pixel_height
+        if width * height <= pixel_budget:
+            return None
+
+        # Snap to the closest overview that fits the budget, so GDAL reads it
+        # directly instead of decimating a finer level.
+        decimation = np.sqrt(width * height / pixel_budget)
+        factor = min([factor for factor in overview_factors if factor >= decimation], default=decimation)
+        return max(1, int(np.ceil(max(width, height) / factor)))
+
+    @staticmethod
+    def __get_dataset_grid(dataset):
+        return dataset.crs, dataset.transform, dataset.width, dataset.height
+
+    @staticmethod
+    def __get_read_window(dataset, feature_geometry, max_size, align_to_dataset):
+        bounds = feature_geometry.bounds
+        window = windows.from_bounds(*bounds, transform=dataset.transform)
+        # At full resolution the window is snapped to the dataset grid, the
+        # pixels are read as they are instead of resampled on a shifted grid.
+        if align_to_dataset or not max_size:
+            (row_start, row_stop), (col_start, col_stop) = window.toranges()
+            row_start, col_start = math.floor(row_start), math.floor(col_start)
+            window = windows.Window(
+                col_start, row_start, math.ceil(col_stop) - col_start, math.ceil(row_stop) - row_start)
+            bounds = windows.bounds(window, dataset.transform)
+
+        height, width = max(1, round(window.height)), max(1, round(window.width))
+        if max_size and max(height, width) > max_size:
+            ratio = height / width
+            height, width = (max_size, math.ceil(max_size / ratio)) if ratio > 1 else (math.ceil(max_size * ratio), max_size)
+
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        boundless = min(row_start, col_start) < 0 or row_stop > dataset.height or col_stop > dataset.width
+        read_options = {
+            "window": window,
+            "out_shape": (height, width),
+            "resampling": Resampling.nearest,
+            "boundless": boundless
+        }
+        return read_options, from_bounds(*bounds, width, height)
+
+    @staticmethod
+    def __get_feature_mask(feature_geometry, out_shape, transform):
+        # Pixels touched by the feature, as the rio-tiler cutline. Rasterized
+        # as 0/1 bytes and viewed as bool.
+        return rasterize(
+            [feature_geometry], out_shape=out_shape, transform=transform, all_touched=True, fill=0, dtype="uint8"
+        ).view(bool)
+
+    @staticmethod
+    def __read_masked(dataset, read_options, feature_mask):
+        image = dataset.read(1, fill_value=dataset.nodata, **read_options)
+        if dataset.nodata is not None:
+            return image, feature_mask & (image != dataset.nodata)
+        return image, feature_mask & (dataset.read_masks(1, **read_options) > 0)
+
+    def __read_band(self, dataset, feature_geometry, max_size, align_to_dataset):
+        read_options, transform = self.__get_read_window(dataset, feature_geometry, max_size, align_to_dataset)
+        feature_mask = self.__get_feature_mask(feature_geometry, read_options["out_shape"], transform)
+        image, valid = self.__read_masked(dataset, read_options, feature_mask)
+        return image, valid, transform
+
+    def get_read_grid(self, src_path, feature_geojson, max_size=None, align_to_dataset=False):
+        # The read window, feature mask, cell areas and edge pixels of a
+        # feature on the grid of src_path, shared by the other years of a
+        # timeseries on the same grid. None for datasets read by rio-tiler.
+        feature_geometry = shape(feature_geojson["geometry"])
+        with self.open_reader(src_path) as cog:
+            if cog.dataset.crs != self.default_crs:
+                return None
+            dataset_grid = self.__get_dataset_grid(cog.dataset)
+            read_options, transform = self.__get_read_window(cog.dataset, feature_geometry, max_size, align_to_dataset)
+        out_shape = read_options["out_shape"]
+        return {
+            "dataset": dataset_grid,
+            "read_options": read_options,
+            "transform": transform,
+            "feature_geometry": feature_geometry,
+            "feature_mask": self.__get_feature_mask(feature_geometry, out_shape, transform),
+            "row_areas": self.get_row_areas(transform, out_shape[0]),
+            "edge_coverage": self.__get_edge_coverage(feature_geometry, out_shape, transform) if self.edge_mask else None
         }
-        return feat_collection
 
-    def render_mapbiomas_from_cog(self, params):
+    def __read_grid(self, src_path, grid):
+        # None when src_path is not on the grid.
+        with instrumentation.stage("read"), self.open_reader(src_path) as cog:
+            if self.__get_dataset_grid(cog.dataset) != grid["dataset"]:
+                return None
+            image, mask = self.__read_masked(cog.dataset, grid["read_options"], grid["feature_mask"])
+        instrumentation.count("pixels", image.size)
+        return image, mask
+
+    def __read_window(self, src_path, feature_geojson, max_size, align_to_dataset=False):
+        # Datasets already in the output CRS are read as a plain uint8 band,
+        # rio-tiler would also build a masked array, a cutline mask and their
+        # combination. Other CRSs go through the rio-tiler WarpedVRT.
+        with instrumentation.stage("read"), self.open_reader(src_path) as cog:
+            if cog.dataset.crs == self.default_crs:
+                image, mask, transform = self.__read_band(
+                    cog.dataset, shape(feature_geojson["geometry"]), max_size, align_to_dataset)
+            else:
+                image_data = cog.feature(feature_geojson, max_size=max_size, align_bounds_with_dataset=align_to_dataset)
+                image = image_data.array.data[0]
+                mask = ~np.ma.getmaskarray(image_data.array)[0]
+                transform = image_data.transform
+        instrumentation.count("pixels", image.size)
+        return image, mask, transform
+
+    def render_mapbiomas_from_cog(self, params, grid=None):
         feature_geojson = params.get("feature_geojson")
-        args = (feature_geojson, )
         if not feature_geojson:
             return {}
 
-        kwargs = {
-            "max_size": params.get("max_size"),
+        grid_image = self.__read_grid(params.get("src_path"), grid) if grid else None
+        if grid_image:
+            (image, mask), transform = grid_image, grid["transform"]
+        else:
+            grid = None
+            image, mask, transform = self.__read_window(
+                params.get("src_path"), feature_geojson, params.get("max_size"), params.get("align_to_dataset", False))
+        if params.get("min_pixels"):
+            image = self.sieve_image(image, mask, params.get("min_pixels"))
+
+        features = self.get_polygons(
+            feature_geojson=feature_geojson,
+            image=image,
+            mask=mask,
+            transform=transform,
+            classes_names=params.get("classes_names"),
+            year=params.get("year"),
+            grid=grid
+        )
+        if self.has_generalization(params):
+            feature_geometry = grid["feature_geometry"] if grid else shape(feature_geojson["geometry"])
+            features = self.generalize_polygons(features, feature_geometry, abs(transform.a), params)
+
+        return features
+
+    def get_pixel_areas(self, feature_geometry, mask, transform, clip_to_window=False):
+        boundary = None
+        if clip_to_window:
+            # Windows of a large feature rasterize and intersect only the
+            # part of the feature and of its boundary around them.
+            height, width = mask.shape
+            clip_box = (
+                transform.c - transform.a, transform.f + transform.e * (height + 1),
+                transform.c + transform.a * (width + 1), transform.f - transform.e
+            )
+            boundary = shapely.clip_by_rect(feature_geometry.boundary, *clip_box)
+            feature_geometry = shapely.intersection(feature_geometry, shapely.box(*clip_box))
+            if feature_geometry.is_empty:
+                return np.zeros(mask.shape)
+            if boundary.is_empty:
+                boundary = None
+        interior, edge = self.__get_edge_mask(feature_geometry, mask, transform, boundary)
+        row_areas = self.get_row_areas(transform, mask.shape[0])
+        pixel_areas = np.where(interior, row_areas[:, np.newaxis], 0.0)
+
+        # Cells crossed by the polygon boundary only count their covered part
+        edge_rows, edge_cols = np.nonzero(edge)
+        edge_left = transform.c + transform.a * edge_cols
+        edge_top = transform.f + transform.e * edge_rows
+        edge_cells = shapely.box(edge_left, edge_top + transform.e, edge_left + transform.a, edge_top)
+        shapely.prepare(feature_geometry)
+        pixel_areas[edge_rows, edge_cols] = self.areas_m2(shapely.intersection(edge_cells, feature_geometry))
+        return pixel_areas
+
+    @staticmethod
+    def count_regions(image, valid):
+        from scipy import ndimage
+        counts = np.zeros(256, dtype="int64")
+        for pixel_value in np.unique(image[valid]):
+            _, counts[pixel_value] = ndimage.label(valid & (image == pixel_value))
+        return counts
+
+    @instrumentation.timed("zonal_stats")
+    def get_zonal_stats(self, feature_geojson, image, mask, transform, classes_names, year):
+        image = image[0] if image.ndim == 3 else image
+        feature_geometry = shape(feature_geojson['geometry'])
+
+        pixel_areas = self.get_pixel_areas(feature_geometry, mask, transform)
+        valid = pixel_areas > 0
+        areas = np.bincount(image[valid], weights=pixel_areas[valid], minlength=256)
+        counts = self.count_regions(image, valid)
+        return self.get_stats(areas, counts, classes_names, year)
+
+    def get_stats(self, areas, counts, classes_names, year):
+        pixel_values = np.nonzero(areas)[0]
+        class_table = as_class_table(classes_names)
+        class_table.validate(pixel_values)
+        class_columns = class_table.columns(pixel_values)
+        stats = []
+        for index, pixel_value in enumerate(pixel_values.tolist()):
+            row = {
+                "pixel_value": pixel_value,
+                "area_ha": round(float(areas[pixel_value])/10_000, self.float_precision),
+                "polygon_count": None if counts is None else int(counts[pixel_value]),
+                "year": year
+            }
+            row.update((field, values[index]) for field, values in class_columns.items())
+            stats.append(row)
+
+        return {
+            "year": year,
+            "stats": sorted(stats, key=lambda row: row["area_ha"], reverse=True)
         }
 
-        image_data = self.__tiler(params.get("src_path"), *args, **kwargs)
-        image_bounds = self.__get_image_bounds(image_data)
-        transform = self.get_transform(image_bounds, image_data.width, image_data.height)
+    def zonal_stats(self, params):
+        feature_geojson = params.get("feature_geojson")
+        if not feature_geojson:
+            return {}
 
-        features = self.get_polygons(
+        image, mask, transform = self.__read_window(
+            params.get("src_path"), feature_geojson, params.get("max_size"))
+
+        return self.get_zonal_stats(
             feature_geojson=feature_geojson,
-            image=image_data.data,
-            mask=image_data.mask,
+            image=image,
+            mask=mask,
             transform=transform,
             classes_names=params.get("classes_names"),
             year=params.get("year")
         )
 
-        return features
\ No newline at end of file
+    def get_class_areas(self, src_path, window, feature_geometry):
+        # Areas per pixel value of the part of the feature in a dataset
+        # window, the pixels crossed by the feature boundary count their
+        # covered part as in get_zonal_stats.
+        with instrumentation.stage("read"), self.open_reader(src_path) as cog:
+            dataset = cog.dataset
+            image = dataset.read(1, window=window)
+            if dataset.nodata is not None:
+                mask = image != dataset.nodata
+            else:
+                mask = dataset.read_masks(1, window=window) > 0
+            transform = windows.transform(window, dataset.transform)
+        instrumentation.count("pixels", image.size)
+        pixel_areas = self.get_pixel_areas(feature_geometry, mask, transform, clip_to_window=True)
+        valid = pixel_areas > 0
+        return np.bincount(image[valid], weights=pixel_areas[valid], minlength=256)
+
+    def zonal_stats_from_pyramid(self, pyramid, params):
+        # Regions cannot be counted from block histograms, polygon_count is
+        # left empty.
+        feature_geojson = params.get("feature_geojson")
+        if not feature_geojson:
+            return {}
+
+        feature_geometry = shape(feature_geojson["geometry"])
+        with instrumentation.stage("pyramid"):
+            areas, boundary_windows = pyramid.query(feature_geometry)
+        if boundary_windows:
+            with ThreadPoolExecutor(max_workers=params.get("max_workers")) as executor:
+                futures = [
+                    executor.submit(
+                        instrumentation.propagate(self.get_class_areas), params.get("src_path"), window, feature_geometry)
+                    for window in boundary_windows
+                ]
+                for future in futures:
+                    areas += future.result()
+
+        return self.get_stats(areas, None, params.get("classes_names"), params.get("year"))
+
+    @instrumentation.timed("transitions")
+    def get_transitions(self, feature_geojson, image_from, image_to, mask, transform, classes_names, years, polygonize_changes=False):
+        image_from = image_from[0] if image_from.ndim == 3 else image_from
+        image_to = image_to[0] if image_to.ndim == 3 else image_to
+        feature_geometry = shape(feature_geojson['geometry'])
+        year_from, year_to = years
+
+        pixel_areas = self.get_pixel_areas(feature_geometry, mask, transform)
+        valid = pixel_areas > 0
+        # Each pixel pair is encoded as from*256+to, so a single bincount
+        # builds the whole area-weighted 256x256 transition matrix.
+        codes = image_from.astype("uint16") * 256 + image_to
+        matrix = np.bincount(codes[valid], weights=pixel_areas[valid], minlength=256*256).reshape(256, 256)
+
+        from_values, to_values = np.nonzero(matrix)
+        class_table = as_class_table(classes_names)
+        class_table.validate(np.concatenate([from_values, to_values]))
+        transitions = []
+        for from_value, to_value, from_class_name, to_class_name, area in zip(
+                from_values.tolist(), to_values.tolist(),
+                class_table.lookup("class_name", from_values).tolist(),
+                class_table.lookup("class_name", to_values).tolist(),
+                matrix[from_values, to_values].tolist()):
+            transitions.append({
+                "from_value": from_value,
+                "to_value": to_value,
+                "from_class_name": from_class_name,
+                "to_class_name": to_class_name,
+                "area_ha": round(area/10_000, self.float_precision),
+                "year_from": year_from,
+                "year_to": year_to
+            })
+
+        transitions = {
+            "year_from": year_from,
+            "year_to": year_to,
+            "transitions": sorted(transitions, key=lambda row: row["area_ha"], reverse=True)
+        }
+        if polygonize_changes:
+            transitions["changes"] = self.get_change_polygons(
+                feature_geometry, codes, valid & (image_from != image_to), transform, classes_names, years)
+        return transitions
+
+    def get_change_polygons(self, feature_geometry, codes, changed, transform, classes_names, years):
+        geometries, inside, pixel_codes = self.__polygonize_and_clip(codes, changed, transform, feature_geometry)
+        areas = self.areas_m2(geometries)
+
+        from_values, to_values = np.divmod(pixel_codes.astype("int64"), 256)
+        class_table = as_class_table(classes_names)
+        class_table.validate(np.concatenate([from_values, to_values]))
+        to_classes = class_table.columns(to_values)
+        from_names = class_table.lookup("class_name", from_values)
+
+        features = []
+        for index, (geometry, from_value, to_value, area) in enumerate(
+                zip(geometries, from_values.tolist(), to_values.tolist(), areas)):
+            features.append({
+                "type": "Feature",
+                "geometry": mapping(geometry),
+                "properties": {
+                    "pixel_value": to_value,
+                    "area_ha": round(float(area)/10_000, self.float_precision),
+                    "class_name": f"{from_names[index]} -> {to_classes['class_name'][index]}",
+                    "class_type": to_classes["class_type"][index],
+                    "hex_color": to_classes["hex_color"][index],
+                    "from_value": from_value,
+                    "to_value": to_value,
+                    "year_from": years[0],
+                    "year_to": years[1]
+                }
+            })
+
+        return {
+            "type": "FeatureCollection",
+            "features": features
+        }
+
+    def transition_matrix(self, params):
+        feature_geojson = params.get("feature_geojson")
+        if not feature_geojson:
+            return {}
+
+        # Both years are read with the same feature and size, so the
+        # windows share the same grid and can be compared pixel by pixel.
+        image_from, mask_from, transform = self.__read_window(
+            params.get("src_path_from"), feature_geojson, params.get("max_size"))
+        image_to, mask_to, _ = self.__read_window(
+            params.get("src_path_to"), feature_geojson, params.get("max_size"))
+
+        return self.get_transitions(
+            feature_geojson=feature_geojson,
+            image_from=image_from,
+            image_to=image_to,
+            mask=mask_from & mask_to,
+            transform=transform,
+            classes_names=params.get("classes_names"),
+            years=(params.get("year_from"), params.get("year_to")),
+            polygonize_changes=params.get("polygonize_changes", False)
+        )
+
+    def get_tiles(self, src_path, feature_geometry, tile_size):
+        with self.open_reader(src_path) as cog:
+            dataset_transform = cog.dataset.transform
+            dataset_window = windows.Window(0, 0, cog.dataset.width, cog.dataset.height)
+            block_height, block_width = cog.dataset.block_shapes[0]
+
+        # Tiles are whole multiples of the COG internal blocks, so every
+        # block is fetched by a single worker.
+        tile_width = max(1, tile_size // block_width) * block_width
+        tile_height = max(1, tile_size // block_height) * block_height
+
+        window = windows.from_bounds(*feature_geometry.bounds, transform=dataset_transform)
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        row_start = int(max(row_start, 0) // tile_height) * tile_height
+        col_start = int(max(col_start, 0) // tile_width) * tile_width
+        row_stop = min(row_stop, dataset_window.height)
+        col_stop = min(col_stop, dataset_window.width)
+
+        tiles = []
+        for row_off in range(row_start, int(np.ceil(row_stop)), tile_height):
+            for col_off in range(col_start, int(np.ceil(col_stop)), tile_width):
+                tile_window = windows.Window(col_off, row_off, tile_width, tile_height)
+                tile_window = tile_window.intersection(dataset_window)
+                tiles.append(shapely.box(*windows.bounds(tile_window, dataset_transform)))
+        return np.array(tiles, dtype=object), abs(dataset_transform.a)
+
+    @instrumentation.timed("merge_tiles")
+    def merge_tiles(self, tile_polygons, tiles, pixel_size):
+        polygons = PolygonResult.concat(tile_polygons)
+        if not polygons.feature_count:
+            return polygons
+
+        geometries, pixel_values = polygons.geometries, polygons.pixel_value
+        seams = shapely.buffer(shapely.union_all(shapely.boundary(tiles)), pixel_size / 1000)
+        shapely.prepare(seams)
+        on_seam = shapely.intersects(seams, geometries)
+
+        merged = [polygons.take(~on_seam)]
+        for pixel_value in np.unique(pixel_values[on_seam]).tolist():
+            class_on_seam = on_seam & (pixel_values == pixel_value)
+            # Tiles share the dataset grid, snapping removes floating point
+            # differences between the pixel edges computed by each tile.
+            snapped = shapely.set_precision(geometries[class_on_seam], pixel_size / 1000)
+            parts = shapely.get_parts(shapely.union_all(snapped))
+            template = polygons.take(np.full(len(parts), np.nonzero(class_on_seam)[0][0]))
+            merged.append(template.with_geometries(parts, self.__round_areas_ha(self.areas_m2(parts))))
+
+        return PolygonResult.concat(merged)
+
+    def render_mapbiomas_tiled(self, params):
+        for chunk in self.iter_mapbiomas_tiled(params):
+            if chunk["final"]:
+                return chunk["polygons"]
+
+    def iter_mapbiomas_tiled(self, params):
+        # Yields each tile polygons as its worker finishes, not generalized
+        # nor merged across seams, then the merged result as the final chunk.
+        feature_geojson = params.get("feature_geojson")
+        if not feature_geojson:
+            yield {"polygons": {}, "done": 0, "total": 0, "final": True}
+            return
+
+        feature_geometry = shape(feature_geojson["geometry"])
+        tiles, pixel_size = self.get_tiles(params.get("src_path"), feature_geometry, params.get("tile_size") or 2048)
+        tile_geometries = shapely.intersection(tiles, feature_geometry)
+        tile_geometries = tile_geometries[shapely.area(tile_geometries) > 0]
+
+        reader_options = self.reader_options
+        # Dissolve, minimum area and smoothing need the regions merged across
+        # seams, they run once on the merged result instead of per tile.
+        task_params = {key: value for key, value in params.items() if key != "progress_callback"}
+        tasks = [
+            {
+                **task_params,
+                "feature_geojson": {"type": "Feature", "properties": {}, "geometry": mapping(tile_geometry)},
+                "max_size": None,
+                "align_to_dataset": True,
+                "reader_options": reader_options,
+                "dissolve": False,
+                "min_area_ha": 0,
+                "smooth": False
+            }
+            for tile_geometry in tile_geometries
+        ]
+        tile_polygons = [None] * len(tasks)
+        with ProcessPoolExecutor(max_workers=params.get("max_workers"), mp_context=get_process_context()) as executor:
+            futures = {executor.submit(render_tile, task): index for index, task in enumerate(tasks)}
+            for done, future in enumerate(as_completed(futures), start=1):
+                # Merged in tile order, whatever order they finish in.
+                tile_polygons[futures[future]] = future.result()
+                yield {"polygons": tile_polygons[futures[future]], "done": done, "total": len(tasks), "final": False}
+
+        polygons = self.merge_tiles(tile_polygons, tiles, pixel_size)
+        if self.has_generalization(params):
+            polygons = self.generalize_polygons(polygons, feature_geometry, pixel_size, params)
+        yield {"polygons": polygons, "done": len(tasks), "total": len(tasks), "final": True}
+
+    def group_features(self, features, max_group_area_ha):
+        geometries = np.array([shape(feature["geometry"]) for feature in features], dtype=object)
+        bounds = shapely.bounds(geometries)
+        centroids = (bounds[:, :2] + bounds[:, 2:]) / 2
+        # Sweep west to east inside coarse latitude bands so neighbours end
+        # up next to each other, then grow each group while its window fits.
+        band_height = max(float(np.ptp(bounds[:, [1, 3]])) / max(np.sqrt(len(features)), 1), 1e-9)
+        order = np.lexsort((centroids[:, 0], np.floor(centroids[:, 1] / band_height)))
+
+        groups = []
+        group, group_bounds = [], None
+        for index in order.tolist():
+            candidate_bounds = bounds[index] if group_bounds is None else np.concatenate([
+                np.minimum(group_bounds[:2], bounds[index][:2]), np.maximum(group_bounds[2:], bounds[index][2:])])
+            if group and self.area_ha(mapping(shapely.box(*candidate_bounds))) > max_group_area_ha:
+                groups.append((group, group_bounds))
+                group, candidate_bounds = [], bounds[index]
+            group.append(index)
+            group_bounds = candidate_bounds
+        if group:
+            groups.append((group, group_bounds))
+        return groups
+
+    def __render_group(self, params, features, group_bounds):
+        window_feature = {"type": "Feature", "properties": {}, "geometry": mapping(shapely.box(*group_bounds))}
+        image, mask, transform = self.__read_window(
+            params.get("src_path"), window_feature, params.get("max_size"), align_to_dataset=True)
+        if params.get("min_pixels"):
+            image = self.sieve_image(image, mask, params.get("min_pixels"))
+
+        group_polygons = []
+        for feature_id, feature in features:
+            # Each feature is masked and polygonized on its own part of the
+            # group window only.
+            feature_geometry = shape(feature["geometry"])
+            window = windows.from_bounds(*feature_geometry.bounds, transform=transform)
+            (row_start, row_stop), (col_start, col_stop) = window.toranges()
+            row_start, col_start = max(0, math.floor(row_start)), max(0, math.floor(col_start))
+            row_stop = min(mask.shape[0], max(math.ceil(row_stop), row_start + 1))
+            col_stop = min(mask.shape[1], max(math.ceil(col_stop), col_start + 1))
+            feature_transform = transform * Affine.translation(col_start, row_start)
+            feature_image = image[row_start:row_stop, col_start:col_stop]
+            feature_mask = self.__get_feature_mask(
+                feature_geometry, feature_image.shape, feature_transform) & mask[row_start:row_stop, col_start:col_stop]
+            polygons = self.get_polygons(
+                feature_geojson=feature,
+                image=feature_image,
+                mask=feature_mask,
+                transform=feature_transform,
+                classes_names=params.get("classes_names"),
+                year=params.get("year")
+            )
+            if self.has_generalization(params):
+                polygons = self.generalize_polygons(polygons, feature_geometry, abs(transform.a), params)
+            group_polygons.append(polygons.with_column("feature_id", feature_id))
+        return group_polygons
+
+    @staticmethod
+    def get_feature_id(feature, index):
+        feature_id = feature.get("id", (feature.get("properties") or {}).get("id"))
+        return index if feature_id is None else feature_id
+
+    def render_mapbiomas_batch(self, params):
+        features = params.get("features")
+        if not features:
+            return {}
+
+        groups = self.group_features(features, params.get("max_group_area_ha"))
+        progress_callback = params.get("progress_callback")
+
+        batch_polygons = []
+        with ThreadPoolExecutor(max_workers=params.get("max_workers")) as executor:
+            futures = [
+                executor.submit(
+                    instrumentation.propagate(self.__render_group),
+                    params,
+                    [(self.get_feature_id(features[index], index), features[index]) for index in group],
+                    group_bounds
+                )
+                for group, group_bounds in groups
+            ]
+            for done, future in enumerate(futures, start=1):
+                batch_polygons.extend(future.result())
+                if progress_callback:
+                    progress_callback(done, len(futures))
+
+        return PolygonResult.concat(batch_polygons)
+
+    def render_mapbiomas_timeseries(self, params, years):
+        for chunk in self.iter_mapbiomas_timeseries(params, years):
+            if chunk["final"]:
+                return chunk["polygons"]
+
+    def iter_mapbiomas_timeseries(self, params, years):
+        # Yields each year as it finishes, then all of them, combined or per
+        # year in the years order, as the final chunk.
+        feature_geojson = params.get("feature_geojson")
+        if not feature_geojson:
+            yield {"polygons": {}, "done": 0, "total": 0, "final": True}
+            return
+
+        src_paths = params.get("src_paths")
+        max_workers = max(1, min(params.get("max_workers") or len(years), len(years)))
+        # The years of a collection share one grid, the window, masks and
+        # cell areas are computed once. Years on another grid read their own.
+        grid = None
+        if years:
+            grid = self.get_read_grid(
+                src_paths[years[0]], feature_geojson, params.get("max_size"), params.get("align_to_dataset", False))
+
+        polygons_per_year = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    instrumentation.propagate(self.render_mapbiomas_from_cog),
+                    {**params, "src_path": src_paths[year], "year": year},
+                    grid
+                ): year
+                for year in years
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                year = futures[future]
+                polygons_per_year[year] = future.result()
+                yield {"polygons": polygons_per_year[year], "year": year, "done": done, "total": len(years), "final": False}
+
+        polygons_per_year = {year: polygons_per_year[year] for year in years}
+        if params.get("combine"):
+            polygons_per_year = self.combine_years(polygons_per_year)
+        yield {"polygons": polygons_per_year, "done": len(years), "total": len(years), "final": True}
+
+    @staticmethod
+    def combine_years(polygons_per_year):
+        return PolygonResult.concat([polygons_per_year[year] for year in sorted(polygons_per_year)])
+
+
+def render_tile(params):
+    return ReadCOG(**params.get("reader_options", {})).render_mapbiomas_from_cog(params)
@@ -0,0 +1,118 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class ReaderPool:
+    def __init__(self, max_handles=16, idle_timeout=300, reader_class=None):
+        if reader_class is None:
+            from rio_tiler.io import COGReader
+            reader_class = COGReader
+        self.max_handles = max_handles
+        self.idle_timeout = idle_timeout
+        self.reader_class = reader_class
+        self.opened = 0
+        self.reused = 0
+        self.evicted = 0
+        self.__idle = {}
+        self.__in_use = 0
+        self.__condition = threading.Condition()
+
+    def __idle_count(self):
+        return sum(len(readers) for readers in self.__idle.values())
+
+    def __close(self, reader):
+        self.evicted += 1
+        reader.close()
+
+    def __evict_expired(self):
+        expire_before = time.monotonic() - self.idle_timeout
+        for src_path in list(self.__idle):
+            readers = self.__idle[src_path]
+            for reader, last_used in readers:
+                if last_used < expire_before:
+                    self.__close(reader)
+            readers = [(reader, last_used) for reader, last_used in readers if last_used >= expire_before]
+            if readers:
+                self.__idle[src_path] = readers
+            else:
+                del self.__idle[src_path]
+
+    def __evict_least_recently_used(self):
+        idle = [
+            (last_used, src_path, index)
+            for src_path, readers in self.__idle.items()
+            for index, (_, last_used) in enumerate(readers)
+        ]
+        if not idle:
+            return False
+        _, src_path, index = min(idle, key=lambda item: item[0])
+        reader, _ = self.__idle[src_path].pop(index)
+        if not self.__idle[src_path]:
+            del self.__idle[src_path]
+        self.__close(reader)
+        return True
+
+    def __acquire(self, src_path):
+        with self.__condition:
+            self.__evict_expired()
+            if self.__idle.get(src_path):
+                reader, _ = self.__idle[src_path].pop()
+                if not self.__idle[src_path]:
+                    del self.__idle[src_path]
+                self.__in_use += 1
+                self.reused += 1
+                return reader
+
+            # Every handle is checked out by a single thread at a time, wait
+            # for one to come back when the pool is full and nothing is idle.
+            while self.__in_use + self.__idle_count() >= self.max_handles:
+                if not self.__evict_least_recently_used():
+                    self.__condition.wait()
+            self.__in_use += 1
+            self.opened += 1
+
+        try:
+            return self.reader_class(src_path)
+        except Exception:
+            with self.__condition:
+                self.__in_use -= 1
+                self.opened -= 1
+                self.__condition.notify()
+            raise
+
+    def __release(self, src_path, reader, reusable):
+        with self.__condition:
+            self.__in_use -= 1
+            if reusable:
+                self.__idle.setdefault(src_path, []).append((reader, time.monotonic()))
+            else:
+                self.__close(reader)
+            self.__condition.notify()
+
+    @contextmanager
+    def reader(self, src_path):
+        reader = self.__acquire(src_path)
+        reusable = False
+        try:
+            yield reader
+            reusable = True
+        finally:
+            self.__release(src_path, reader, reusable)
+
+    def close_all(self):
+        with self.__condition:
+            for readers in self.__idle.values():
+                for reader, _ in readers:
+                    self.__close(reader)
+            self.__idle = {}
+
+    def stats(self):
+        with self.__condition:
+            return {
+                "opened": self.opened,
+                "reused": self.reused,
+                "evicted": self.evicted,
+                "idle": self.__idle_count(),
+                "in_use": self.__in_use,
+            }
@@ -0,0 +1,130 @@
+import io
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+import shapely
+from contextlib import closing
+from shapely.geometry import shape
+from model.instrumentation import instrumentation
+from model.polygon_result import PolygonResult, as_polygon_result, to_wkb_buffer, from_wkb_buffer
+
+
+class ResultCache:
+    def __init__(self, path, max_size_bytes=512_000_000, float_precision=6):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.float_precision = float_precision
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__create_table()
+
+    def __connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def __create_table(self):
+        with self.__connect() as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, payload BLOB NOT NULL, "
+                "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results(last_access)")
+
+    def geometry_hash(self, geometry_geojson):
+        geometry = shapely.set_precision(shape(geometry_geojson), 10 ** -self.float_precision)
+        geometry_wkb = shapely.to_wkb(shapely.normalize(geometry))
+        return hashlib.sha256(geometry_wkb).hexdigest()
+
+    def make_key(self, params, reader_options=None):
+        # Every option that changes the polygons, those of the request and
+        # those of the reader that renders it.
+        reader_options = reader_options or {}
+        parts = [
+            self.geometry_hash(params.get("feature_geojson").get("geometry")),
+            str(params.get("src_path")),
+            str(params.get("year")),
+            str(params.get("max_size")),
+            str(self.float_precision),
+        ]
+        parts.extend(str(params.get(option)) for option in ("min_pixels", "min_area_ha", "dissolve", "smooth"))
+        parts.extend(str(reader_options.get(option)) for option in ("engine", "area_engine", "edge_mask"))
+        return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def encode(polygons):
+        polygons = as_polygon_result(polygons)
+        wkb, offsets = to_wkb_buffer(polygons.geometries)
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            wkb=np.frombuffer(wkb, dtype="uint8"),
+            wkb_offsets=offsets,
+            pixel_value=polygons.pixel_value,
+            area_ha=polygons.area_ha,
+        )
+        return buffer.getvalue()
+
+    @staticmethod
+    def decode(payload, year, classes_names):
+        with np.load(io.BytesIO(payload)) as arrays:
+            geometries = from_wkb_buffer(arrays["wkb"].tobytes(), arrays["wkb_offsets"])
+            return PolygonResult(geometries, arrays["pixel_value"], arrays["area_ha"], year, classes_names)
+
+    @instrumentation.timed("cache_get")
+    def get(self, key, params):
+        with self.__connect() as connection, connection:
+            row = connection.execute("SELECT payload FROM results WHERE key = ?", (key,)).fetchone()
+            if row:
+                connection.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+
+        with self.__lock:
+            if row is None:
+                self.misses += 1
+                instrumentation.count("cache_misses")
+                return None
+            self.hits += 1
+            instrumentation.count("cache_hits")
+        return self.decode(row[0], params.get("year"), params.get("classes_names"))
+
+    @instrumentation.timed("cache_set")
+    def set(self, key, polygons):
+        payload = self.encode(polygons)
+        if len(payload) > self.max_size_bytes:
+            return False
+
+        with self.__connect() as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO results (key, payload, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, sqlite3.Binary(payload), len(payload), time.time())
+            )
+            self.__evict(connection)
+        return True
+
+    def __evict(self, connection):
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+
+        oldest = connection.execute("SELECT key, size FROM results ORDER BY last_access")
+        evicted = []
+        for key, size in oldest:
+            if total_size <= self.max_size_bytes:
+                break
+            evicted.append((key,))
+            total_size -= size
+        connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def stats(self):
+        with self.__connect() as connection:
+            entries, size = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "size_bytes": size,
+        }
@@ -0,0 +1,42 @@
+import numpy as np
+import shapely
+
+
+def get_shared_edges(geometries):
+    # The boundaries noded and merged into edges that run between the points
+    # where three or more polygons meet, each edge shared by two neighbours
+    # is kept once.
+    boundaries = shapely.union_all(shapely.boundary(geometries[~shapely.is_empty(geometries)]))
+    return shapely.get_parts(shapely.line_merge(boundaries))
+
+
+def simplify_shared_edges(geometries, edges, tolerance, decimals=None):
+    # Each shared edge is simplified once and the polygons built back from
+    # the edges, so neighbours keep the same border and no gaps or overlaps
+    # open between them. Edge ends do not move and rounding moves them to the
+    # same place in every edge.
+    simplified_edges = shapely.simplify(edges, tolerance, preserve_topology=False)
+    if decimals is not None:
+        simplified_edges = shapely.transform(simplified_edges, lambda coords: np.round(coords, decimals))
+    # Simplified edges may cross, they are noded again before polygonizing.
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(shapely.union_all(simplified_edges))))
+    faces = faces[shapely.area(faces) > 0]
+    # Noding leaves the corners of the neighbours on straight sides, they
+    # are dropped without moving any side.
+    faces = shapely.simplify(faces, 0)
+
+    # Faces take the polygon their inner point falls in, faces outside every
+    # polygon are the holes and nodata areas of the coverage.
+    face_index, geometry_index = shapely.STRtree(geometries).query(
+        shapely.point_on_surface(faces), predicate="intersects")
+    face_index, first = np.unique(face_index, return_index=True)
+    geometry_index = geometry_index[first]
+
+    simplified = np.full(len(geometries), shapely.Polygon(), dtype=object)
+    order = np.argsort(geometry_index, kind="stable")
+    face_index, geometry_index = face_index[order], geometry_index[order]
+    parts = shapely.multipolygons(faces[face_index], indices=np.unique(geometry_index, return_inverse=True)[1])
+    single = shapely.get_num_geometries(parts) == 1
+    parts[single] = shapely.get_geometry(parts[single], 0)
+    simplified[np.unique(geometry_index)] = parts
+    return simplified
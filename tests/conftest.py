@@ -0,0 +1,78 @@
+import os
+import re
+import sys
+import time
+import socket
+import functools
+import multiprocessing
+import pytest
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from synthetic import write_synthetic_coverage
+
+SYNTHETIC_YEARS = (1985, 1986)
+
+
+@pytest.fixture(scope="session")
+def synthetic_coverage_dir(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("coverage")
+    for seed, year in enumerate(SYNTHETIC_YEARS):
+        write_synthetic_coverage(str(directory / f"brasil_coverage_{year}.tif"), seed)
+    return str(directory)
+
+
+@pytest.fixture(scope="session")
+def noisy_coverage_path(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("noisy_coverage")
+    return write_synthetic_coverage(str(directory / "brasil_coverage_1985.tif"), 3, block=1)
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        size = os.path.getsize(path)
+        byte_range = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        start, end = (int(byte_range.group(1)), int(byte_range.group(2) or size - 1)) if byte_range else (0, size - 1)
+        end = min(end, size - 1)
+        with open(path, "rb") as source:
+            source.seek(start)
+            body = source.read(end - start + 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Length", str(len(body)))
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_directory(directory, port):
+    handler = functools.partial(RangeRequestHandler, directory=directory)
+    ThreadingHTTPServer(("127.0.0.1", port), handler).serve_forever()
+
+
+def get_free_port():
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        return free_socket.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def coverage_server(synthetic_coverage_dir):
+    # Stands in for the bucket. A separate process, GDAL blocks every thread
+    # of the reading process while it opens a dataset.
+    port = get_free_port()
+    process = multiprocessing.get_context("spawn").Process(
+        target=serve_directory, args=(synthetic_coverage_dir, port), daemon=True)
+    process.start()
+    for _ in range(100):
+        with socket.socket() as client:
+            if client.connect_ex(("127.0.0.1", port)) == 0:
+                break
+        time.sleep(0.1)
+    yield f"http://127.0.0.1:{port}"
+    process.terminate()
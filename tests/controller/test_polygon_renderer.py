@@ -56,3 +56,269 @@ def test_render_mapbiomas_error(mocker, big_feature_geojson, sample_data_url):
 
     polygons = polygon_renderer.render_mapbiomas(params)
     assert "error" in polygons
+
+def test_render_mapbiomas_result_cache(mocker, tmp_path, feature_geojson, sample_data_url):
+    polygons = {"type": "FeatureCollection", "features": []}
+    render = mocker.patch(
+        "model.read_cog.ReadCOG.render_mapbiomas_from_cog",
+        return_value=polygons
+    )
+    mocker.patch.object(app_config_data, "result_cache_path", str(tmp_path / "cache.sqlite"))
+    mocker.patch("controller.polygon_renderer.app_config_data", app_config_data)
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"geometry":feature_geojson},
+            "src_path": sample_data_url,
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+
+    assert polygon_renderer.render_mapbiomas(params) == polygons
+    assert polygon_renderer.render_mapbiomas(params) == polygons
+    assert render.call_count == 1
+    assert polygon_renderer.result_cache.stats()["hits"] == 1
+
+def test_render_mapbiomas_timeseries(mocker, tmp_path, feature_geojson, synthetic_coverage_dir):
+    mocker.patch.object(app_config_data, "url_mapbiomas", synthetic_coverage_dir)
+    mocker.patch.object(app_config_data, "result_cache_path", str(tmp_path / "cache.sqlite"))
+    mocker.patch("controller.polygon_renderer.app_config_data", app_config_data)
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": feature_geojson},
+            "classes_names": mapbiomas_classes,
+            "max_size": None
+    }
+
+    polygons_per_year = polygon_renderer.render_mapbiomas_timeseries(params, [1985, 1986])
+    assert sorted(polygons_per_year) == [1985, 1986]
+    combined = polygon_renderer.render_mapbiomas_timeseries({**params, "combine": True}, [1985, 1986])
+    assert {feature["properties"]["year"] for feature in combined["features"]} == {1985, 1986}
+    assert polygon_renderer.result_cache.stats()["hits"] == 2
+
+def test_render_mapbiomas_timeseries_error(big_feature_geojson):
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"geometry": big_feature_geojson},
+            "classes_names": mapbiomas_classes,
+            "max_size": None
+    }
+    assert "error" in polygon_renderer.render_mapbiomas_timeseries(params, [1985])
+
+def test_render_zonal_stats(feature_geojson, synthetic_coverage_dir):
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": feature_geojson},
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+    zonal_stats = polygon_renderer.render_zonal_stats(params)
+    assert round(sum(row["area_ha"] for row in zonal_stats["stats"]), 3) == 5.134
+
+def test_render_zonal_stats_error(big_feature_geojson, sample_data_url):
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"geometry": big_feature_geojson},
+            "src_path": sample_data_url,
+            "classes_names": mapbiomas_classes,
+            "max_size": None
+    }
+    assert "error" in polygon_renderer.render_zonal_stats(params)
+
+def test_render_transition_matrix(feature_geojson, synthetic_coverage_dir):
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": feature_geojson},
+            "src_path_from": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "src_path_to": f"{synthetic_coverage_dir}/brasil_coverage_1986.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year_from": 1985,
+            "year_to": 1986
+    }
+    transitions = polygon_renderer.render_transition_matrix(params)
+    assert round(sum(row["area_ha"] for row in transitions["transitions"]), 3) == 5.134
+    assert "changes" not in transitions
+
+def test_render_mapbiomas_tiled(mocker, big_feature_geojson, sample_data_url):
+    render_tiled = mocker.patch(
+        "model.read_cog.ReadCOG.render_mapbiomas_tiled",
+        return_value={"type": "FeatureCollection", "features": []}
+    )
+    mocker.patch.object(app_config_data, "max_tiled_polygon_clip_area_ha", 1_000_000)
+    mocker.patch("controller.polygon_renderer.app_config_data", app_config_data)
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"geometry":big_feature_geojson},
+            "src_path": sample_data_url,
+            "classes_names": mapbiomas_classes,
+            "max_size": None
+    }
+
+    polygons = polygon_renderer.render_mapbiomas(params)
+    assert "error" not in polygons
+    assert render_tiled.call_args[0][0]["tile_size"] == app_config_data.tile_size
+
+def test_get_preview_max_size(mocker, feature_geojson, synthetic_coverage_dir):
+    mocker.patch.object(app_config_data, "preview_pixel_budget", 16)
+    mocker.patch("controller.polygon_renderer.app_config_data", app_config_data)
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": feature_geojson},
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif"
+    }
+    assert polygon_renderer.get_preview_max_size(params) == 4
+
+def test_render_mapbiomas_batch_error(feature_geojson, big_feature_geojson, sample_data_url):
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "features": [
+                {"type": "Feature", "properties": {}, "geometry": feature_geojson},
+                {"type": "Feature", "properties": {"id": "big"}, "geometry": big_feature_geojson}
+            ],
+            "src_path": sample_data_url,
+            "classes_names": mapbiomas_classes,
+            "max_size": None
+    }
+    polygons = polygon_renderer.render_mapbiomas_batch(params)
+    assert polygons["error"]
+    assert polygons["feature_id"] == "big"
+
+def test_render_mapbiomas_scheduled(mocker, feature_geojson, synthetic_coverage_dir):
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": feature_geojson},
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+    expected = PolygonRenderer().render_mapbiomas(params)
+
+    mocker.patch.object(app_config_data, "scheduler_workers", 1)
+    mocker.patch("controller.polygon_renderer.app_config_data", app_config_data)
+    polygon_renderer = PolygonRenderer()
+    statuses = []
+    assert polygon_renderer.render_mapbiomas({**params, "progress_callback": statuses.append}) == expected
+    assert polygon_renderer.scheduler.stats()["completed"] == 1
+    assert statuses
+    polygon_renderer.scheduler.shutdown()
+
+def test_timeseries_and_batch_scheduled(mocker, feature_geojson, synthetic_coverage_dir):
+    mocker.patch.object(app_config_data, "url_mapbiomas", synthetic_coverage_dir)
+    mocker.patch("controller.polygon_renderer.app_config_data", app_config_data)
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": feature_geojson},
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "combine": True
+    }
+    batch_params = {
+            "features": [{"type": "Feature", "id": "farm", "properties": None, "geometry": feature_geojson}],
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+    expected_timeseries = PolygonRenderer().render_mapbiomas_timeseries(params, [1985, 1986])
+    expected_batch = PolygonRenderer().render_mapbiomas_batch(batch_params)
+
+    mocker.patch.object(app_config_data, "scheduler_workers", 1)
+    polygon_renderer = PolygonRenderer()
+    chunks = list(polygon_renderer.stream_mapbiomas_timeseries(params, [1985, 1986]))
+    assert sorted(chunk["year"] for chunk in chunks[:-1]) == [1985, 1986]
+    assert chunks[-1]["polygons"].properties() == expected_timeseries.properties()
+    progress = []
+    batch = polygon_renderer.render_mapbiomas_batch({**batch_params, "progress_callback": lambda *args: progress.append(args)})
+    assert batch.properties() == expected_batch.properties()
+    assert progress == [(1, 1)]
+    assert polygon_renderer.scheduler.stats()["completed"] == 2
+    polygon_renderer.scheduler.shutdown()
+
+def test_stream_mapbiomas(mocker, tmp_path, feature_geojson, synthetic_coverage_dir):
+    mocker.patch.object(app_config_data, "max_polygon_clip_area_ha", 1)
+    mocker.patch.object(app_config_data, "max_tiled_polygon_clip_area_ha", 1_000_000)
+    mocker.patch.object(app_config_data, "tile_size", 16)
+    mocker.patch.object(app_config_data, "result_cache_path", str(tmp_path / "cache.sqlite"))
+    mocker.patch("controller.polygon_renderer.app_config_data", app_config_data)
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": feature_geojson},
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+
+    chunks = list(polygon_renderer.stream_mapbiomas(params))
+    assert [chunk["final"] for chunk in chunks] == [False] * chunks[-1]["total"] + [True]
+    cached = list(polygon_renderer.stream_mapbiomas(params))
+    assert len(cached) == 1
+    assert cached[0]["polygons"].properties() == chunks[-1]["polygons"].properties()
+    assert polygon_renderer.result_cache.stats()["hits"] == 1
+
+def test_stream_mapbiomas_scheduler(mocker, synthetic_coverage_dir):
+    mocker.patch.object(app_config_data, "max_polygon_clip_area_ha", 1)
+    mocker.patch.object(app_config_data, "max_tiled_polygon_clip_area_ha", 1_000_000)
+    mocker.patch.object(app_config_data, "tile_size", 64)
+    mocker.patch.object(app_config_data, "scheduler_workers", 1)
+    mocker.patch("controller.polygon_renderer.app_config_data", app_config_data)
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[-45.135, -21.16], [-45.11, -21.165], [-45.115, -21.185], [-45.135, -21.18], [-45.135, -21.16]]]}},
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+
+    chunks = list(polygon_renderer.stream_mapbiomas(params))
+    polygon_renderer.scheduler.shutdown()
+    assert [(chunk["done"], chunk["total"], chunk["final"]) for chunk in chunks[:-1]] == [
+        (done, 4, False) for done in range(1, 5)]
+    assert chunks[-1]["final"]
+    assert chunks[-1]["polygons"].properties() == polygon_renderer.cog_reader.render_mapbiomas_tiled({
+        **params, "tile_size": 64, "max_workers": app_config_data.max_workers}).properties()
+
+def test_stream_mapbiomas_timeseries(mocker, feature_geojson, big_feature_geojson, synthetic_coverage_dir):
+    mocker.patch.object(app_config_data, "url_mapbiomas", synthetic_coverage_dir)
+    mocker.patch("controller.polygon_renderer.app_config_data", app_config_data)
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": feature_geojson},
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "combine": True
+    }
+
+    chunks = list(polygon_renderer.stream_mapbiomas_timeseries(params, [1985, 1986]))
+    assert [(chunk["done"], chunk["total"]) for chunk in chunks[:-1]] == [(1, 2), (2, 2)]
+    assert chunks[-1]["polygons"].properties() == polygon_renderer.render_mapbiomas_timeseries(params, [1985, 1986]).properties()
+    errors = list(polygon_renderer.stream_mapbiomas_timeseries(
+        {**params, "feature_geojson": {"geometry": big_feature_geojson}}, [1985]))
+    assert len(errors) == 1 and "error" in errors[0]["polygons"]
+
+def test_render_zonal_stats_pyramid(mocker, tmp_path, synthetic_coverage_dir):
+    from model.read_cog import ReadCOG
+    from model.histogram_pyramid import HistogramPyramid
+    src_path = f"{synthetic_coverage_dir}/brasil_coverage_1985.tif"
+    HistogramPyramid.build(ReadCOG(), src_path, block_size=16).save(str(tmp_path / "brasil_coverage_1985.npz"))
+    mocker.patch.object(app_config_data, "max_polygon_clip_area_ha", 1)
+    mocker.patch("controller.polygon_renderer.app_config_data", app_config_data)
+    polygon_renderer = PolygonRenderer()
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": {
+                "type": "Polygon", "coordinates": [[[-46, -22], [-44, -22], [-44, -20], [-46, -20], [-46, -22]]]}},
+            "src_path": src_path,
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+    assert "error" in polygon_renderer.render_zonal_stats(params)
+
+    mocker.patch.object(app_config_data, "histogram_pyramid_dir", str(tmp_path))
+    zonal_stats = polygon_renderer.render_zonal_stats(params)
+    assert round(sum(row["area_ha"] for row in zonal_stats["stats"]), 3) > 1000
@@ -0,0 +1,128 @@
+import json
+import pytest
+import shapely
+from shapely.geometry import shape
+from conftest import get_free_port
+from model import block_cache
+from model.block_cache import BlockCache, start_block_cache_server, get_cached_url, get_source_url, prefetch
+from model.read_cog import ReadCOG
+from mapbiomas_classes import mapbiomas_classes
+
+@pytest.fixture
+def feature_geojson():
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        polygon_geojson = json.load(test_data)
+    return {
+            "type": "Feature",
+            "properties": {},
+            "geometry": polygon_geojson
+        }
+
+@pytest.fixture(scope="module")
+def block_cache_server(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("block_cache") / "blocks.sqlite")
+    return path, start_block_cache_server(path, 100_000_000, get_free_port())
+
+def test_cached_url():
+    src_path = "https://storage.googleapis.com/mapbiomas-public/brasil_coverage_2022.tif"
+    cached_url = get_cached_url("http://127.0.0.1:8765", src_path)
+    assert cached_url == "http://127.0.0.1:8765/https/storage.googleapis.com/mapbiomas-public/brasil_coverage_2022.tif"
+    assert get_source_url(cached_url.removeprefix("http://127.0.0.1:8765")) == src_path
+
+def test_start_server_port_taken(block_cache_server, monkeypatch):
+    # Two processes start a server together, the other one binds the port
+    # first and this process's server exits.
+    path, url = block_cache_server
+    port = int(url.rsplit(":", 1)[1])
+    popen = block_cache.subprocess.Popen
+    processes = []
+
+    def start_process(*args, **kwargs):
+        processes.append(popen(*args, **kwargs))
+        return processes[-1]
+
+    is_serving = block_cache.is_serving
+    checks = []
+
+    def is_serving_after_exit(host, port):
+        checks.append(port)
+        if len(checks) == 1:
+            return False
+        if len(checks) == 2:
+            processes[0].wait(timeout=30)
+            return False
+        return is_serving(host, port)
+
+    monkeypatch.setattr(block_cache.subprocess, "Popen", start_process)
+    monkeypatch.setattr(block_cache, "is_serving", is_serving_after_exit)
+    assert start_block_cache_server(path, 100_000_000, port) == url
+    assert processes[0].returncode != 0
+
+    # Nothing serving when the server exits is still an error.
+    monkeypatch.setattr(block_cache, "is_serving", lambda host, port: False)
+    with pytest.raises(RuntimeError):
+        start_block_cache_server(path, 100_000_000, port)
+
+def test_read(tmp_path, coverage_server, synthetic_coverage_dir):
+    with open(f"{synthetic_coverage_dir}/brasil_coverage_1985.tif", "rb") as source:
+        expected = source.read()
+    url = f"{coverage_server}/brasil_coverage_1985.tif"
+    cache = BlockCache(str(tmp_path / "blocks.sqlite"), block_size=256)
+
+    assert cache.read(url, 100, 700) == expected[100:701]
+    assert (cache.hits, cache.misses) == (0, 3)
+    assert cache.read(url, 500, len(expected) + 100) == expected[500:]
+    assert (cache.hits, cache.misses) == (2, 3 + (len(expected) - 1) // 256 - 2)
+
+    fetched_bytes = cache.fetched_bytes
+    restarted = BlockCache(str(tmp_path / "blocks.sqlite"), block_size=256)
+    assert restarted.read(url, 0, 700) == expected[:701]
+    assert restarted.misses == 0
+    assert restarted.stats()["size_bytes"] == fetched_bytes == len(expected)
+
+def test_lru_eviction(tmp_path, coverage_server):
+    url = f"{coverage_server}/brasil_coverage_1985.tif"
+    cache = BlockCache(str(tmp_path / "blocks.sqlite"), max_size_bytes=3 * 256, block_size=256)
+    for block in (0, 1, 2, 0, 3):
+        cache.read(url, block * 256, block * 256)
+    assert cache.stats()["entries"] == 3
+
+    misses = cache.misses
+    cache.read(url, 0, 0)
+    assert cache.misses == misses
+    cache.read(url, 256, 256)
+    assert cache.misses == misses + 1
+
+def test_read_cog_through_cache(block_cache_server, coverage_server, synthetic_coverage_dir, feature_geojson):
+    path, server_url = block_cache_server
+    params = {
+            "feature_geojson": feature_geojson,
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1986
+    }
+    expected = ReadCOG().render_mapbiomas_from_cog({
+        **params, "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1986.tif"})
+    polygons = ReadCOG(block_cache_url=server_url).render_mapbiomas_from_cog({
+        **params, "src_path": f"{coverage_server}/brasil_coverage_1986.tif"})
+    assert polygons == expected
+    assert BlockCache(path).stats()["files"] == 1
+
+def test_prefetch(block_cache_server, coverage_server, feature_geojson):
+    path, server_url = block_cache_server
+    src_path = f"{coverage_server}/brasil_coverage_1985.tif"
+    cache = BlockCache(path)
+    result = prefetch(cache, server_url, src_path, shape(feature_geojson["geometry"]))
+    assert result["tiles"] > 0
+
+    entries = cache.stats()["entries"]
+    for max_size in (None, 64):
+        ReadCOG(block_cache_url=server_url).render_mapbiomas_from_cog({
+            "src_path": src_path,
+            "feature_geojson": feature_geojson,
+            "classes_names": mapbiomas_classes,
+            "max_size": max_size,
+            "year": 1985
+        })
+    assert cache.stats()["entries"] == entries
+    assert prefetch(cache, server_url, src_path, shapely.box(0, 0, 1, 1))["tiles"] == 0
@@ -0,0 +1,71 @@
+import csv
+import json
+import pytest
+import numpy as np
+from model.read_cog import ReadCOG
+from model.class_table import ClassTable, load_class_table, mapbiomas_class_table
+from mapbiomas_classes import mapbiomas_classes
+
+
+@pytest.fixture
+def feature_geojson():
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        polygon_geojson = json.load(test_data)
+    return {"type": "Feature", "properties": {}, "geometry": polygon_geojson}
+
+
+def test_lookup_matches_classes():
+    pixel_values = np.array(list(mapbiomas_classes), dtype="uint8")
+    columns = mapbiomas_class_table.columns(pixel_values)
+    for index, pixel_value in enumerate(pixel_values.tolist()):
+        assert {field: values[index] for field, values in columns.items()} == mapbiomas_classes[pixel_value]
+    assert mapbiomas_class_table[3] == mapbiomas_classes[3]
+    assert load_class_table() is mapbiomas_class_table
+
+    with pytest.raises(KeyError):
+        mapbiomas_class_table.validate(np.array([3, 2], dtype="uint8"))
+
+
+def test_name_codes_and_colors():
+    codes = mapbiomas_class_table.codes["hex_color"]
+    assert codes[22] == codes[24]
+    assert mapbiomas_class_table.categories["hex_color"][codes[22]] == "#d4271e"
+
+    image = np.array([[3, 15], [33, 0]], dtype="uint8")
+    rgba = mapbiomas_class_table.colorize(image, mask=image > 0)
+    assert rgba[0, 0].tolist() == [0x1f, 0x8d, 0x49, 255]
+    assert rgba[1, 1].tolist() == [0, 0, 0, 0]
+
+
+def test_from_file(tmp_path):
+    legend = {"3": {"hex_color": "#00ff00", "class_type": "Natural", "class_name": "Forest"}}
+    json_path = tmp_path / "legend.json"
+    json_path.write_text(json.dumps(legend))
+    csv_path = tmp_path / "legend.csv"
+    with open(csv_path, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=["pixel_value", "hex_color", "class_type", "class_name"])
+        writer.writeheader()
+        writer.writerow({"pixel_value": 3, **legend["3"]})
+
+    for path in (json_path, csv_path):
+        class_table = load_class_table(str(path))
+        assert dict(class_table) == {3: legend["3"]}
+        assert class_table.rgba[3].tolist() == [0, 255, 0, 255]
+
+
+def test_render_with_legend(feature_geojson, synthetic_coverage_dir):
+    legend = {pixel_value: {**attributes, "class_name": f"class {pixel_value}"}
+              for pixel_value, attributes in mapbiomas_classes.items()}
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": ClassTable(legend, name="test"),
+            "max_size": None,
+            "year": 1985
+    }
+    polygons = ReadCOG().render_mapbiomas_from_cog(params)
+    assert all(
+        feature["properties"]["class_name"] == f"class {feature['properties']['pixel_value']}"
+        for feature in polygons["features"])
+    stats = ReadCOG().zonal_stats(params)["stats"]
+    assert {row["class_name"] for row in stats} == {row["class_name"] for row in polygons.summary()}
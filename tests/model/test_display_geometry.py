@@ -0,0 +1,100 @@
+import json
+import base64
+import pytest
+import shapely
+from shapely.geometry import shape, mapping
+from model import display_geometry
+from model.read_cog import ReadCOG
+from mapbiomas_classes import mapbiomas_classes
+from synthetic import PIXEL_SIZE, ORIGIN
+
+
+@pytest.fixture
+def polygons(synthetic_coverage_dir):
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        geometry = json.load(test_data)
+    return ReadCOG().render_mapbiomas_from_cog({
+        "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+        "feature_geojson": {"type": "Feature", "properties": {}, "geometry": geometry},
+        "classes_names": mapbiomas_classes,
+        "max_size": None,
+        "year": 1985
+    })
+
+
+@pytest.fixture
+def coverage_polygons(synthetic_coverage_dir):
+    # Most of the synthetic coverage, many neighbouring class polygons.
+    west, north = ORIGIN
+    geometry = mapping(shapely.box(west, north - 120 * PIXEL_SIZE, west + 120 * PIXEL_SIZE, north))
+    return ReadCOG().render_mapbiomas_from_cog({
+        "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+        "feature_geojson": {"type": "Feature", "properties": {}, "geometry": geometry},
+        "classes_names": mapbiomas_classes,
+        "max_size": None,
+        "year": 1985
+    })
+
+
+def test_prepare_display_vector(polygons):
+    display = display_geometry.prepare_display(polygons, map_width_px=10)
+    assert display["mode"] == "vector"
+    features = display["polygons"]["features"]
+    assert [feature["properties"] for feature in features] == [feature["properties"] for feature in polygons["features"]]
+
+    decimals = display_geometry.get_decimals(display_geometry.get_display_tolerance(
+        shapely.total_bounds([shape(feature["geometry"]) for feature in polygons["features"]]), 10), 6)
+    assert decimals < 6
+    coordinates = [coordinate for feature in features for coordinate in feature["geometry"]["coordinates"][0]]
+    assert all(round(value, decimals) == value for coordinate in coordinates for value in coordinate)
+
+    exact_area = sum(shape(feature["geometry"]).area for feature in polygons["features"])
+    display_area = sum(shape(feature["geometry"]).area for feature in features)
+    assert display_area == pytest.approx(exact_area, rel=0.05)
+
+
+def test_prepare_display_levels(coverage_polygons):
+    display = display_geometry.prepare_display(coverage_polygons, map_width_px=4)
+    levels = display["levels"]
+    assert display["polygons"] is levels[0]["polygons"]
+    tolerances = [level["tolerance"] for level in levels]
+    assert len(levels) > 1
+    assert tolerances == sorted(tolerances, reverse=True)
+
+    exact = shapely.union_all(coverage_polygons.geometries)
+    level_vertices = []
+    for level in levels:
+        geometries = [shape(feature["geometry"]) for feature in level["polygons"]["features"]]
+        level_vertices.append(int(shapely.get_num_coordinates(geometries).sum()))
+        display_union = shapely.union_all(geometries)
+        # Neighbours share their simplified edges, they neither overlap nor
+        # leave gaps between them.
+        assert shapely.area(geometries).sum() == pytest.approx(display_union.area)
+        assert display_union.area == pytest.approx(exact.area, rel=0.02)
+    assert level_vertices == sorted(level_vertices)
+    assert display["vertices"] == sum(level_vertices)
+
+    # Levels stop at the exact polygons and at max_vertices.
+    finer = display_geometry.prepare_display(coverage_polygons, map_width_px=4, zoom_levels=20)
+    assert len(finer["levels"]) < 20
+    assert len(display_geometry.prepare_display(
+        coverage_polygons, map_width_px=4, max_vertices=display["vertices"] - 1)["levels"]) < len(levels)
+
+
+def test_prepare_display_image(polygons, mocker):
+    # Results drawn as an image never build the shared edges.
+    get_shared_edges = mocker.patch.object(display_geometry, "get_shared_edges")
+    display = display_geometry.prepare_display(polygons, max_vertices=10, image_max_size=256)
+    get_shared_edges.assert_not_called()
+    assert display["mode"] == "image"
+    assert base64.b64decode(display["image"].split(",")[1]).startswith(b"\x89PNG")
+    (south, west), (north, east) = display["bounds"]
+    assert west < east and south < north
+
+
+def test_prepare_display_empty():
+    polygons = {"type": "FeatureCollection", "features": []}
+    display = display_geometry.prepare_display(polygons)
+    assert display["mode"] == "vector"
+    assert display["polygons"] == polygons
+    assert [level["polygons"] for level in display["levels"]] == [polygons]
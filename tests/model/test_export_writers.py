@@ -0,0 +1,91 @@
+import io
+import csv
+import json
+import pytest
+import shapely
+from shapely.geometry import shape
+from model import export_writers
+from model.read_cog import ReadCOG
+from mapbiomas_classes import mapbiomas_classes
+
+
+@pytest.fixture
+def features(synthetic_coverage_dir):
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        geometry = json.load(test_data)
+    polygons = ReadCOG().render_mapbiomas_from_cog({
+        "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+        "feature_geojson": {"type": "Feature", "properties": {}, "geometry": geometry},
+        "classes_names": mapbiomas_classes,
+        "max_size": None,
+        "year": 1985
+    })
+    return json.loads(json.dumps(polygons["features"]))
+
+
+def test_write_geojson(features):
+    data = json.loads(export_writers.export_features(features, "GeoJSON"))
+    assert data == {"type": "FeatureCollection", "features": features}
+
+
+def test_write_ndjson(features):
+    lines = export_writers.export_features(features, "NDJSON").decode("utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == features
+
+
+def test_write_csv(features):
+    rows = list(csv.DictReader(io.StringIO(export_writers.export_features(features, "CSV").decode("utf-8"))))
+    assert len(rows) == len(features)
+    assert float(rows[0]["area_ha"]) == features[0]["properties"]["area_ha"]
+
+
+def test_write_csv_result(synthetic_coverage_dir, features):
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        geometry = json.load(test_data)
+    polygons = ReadCOG().render_mapbiomas_from_cog({
+        "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+        "feature_geojson": {"type": "Feature", "properties": {}, "geometry": geometry},
+        "classes_names": mapbiomas_classes,
+        "max_size": None,
+        "year": 1985
+    })
+    data = export_writers.export_features(polygons, "CSV")
+    assert data == export_writers.export_features(features, "CSV")
+    # The rows come from the columns, the GeoJSON features are not built.
+    assert polygons._PolygonResult__features is None
+
+
+def test_write_geoparquet(features):
+    pq = pytest.importorskip("pyarrow.parquet")
+    table = pq.read_table(io.BytesIO(export_writers.export_features(features, "GeoParquet")))
+    geo_metadata = json.loads(table.schema.metadata[b"geo"])
+    assert geo_metadata["columns"]["geometry"] == {"encoding": "WKB", "geometry_types": ["Polygon"]}
+    assert table.column("pixel_value").to_pylist() == [feature["properties"]["pixel_value"] for feature in features]
+    geometries = shapely.from_wkb(table.column("geometry").to_numpy(zero_copy_only=False))
+    assert all(geometry.equals(shape(feature["geometry"])) for geometry, feature in zip(geometries, features))
+
+
+def test_write_flatgeobuf(tmp_path, features):
+    pyogrio = pytest.importorskip("pyogrio")
+    path = tmp_path / "export.fgb"
+    path.write_bytes(export_writers.export_features(features, "FlatGeobuf"))
+    info = pyogrio.read_info(path)
+    assert info["features"] == len(features)
+    assert info["capabilities"]["fast_spatial_filter"]
+
+
+def test_write_geoparquet_result(synthetic_coverage_dir, features):
+    pq = pytest.importorskip("pyarrow.parquet")
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        geometry = json.load(test_data)
+    polygons = ReadCOG().render_mapbiomas_from_cog({
+        "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+        "feature_geojson": {"type": "Feature", "properties": {}, "geometry": geometry},
+        "classes_names": mapbiomas_classes,
+        "max_size": None,
+        "year": 1985
+    })
+    table = pq.read_table(io.BytesIO(export_writers.export_features(polygons, "GeoParquet")))
+    geo_metadata = json.loads(table.schema.metadata[b"geo"])
+    assert geo_metadata["columns"]["geometry"] == {"encoding": "WKB", "geometry_types": ["Polygon"]}
+    assert table.drop(["geometry"]).to_pylist() == [feature["properties"] for feature in features]
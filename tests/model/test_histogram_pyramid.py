@@ -0,0 +1,74 @@
+import json
+import pytest
+import numpy as np
+from shapely.geometry import shape, box, mapping
+from model.read_cog import ReadCOG
+from model.histogram_pyramid import HistogramPyramid, get_pyramid_path, load_histogram_pyramid
+from mapbiomas_classes import mapbiomas_classes
+
+
+@pytest.fixture
+def src_path(synthetic_coverage_dir):
+    return f"{synthetic_coverage_dir}/brasil_coverage_1985.tif"
+
+
+@pytest.fixture
+def pyramid(src_path):
+    return HistogramPyramid.build(ReadCOG(), src_path, block_size=16, max_workers=2)
+
+
+def load_geometry():
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        return json.load(test_data)
+
+
+def test_build(pyramid, tmp_path):
+    assert [pyramid.get_grid_shape(level) for level in range(len(pyramid.levels))] == [(8, 8), (4, 4), (2, 2), (1, 1)]
+    total_areas = [areas.sum() for _, _, areas in pyramid.levels]
+    assert total_areas == pytest.approx([total_areas[0]] * 4)
+
+    path = get_pyramid_path(str(tmp_path), "http://host/brasil_coverage_1985.tif")
+    assert path.endswith("brasil_coverage_1985.npz")
+    pyramid.save(path)
+    loaded = HistogramPyramid.load(path)
+    assert loaded.transform == pyramid.transform
+    for level, arrays in enumerate(pyramid.levels):
+        assert all(np.array_equal(loaded_array, array) for loaded_array, array in zip(loaded.levels[level], arrays))
+
+
+def test_load_rebuilt_pyramid(pyramid, src_path, tmp_path):
+    path = str(tmp_path / "brasil_coverage_1985.npz")
+    pyramid.save(path)
+    assert load_histogram_pyramid(path) is load_histogram_pyramid(path)
+    assert load_histogram_pyramid(path).block_size == 16
+    HistogramPyramid.build(ReadCOG(), src_path, block_size=32).save(path)
+    assert load_histogram_pyramid(path).block_size == 32
+
+
+@pytest.mark.parametrize("geometry", [
+    load_geometry(),
+    {"type": "Polygon", "coordinates": [[[-45.135, -21.16], [-45.11, -21.165], [-45.115, -21.185], [-45.135, -21.18], [-45.135, -21.16]]]},
+    mapping(box(-46, -22, -44, -20))
+])
+def test_zonal_stats_from_pyramid(pyramid, src_path, geometry):
+    params = {
+            "feature_geojson": {"type": "Feature", "properties": {}, "geometry": geometry},
+            "src_path": src_path,
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+    mapbimas_reader = ReadCOG()
+    expected = mapbimas_reader.zonal_stats(params)["stats"]
+    stats = mapbimas_reader.zonal_stats_from_pyramid(pyramid, params)["stats"]
+    assert [(row["pixel_value"], row["area_ha"], row["class_name"]) for row in stats] == [
+        (row["pixel_value"], row["area_ha"], row["class_name"]) for row in expected]
+    assert all(row["polygon_count"] is None for row in stats)
+
+
+def test_query_reads_only_boundary(pyramid):
+    _, boundary_windows = pyramid.query(box(-46, -22, -44, -20))
+    assert boundary_windows == []
+    _, boundary_windows = pyramid.query(shape(load_geometry()))
+    assert 0 < len(boundary_windows) < 64
+    assert all(window.width == window.height == 16 for window in boundary_windows)
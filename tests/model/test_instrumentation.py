@@ -0,0 +1,103 @@
+import pytest
+import json
+import logging
+import tracemalloc
+from model.instrumentation import Instrumentation, GdalRequestHandler, instrumentation
+from model.read_cog import ReadCOG
+from mapbiomas_classes import mapbiomas_classes
+
+@pytest.fixture
+def feature_geojson():
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        polygon_geojson = json.load(test_data)
+    return {
+            "type": "Feature",
+            "properties": {},
+            "geometry": polygon_geojson
+        }
+
+@pytest.fixture
+def enabled_instrumentation(monkeypatch):
+    monkeypatch.setattr(instrumentation, "enabled", True)
+    monkeypatch.setattr(instrumentation, "trace_memory", True)
+    tracemalloc.start()
+    yield instrumentation
+    tracemalloc.stop()
+
+def test_trace_stages(enabled_instrumentation, feature_geojson, synthetic_coverage_dir):
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+    with enabled_instrumentation.trace("test", year=1985) as trace:
+        polygons = ReadCOG().render_mapbiomas_from_cog(params)
+
+    summary = enabled_instrumentation.recent_traces[-1]
+    assert summary == trace.summary()
+    assert summary["year"] == 1985
+    assert {"read", "polygonize", "clip", "area", "build_features"} <= set(summary["stages"])
+    assert summary["stages"]["polygonize"]["allocated_bytes"] > 0
+    assert summary["counters"]["shapes"] >= len(polygons["features"])
+    assert summary["counters"]["pixels"] > 0
+
+def test_nested_stage_memory(enabled_instrumentation):
+    with enabled_instrumentation.trace("test") as trace:
+        with enabled_instrumentation.stage("outer"):
+            block = bytearray(4_000_000)
+            del block
+            with enabled_instrumentation.stage("inner"):
+                small = bytearray(1_000)
+
+    assert len(small) == 1_000
+    assert trace.stages["outer"]["allocated_bytes"] > 3_900_000
+    assert 0 < trace.stages["inner"]["allocated_bytes"] < 1_000_000
+
+def test_trace_propagates_to_workers(enabled_instrumentation, feature_geojson, synthetic_coverage_dir):
+    years = [1985, 1986]
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_paths": {year: f"{synthetic_coverage_dir}/brasil_coverage_{year}.tif" for year in years},
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "max_workers": 2
+    }
+    with enabled_instrumentation.trace("test") as trace:
+        ReadCOG().render_mapbiomas_timeseries(params, years)
+    assert trace.summary()["stages"]["read"]["count"] == 2
+
+def test_gdal_request_handler():
+    recorder = Instrumentation()
+    recorder.enabled = True
+    handler = GdalRequestHandler(recorder, logging.getLogger("test_gdal"))
+    message = "CPLE_None in VSICURL: Downloading 0-16383 (https://example.com/brasil_coverage_2022.tif)..."
+    handler.emit(logging.LogRecord("rasterio._env", logging.DEBUG, __file__, 0, message, None, None))
+    handler.emit(logging.LogRecord("rasterio._env", logging.DEBUG, __file__, 0, "GDALOpen(...)", None, None))
+    assert recorder.metrics.snapshot()["counters"] == {"gdal_requests": 1, "gdal_bytes": 16384}
+
+def test_render_prometheus():
+    recorder = Instrumentation()
+    recorder.enabled = True
+    with recorder.stage("read"):
+        pass
+    recorder.count("features", 3)
+    metrics = recorder.metrics.render_prometheus()
+    assert 'mapbiomas_stage_seconds_count{stage="read"} 1' in metrics
+    assert "mapbiomas_features_total 3" in metrics
+
+def test_disabled_is_noop():
+    recorder = Instrumentation()
+    with recorder.trace("test") as trace:
+        with recorder.stage("read"):
+            recorder.count("features")
+    assert trace is None
+    assert recorder.metrics.snapshot() == {"stages": {}, "counters": {}}
+
+def test_cprofile(tmp_path):
+    recorder = Instrumentation()
+    recorder.configure(profiler="cprofile", profile_dir=str(tmp_path))
+    with recorder.trace("render_mapbiomas"):
+        sum(range(1000))
+    assert [path.suffix for path in tmp_path.iterdir()] == [".prof"]
@@ -0,0 +1,79 @@
+import time
+import pytest
+from concurrent.futures import CancelledError
+from model.job_scheduler import JobScheduler, job_key
+
+def slow_square(value, seconds):
+    time.sleep(seconds)
+    return value * value
+
+def count_up(chunk_queue, stop, seconds):
+    for value in range(stop):
+        chunk_queue.put(value)
+        time.sleep(seconds)
+    return stop
+
+@pytest.fixture
+def scheduler():
+    scheduler = JobScheduler(max_workers=2, max_running_cost=10, max_queued_jobs=2)
+    yield scheduler
+    scheduler.shutdown()
+
+def test_job_key():
+    callback = lambda status: None
+    params = {"year": 1985, "max_size": None}
+    assert job_key("render", {**params, "progress_callback": callback}) == job_key("render", params)
+    assert job_key("render", params) != job_key("render", {**params, "year": 1986})
+
+def test_admission_by_cost(scheduler):
+    running = scheduler.submit("a", 8, slow_square, 2, 0.5)
+    waiting = scheduler.submit("b", 5, slow_square, 3, 0)
+    # fits the budget but waits its turn
+    small = scheduler.submit("c", 1, slow_square, 4, 0)
+    assert scheduler.status(running)["state"] == "running"
+    assert scheduler.status(waiting) == {"state": "queued", "position": 1, "running": 1}
+    assert scheduler.status(small)["position"] == 2
+    assert scheduler.submit("d", 1, slow_square, 5, 0) is None
+
+    assert [scheduler.wait(job) for job in (running, waiting, small)] == [4, 9, 16]
+    assert scheduler.stats() == {
+        "queued": 0, "running": 0, "running_cost": 0, "completed": 3, "deduplicated": 0, "rejected": 1
+    }
+
+def test_oversized_job_runs_alone(scheduler):
+    job = scheduler.submit("a", 100, slow_square, 2, 0)
+    assert scheduler.wait(job) == 4
+
+def test_deduplicate_in_flight(scheduler):
+    job = scheduler.submit("a", 1, slow_square, 2, 0.3)
+    assert scheduler.submit("a", 1, slow_square, 2, 0.3) is job
+    statuses = []
+    assert scheduler.wait(job, statuses.append, interval=0.05) == 4
+    assert {status["state"] for status in statuses} == {"running"}
+    assert scheduler.stats()["deduplicated"] == 1
+
+    # finished jobs are not shared
+    assert scheduler.submit("a", 1, slow_square, 2, 0) is not job
+
+def test_shutdown_cancels_queued_jobs():
+    scheduler = JobScheduler(max_workers=1)
+    running = scheduler.submit("a", 1, slow_square, 2, 0.5)
+    queued = scheduler.submit("b", 1, slow_square, 3, 0)
+    assert scheduler.submit("b", 1, slow_square, 3, 0) is queued
+    scheduler.shutdown()
+    # every session waiting on the queued job gets an error, none hangs
+    with pytest.raises(CancelledError):
+        queued.future.result(timeout=5)
+    assert scheduler.wait(running) == 4
+    with pytest.raises(RuntimeError):
+        scheduler.submit("c", 1, slow_square, 4, 0)
+
+def test_stream_chunks(scheduler):
+    job = scheduler.submit("a", 1, count_up, 3, 0.1, stream=True)
+    assert scheduler.submit("a", 1, count_up, 3, 0.1, stream=True) is job
+    statuses = []
+    assert list(scheduler.iter_chunks(job, statuses.append, interval=0.02)) == [0, 1, 2]
+    assert scheduler.wait(job) == 3
+    assert statuses
+    # sessions joining late receive every chunk
+    assert list(scheduler.iter_chunks(job)) == [0, 1, 2]
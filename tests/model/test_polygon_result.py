@@ -0,0 +1,89 @@
+import json
+import pickle
+import pytest
+import numpy as np
+from shapely.geometry import shape
+from model.read_cog import ReadCOG
+from model.polygon_result import PolygonResult
+from mapbiomas_classes import mapbiomas_classes
+
+
+@pytest.fixture
+def polygons(synthetic_coverage_dir):
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        geometry = json.load(test_data)
+    return ReadCOG().render_mapbiomas_from_cog({
+        "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+        "feature_geojson": {"type": "Feature", "properties": {}, "geometry": geometry},
+        "classes_names": mapbiomas_classes,
+        "max_size": None,
+        "year": 1985
+    })
+
+
+def test_reads_as_feature_collection(polygons):
+    assert isinstance(polygons, PolygonResult)
+    assert polygons["type"] == "FeatureCollection"
+    assert len(polygons["features"]) == polygons.feature_count > 0
+    feature = polygons["features"][0]
+    assert feature["properties"] == {
+        "pixel_value": int(polygons.pixel_value[0]),
+        "area_ha": float(polygons.area_ha[0]),
+        "year": 1985,
+        **mapbiomas_classes[int(polygons.pixel_value[0])]
+    }
+    assert shape(feature["geometry"]).equals(polygons.geometries[0])
+    assert "error" not in polygons
+
+
+def test_from_geojson(polygons):
+    restored = PolygonResult.from_geojson(json.loads(json.dumps(polygons.to_geojson())), mapbiomas_classes)
+    assert restored.class_columns()["class_name"].tolist() == polygons.class_columns()["class_name"].tolist()
+    assert restored.properties() == polygons.properties()
+
+
+def test_pickle(polygons):
+    restored = pickle.loads(pickle.dumps(polygons.with_column("feature_id", "farm-1")))
+    assert restored.properties() == polygons.with_column("feature_id", "farm-1").properties()
+    assert all(restored.geometries == polygons.geometries)
+
+
+def test_concat_and_take(polygons):
+    combined = PolygonResult.concat([polygons.with_column("feature_id", 1), polygons, {}])
+    assert combined.feature_count == 2 * polygons.feature_count
+    assert combined.columns["feature_id"].tolist() == [1] * polygons.feature_count + [None] * polygons.feature_count
+    assert combined.take(combined.year == 1985).feature_count == combined.feature_count
+    assert PolygonResult.concat([]).feature_count == 0
+
+
+def test_concat_empty_keeps_class_table(polygons):
+    no_polygons = polygons.take(np.zeros(polygons.feature_count, dtype=bool))
+    combined = PolygonResult.concat([PolygonResult.empty(), no_polygons])
+    assert combined.class_table is polygons.class_table
+    assert combined.summary() == []
+    assert PolygonResult.concat([combined, polygons]).summary() == polygons.summary()
+
+
+def test_summary(polygons):
+    areas = {}
+    for feature in polygons["features"]:
+        areas[feature["properties"]["class_name"]] = areas.get(feature["properties"]["class_name"], 0) + feature["properties"]["area_ha"]
+    summary = polygons.summary()
+    assert {row["class_name"]: row["area_ha"] for row in summary} == pytest.approx(areas)
+    assert sum(row["polygon_count"] for row in summary) == polygons.feature_count
+    assert [row["area_ha"] for row in summary] == sorted(areas.values(), reverse=True)
+
+
+def test_to_dataframe(polygons):
+    pytest.importorskip("pandas")
+    data_frame = polygons.to_dataframe()
+    assert data_frame.to_dict("records") == polygons.properties()
+
+
+def test_to_arrow(polygons):
+    pa = pytest.importorskip("pyarrow")
+    table = polygons.to_arrow()
+    assert pa.types.is_dictionary(table.schema.field("class_name").type)
+    dictionary = table.column("class_name").combine_chunks().dictionary
+    assert dictionary.to_pylist() == polygons.class_table.categories["class_name"].tolist()
+    assert table.drop(["geometry"]).to_pylist() == polygons.properties()
@@ -3,8 +3,14 @@ from PIL import Image
 import pytest
 import json
 import numpy as np
+from rasterio.transform import Affine
+from rasterio.features import shapes
+import shapely.affinity
+from shapely.geometry import shape, mapping
 from model.read_cog import ReadCOG
+from model.reader_pool import ReaderPool
 from mapbiomas_classes import mapbiomas_classes
+from synthetic import synthetic_classes, write_synthetic_coverage, area_per_class
 import zipfile
 import os
 
@@ -82,3 +88,392 @@ def test_area(feature_geojson):
     mapbimas_reader = ReadCOG()
     polygon_area = mapbimas_reader.area_ha(feature_geojson.get("geometry"))
     assert polygon_area == 5.13368
+
+@pytest.fixture
+def synthetic_image():
+    image = synthetic_classes(32, 4, 42)[np.newaxis, :, :]
+    mask = np.full(image.shape[1:], 255, dtype="uint8")
+    return image, mask
+
+def test_get_polygons_engines_match(feature_geojson, synthetic_image):
+    image, mask = synthetic_image
+    transform = Affine(0.0000675, 0.0, -45.1278, 0.0, -0.0000675, -21.1671)
+    args = {
+        "feature_geojson": feature_geojson,
+        "image": image,
+        "mask": mask,
+        "transform": transform,
+        "classes_names": mapbiomas_classes,
+        "year": 1985
+    }
+    vectorized = ReadCOG(engine="vectorized").get_polygons(**args)
+    iterative = ReadCOG(engine="iterative").get_polygons(**args)
+    iterative_features = [
+        feature for feature in iterative["features"] if shape(feature["geometry"]).area > 0]
+    assert len(vectorized["features"]) > 0
+    assert len(vectorized["features"]) == len(iterative_features)
+    for vectorized_feature, iterative_feature in zip(vectorized["features"], iterative_features):
+        assert vectorized_feature["properties"] == iterative_feature["properties"]
+        assert shape(vectorized_feature["geometry"]).equals(shape(iterative_feature["geometry"]))
+
+def test_get_polygons_edge_mask(feature_geojson, synthetic_image):
+    image, mask = synthetic_image
+    transform = Affine(0.0000675, 0.0, -45.1278, 0.0, -0.0000675, -21.1671)
+    args = (feature_geojson, image, mask, transform, mapbiomas_classes, 1985)
+    default = ReadCOG().get_polygons(*args)
+    edge_mask = ReadCOG(edge_mask=True).get_polygons(*args)
+
+    assert area_per_class(edge_mask, 4) == area_per_class(default, 4)
+
+def test_pixel_aligned_areas():
+    image = np.full((20, 20), 3, dtype="uint8")
+    image[5:9, 5:9] = 4
+    image[12:15, 3:17] = 4
+    image[13, 4:6] = 12
+    transform = Affine(0.000269494585236, 0.0, -45.0, 0.0, -0.000269494585236, -21.0)
+    image_shapes = list(shapes(image, transform=transform))
+    geometries = np.array([shape(geometry) for geometry, _ in image_shapes], dtype=object)
+    pixel_values = np.array([pixel_value for _, pixel_value in image_shapes])
+
+    mapbimas_reader = ReadCOG()
+    row_areas = mapbimas_reader.get_row_areas(transform, image.shape[0])
+    areas = mapbimas_reader.pixel_aligned_areas_m2(geometries, transform, row_areas)
+    assert areas == pytest.approx(mapbimas_reader.areas_m2(geometries), rel=1e-9)
+    assert areas[pixel_values == 3].sum() == pytest.approx(((image == 3) * row_areas[:, np.newaxis]).sum(), rel=1e-9)
+
+def test_get_polygons_area_engines_match(feature_geojson, synthetic_image):
+    image, mask = synthetic_image
+    transform = Affine(0.0000675, 0.0, -45.1278, 0.0, -0.0000675, -21.1671)
+    args = (feature_geojson, image, mask, transform, mapbiomas_classes, 1985)
+    rows = ReadCOG(area_engine="rows").get_polygons(*args)
+    projected = ReadCOG(area_engine="projected").get_polygons(*args)
+    assert [feature["properties"]["area_ha"] for feature in rows["features"]] == pytest.approx(
+        [feature["properties"]["area_ha"] for feature in projected["features"]], abs=1e-6)
+
+def test_get_polygons_empty_mask(feature_geojson, synthetic_image):
+    image, mask = synthetic_image
+    polygons = ReadCOG().get_polygons(
+        feature_geojson, image, np.zeros_like(mask), Affine.identity(), mapbiomas_classes, 1985)
+    assert polygons["features"] == []
+
+def test_render_mapbiomas_local_cog(feature_geojson, synthetic_coverage_dir):
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+    polygons = ReadCOG().render_mapbiomas_from_cog(params)
+    assert len(polygons["features"]) > 0
+    assert round(sum(feature["properties"]["area_ha"] for feature in polygons["features"]), 3) == 5.134
+
+def test_render_mapbiomas_timeseries(feature_geojson, synthetic_coverage_dir):
+    years = [1985, 1986]
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_paths": {year: f"{synthetic_coverage_dir}/brasil_coverage_{year}.tif" for year in years},
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "max_workers": 2
+    }
+    mapbimas_reader = ReadCOG()
+    polygons_per_year = mapbimas_reader.render_mapbiomas_timeseries(params, years)
+    assert list(polygons_per_year) == years
+    for year in years:
+        assert {feature["properties"]["year"] for feature in polygons_per_year[year]["features"]} == {year}
+
+    combined = mapbimas_reader.render_mapbiomas_timeseries({**params, "combine": True}, years)
+    assert len(combined["features"]) == sum(len(polygons_per_year[year]["features"]) for year in years)
+
+@pytest.mark.parametrize("edge_mask", [False, True])
+def test_render_mapbiomas_timeseries_shared_grid(tmp_path, feature_geojson, synthetic_coverage_dir, edge_mask):
+    # 1987 is on a smaller grid and is read on its own
+    src_paths = {year: f"{synthetic_coverage_dir}/brasil_coverage_{year}.tif" for year in [1985, 1986]}
+    src_paths[1987] = write_synthetic_coverage(str(tmp_path / "brasil_coverage_1987.tif"), 7, size=96)
+    years = list(src_paths)
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_paths": src_paths,
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "max_workers": 2,
+            "min_area_ha": 0.01
+    }
+    mapbimas_reader = ReadCOG(edge_mask=edge_mask)
+    polygons_per_year = mapbimas_reader.render_mapbiomas_timeseries(params, years)
+    for year in years:
+        single = mapbimas_reader.render_mapbiomas_from_cog({**params, "src_path": src_paths[year], "year": year})
+        assert polygons_per_year[year].properties() == single.properties()
+        assert all(shapely.equals(polygons_per_year[year].geometries, single.geometries))
+
+    assert mapbimas_reader.render_mapbiomas_timeseries(params, []) == {}
+
+def test_zonal_stats_matches_polygons(feature_geojson, synthetic_coverage_dir):
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1986.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1986
+    }
+    mapbimas_reader = ReadCOG()
+    polygons = mapbimas_reader.render_mapbiomas_from_cog(params)
+    zonal_stats = mapbimas_reader.zonal_stats(params)
+
+    polygon_counts = {}
+    for feature in polygons["features"]:
+        pixel_value = feature["properties"]["pixel_value"]
+        polygon_counts[pixel_value] = polygon_counts.get(pixel_value, 0) + 1
+
+    assert zonal_stats["year"] == 1986
+    assert {row["pixel_value"]: round(row["area_ha"], 4) for row in zonal_stats["stats"]} == area_per_class(polygons, 4)
+    assert {row["pixel_value"]: row["polygon_count"] for row in zonal_stats["stats"]} == polygon_counts
+
+def test_zonal_stats_empty(sample_data_url):
+    assert ReadCOG().zonal_stats({"feature_geojson": None, "src_path": sample_data_url}) == {}
+
+def test_transition_matrix(feature_geojson, synthetic_coverage_dir):
+    mapbimas_reader = ReadCOG()
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_path_from": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "src_path_to": f"{synthetic_coverage_dir}/brasil_coverage_1986.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year_from": 1985,
+            "year_to": 1986,
+            "polygonize_changes": True
+    }
+    transitions = mapbimas_reader.transition_matrix(params)
+    zonal_stats = mapbimas_reader.zonal_stats({
+        **params, "src_path": params["src_path_from"], "year": 1985})
+
+    area_from = {}
+    for row in transitions["transitions"]:
+        area_from[row["from_value"]] = area_from.get(row["from_value"], 0) + row["area_ha"]
+    assert {key: round(value, 4) for key, value in area_from.items()} == {
+        row["pixel_value"]: round(row["area_ha"], 4) for row in zonal_stats["stats"]}
+
+    changed_area = sum(row["area_ha"] for row in transitions["transitions"] if row["from_value"] != row["to_value"])
+    change_polygons_area = sum(feature["properties"]["area_ha"] for feature in transitions["changes"]["features"])
+    assert transitions["changes"]["features"]
+    assert round(changed_area, 4) == round(change_polygons_area, 4)
+    assert all(
+        feature["properties"]["from_value"] != feature["properties"]["to_value"]
+        for feature in transitions["changes"]["features"])
+
+@pytest.fixture
+def large_feature():
+    return {
+        "type": "Feature",
+        "properties": {},
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[-45.135, -21.16], [-45.11, -21.165], [-45.115, -21.185], [-45.135, -21.18], [-45.135, -21.16]]]
+        }
+    }
+
+def test_render_mapbiomas_tiled(large_feature, synthetic_coverage_dir):
+    params = {
+            "feature_geojson": large_feature,
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985,
+            "tile_size": 64,
+            "max_workers": 2
+    }
+    mapbimas_reader = ReadCOG()
+    tiled = mapbimas_reader.render_mapbiomas_tiled(params)
+    single_pass = mapbimas_reader.render_mapbiomas_from_cog({**params, "align_to_dataset": True})
+
+    assert len(mapbimas_reader.get_tiles(params["src_path"], shape(large_feature["geometry"]), 64)[0]) == 4
+    assert area_per_class(tiled) == area_per_class(single_pass)
+    assert len(tiled["features"]) == len(single_pass["features"])
+
+def test_render_mapbiomas_reader_pool(feature_geojson, synthetic_coverage_dir):
+    reader_pool = ReaderPool(max_handles=2)
+    mapbimas_reader = ReadCOG(reader_pool=reader_pool)
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+    first = mapbimas_reader.render_mapbiomas_from_cog(params)
+    second = mapbimas_reader.render_mapbiomas_from_cog(params)
+    assert first == second
+    assert reader_pool.stats()["opened"] == 1
+    assert reader_pool.stats()["reused"] == 1
+    reader_pool.close_all()
+
+def test_adaptive_max_size(large_feature, synthetic_coverage_dir):
+    src_path = f"{synthetic_coverage_dir}/brasil_coverage_1985.tif"
+    mapbimas_reader = ReadCOG()
+    assert mapbimas_reader.get_adaptive_max_size(src_path, large_feature, 100_000) is None
+
+    max_size = mapbimas_reader.get_adaptive_max_size(src_path, large_feature, 3_000)
+    assert max_size == 47
+    params = {
+            "feature_geojson": large_feature,
+            "src_path": src_path,
+            "classes_names": mapbiomas_classes,
+            "max_size": max_size,
+            "year": 1985
+    }
+    preview = mapbimas_reader.render_mapbiomas_from_cog(params)
+    full_resolution = mapbimas_reader.render_mapbiomas_from_cog({**params, "max_size": None})
+    preview_area = sum(feature["properties"]["area_ha"] for feature in preview["features"])
+    full_resolution_area = sum(feature["properties"]["area_ha"] for feature in full_resolution["features"])
+    assert preview["features"]
+    assert abs(preview_area - full_resolution_area) / full_resolution_area < 0.01
+
+def test_render_mapbiomas_batch(feature_geojson, synthetic_coverage_dir):
+    geometry = shape(feature_geojson["geometry"])
+    features = [
+        {"type": "Feature", "id": f"farm-{index}", "properties": {},
+         "geometry": mapping(shapely.affinity.translate(geometry, xoff=offset))}
+        for index, offset in enumerate([0.0, 0.003, 0.012])
+    ]
+    progress = []
+    params = {
+            "features": features,
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985,
+            "max_group_area_ha": 25,
+            "max_workers": 2,
+            "progress_callback": lambda done, total: progress.append((done, total))
+    }
+    mapbimas_reader = ReadCOG()
+    assert len(mapbimas_reader.group_features(features, 25)) == 2
+    batch = mapbimas_reader.render_mapbiomas_batch(params)
+    assert progress == [(1, 2), (2, 2)]
+
+    for feature in features:
+        single = mapbimas_reader.render_mapbiomas_from_cog({
+            **params, "feature_geojson": feature, "align_to_dataset": True})
+        batch_area = sum(
+            polygon["properties"]["area_ha"] for polygon in batch["features"]
+            if polygon["properties"]["feature_id"] == feature["id"])
+        single_area = sum(polygon["properties"]["area_ha"] for polygon in single["features"])
+        assert round(batch_area, 4) == round(single_area, 4)
+
+def test_get_feature_id():
+    assert ReadCOG.get_feature_id({"type": "Feature", "id": "farm", "properties": {"id": 7}}, 0) == "farm"
+    assert ReadCOG.get_feature_id({"type": "Feature", "properties": {"id": 7}}, 0) == 7
+    assert ReadCOG.get_feature_id({"type": "Feature", "properties": {}}, 3) == 3
+    assert ReadCOG.get_feature_id({"type": "Feature", "properties": None}, 3) == 3
+
+def test_render_mapbiomas_batch_null_properties(feature_geojson, synthetic_coverage_dir):
+    features = [{"type": "Feature", "properties": None, "geometry": feature_geojson["geometry"]}]
+    batch = ReadCOG().render_mapbiomas_batch({
+            "features": features,
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985,
+            "max_group_area_ha": 25
+    })
+    assert batch["features"]
+    assert {polygon["properties"]["feature_id"] for polygon in batch["features"]} == {0}
+
+def test_render_mapbiomas_generalized(large_feature, noisy_coverage_path):
+    feature_geojson = {
+        "type": "Feature",
+        "properties": {},
+        "geometry": mapping(shapely.affinity.scale(shape(large_feature["geometry"]), 0.5, 0.5))
+    }
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_path": noisy_coverage_path,
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985
+    }
+    mapbimas_reader = ReadCOG()
+    polygons = mapbimas_reader.render_mapbiomas_from_cog(params)
+    total_area = sum(feature["properties"]["area_ha"] for feature in polygons["features"])
+
+    sieved = mapbimas_reader.render_mapbiomas_from_cog({**params, "min_pixels": 5})
+    assert len(sieved["features"]) < len(polygons["features"])
+    assert sum(feature["properties"]["area_ha"] for feature in sieved["features"]) == pytest.approx(total_area)
+
+    min_area = mapbimas_reader.render_mapbiomas_from_cog({**params, "min_area_ha": 0.5})
+    assert min_area["features"]
+    assert all(feature["properties"]["area_ha"] >= 0.5 for feature in min_area["features"])
+
+    dissolved = mapbimas_reader.render_mapbiomas_from_cog({**params, "dissolve": True})
+    pixel_values = [feature["properties"]["pixel_value"] for feature in dissolved["features"]]
+    assert sorted(pixel_values) == sorted({feature["properties"]["pixel_value"] for feature in polygons["features"]})
+    assert sum(feature["properties"]["area_ha"] for feature in dissolved["features"]) == pytest.approx(total_area)
+
+    smoothed = mapbimas_reader.render_mapbiomas_from_cog({**params, "smooth": True})
+    vertices = lambda result: sum(shapely.get_num_coordinates(shape(feature["geometry"])) for feature in result["features"])
+    assert vertices(smoothed) < vertices(polygons)
+    feature_geometry = shape(feature_geojson["geometry"]).buffer(1e-9)
+    assert all(feature_geometry.contains(shape(feature["geometry"])) for feature in smoothed["features"])
+    # Neighbours share their smoothed edges, no overlaps or gaps between them.
+    smoothed_geometries = [shape(feature["geometry"]) for feature in smoothed["features"]]
+    assert shapely.union_all(smoothed_geometries).area == pytest.approx(shapely.area(smoothed_geometries).sum())
+    assert shapely.union_all(smoothed_geometries).area == pytest.approx(
+        shapely.union_all([shape(feature["geometry"]) for feature in polygons["features"]]).area, rel=0.02)
+
+def test_render_mapbiomas_tiled_dissolve(large_feature, synthetic_coverage_dir):
+    params = {
+            "feature_geojson": large_feature,
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985,
+            "tile_size": 64,
+            "max_workers": 2,
+            "dissolve": True
+    }
+    mapbimas_reader = ReadCOG()
+    tiled = mapbimas_reader.render_mapbiomas_tiled(params)
+    single_pass = mapbimas_reader.render_mapbiomas_from_cog({**params, "align_to_dataset": True})
+    pixel_values = [feature["properties"]["pixel_value"] for feature in tiled["features"]]
+    assert len(pixel_values) == len(set(pixel_values))
+    assert sorted(
+        (feature["properties"]["pixel_value"], round(feature["properties"]["area_ha"], 3)) for feature in tiled["features"]
+    ) == sorted(
+        (feature["properties"]["pixel_value"], round(feature["properties"]["area_ha"], 3)) for feature in single_pass["features"]
+    )
+
+def test_iter_mapbiomas_tiled(large_feature, synthetic_coverage_dir):
+    params = {
+            "feature_geojson": large_feature,
+            "src_path": f"{synthetic_coverage_dir}/brasil_coverage_1985.tif",
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "year": 1985,
+            "tile_size": 64,
+            "max_workers": 2,
+            "progress_callback": lambda *args: None
+    }
+    mapbimas_reader = ReadCOG()
+    chunks = list(mapbimas_reader.iter_mapbiomas_tiled(params))
+    assert [chunk["final"] for chunk in chunks] == [False] * 4 + [True]
+    assert sorted(chunk["done"] for chunk in chunks[:-1]) == [1, 2, 3, 4]
+    assert all(chunk["total"] == 4 for chunk in chunks)
+    assert sum(chunk["polygons"].area_ha.sum() for chunk in chunks[:-1]) == pytest.approx(chunks[-1]["polygons"].area_ha.sum())
+    assert chunks[-1]["polygons"].properties() == mapbimas_reader.render_mapbiomas_tiled(params).properties()
+
+def test_iter_mapbiomas_timeseries(feature_geojson, synthetic_coverage_dir):
+    years = [1985, 1986]
+    params = {
+            "feature_geojson": feature_geojson,
+            "src_paths": {year: f"{synthetic_coverage_dir}/brasil_coverage_{year}.tif" for year in years},
+            "classes_names": mapbiomas_classes,
+            "max_size": None,
+            "max_workers": 2,
+            "combine": True
+    }
+    chunks = list(ReadCOG().iter_mapbiomas_timeseries(params, years))
+    assert sorted(chunk["year"] for chunk in chunks[:-1]) == years
+    assert chunks[-1]["final"]
+    assert chunks[-1]["polygons"].feature_count == sum(chunk["polygons"].feature_count for chunk in chunks[:-1])
@@ -0,0 +1,74 @@
+import threading
+import pytest
+from model.reader_pool import ReaderPool
+
+class FakeReader:
+    instances = []
+
+    def __init__(self, src_path):
+        self.src_path = src_path
+        self.closed = False
+        FakeReader.instances.append(self)
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture(autouse=True)
+def reset_fake_reader():
+    FakeReader.instances = []
+
+def test_reuse_reader():
+    pool = ReaderPool(max_handles=2, reader_class=FakeReader)
+    with pool.reader("a.tif") as first:
+        pass
+    with pool.reader("a.tif") as second:
+        pass
+    assert first is second
+    assert pool.stats() == {"opened": 1, "reused": 1, "evicted": 0, "idle": 1, "in_use": 0}
+
+def test_concurrent_readers_are_not_shared():
+    pool = ReaderPool(max_handles=2, reader_class=FakeReader)
+    with pool.reader("a.tif") as first, pool.reader("a.tif") as second:
+        assert first is not second
+    assert pool.stats()["idle"] == 2
+
+def test_evict_least_recently_used():
+    pool = ReaderPool(max_handles=2, reader_class=FakeReader)
+    for src_path in ("a.tif", "b.tif", "c.tif"):
+        with pool.reader(src_path):
+            pass
+    assert [reader.closed for reader in FakeReader.instances] == [True, False, False]
+    assert pool.stats()["evicted"] == 1
+
+def test_idle_timeout():
+    pool = ReaderPool(max_handles=2, idle_timeout=0, reader_class=FakeReader)
+    with pool.reader("a.tif"):
+        pass
+    with pool.reader("a.tif"):
+        pass
+    assert pool.stats()["opened"] == 2
+    assert FakeReader.instances[0].closed
+
+def test_failed_request_discards_reader():
+    pool = ReaderPool(max_handles=1, reader_class=FakeReader)
+    with pytest.raises(ValueError):
+        with pool.reader("a.tif"):
+            raise ValueError()
+    assert FakeReader.instances[0].closed
+    assert pool.stats()["in_use"] == 0
+
+def test_wait_for_free_handle():
+    pool = ReaderPool(max_handles=1, reader_class=FakeReader)
+    released = threading.Event()
+
+    def use_other_path():
+        with pool.reader("b.tif"):
+            released.set()
+
+    with pool.reader("a.tif"):
+        worker = threading.Thread(target=use_other_path)
+        worker.start()
+        assert not released.wait(0.1)
+    worker.join(1)
+    assert released.is_set()
+    assert pool.stats()["opened"] == 2
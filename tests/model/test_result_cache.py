@@ -0,0 +1,87 @@
+import pytest
+import json
+from model.result_cache import ResultCache
+from mapbiomas_classes import mapbiomas_classes
+from shapely.geometry import shape
+
+@pytest.fixture
+def feature_geojson():
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        polygon_geojson = json.load(test_data)
+    return {
+            "type": "Feature",
+            "properties": {},
+            "geometry": polygon_geojson
+        }
+
+@pytest.fixture
+def polygons():
+    features = []
+    for index, pixel_value in enumerate([3, 15, 33]):
+        properties = {"pixel_value": pixel_value, "area_ha": 1.5 + index, "year": 1985}
+        properties.update(mapbiomas_classes[pixel_value])
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[(index, 0.0), (index + 1, 0.0), (index + 1, 1.0), (index, 1.0), (index, 0.0)]]
+            },
+            "properties": properties
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+def cache_params(feature_geojson, year=1985):
+    return {
+        "feature_geojson": feature_geojson,
+        "src_path": "brasil_coverage_1985.tif",
+        "classes_names": mapbiomas_classes,
+        "max_size": None,
+        "year": year
+    }
+
+def test_encode_decode(polygons):
+    payload = ResultCache.encode(polygons)
+    decoded = ResultCache.decode(payload, 1985, mapbiomas_classes)
+    assert len(decoded["features"]) == 3
+    for original, restored in zip(polygons["features"], decoded["features"]):
+        assert original["properties"] == restored["properties"]
+        assert shape(original["geometry"]).equals(shape(restored["geometry"]))
+
+def test_hit_and_miss(tmp_path, feature_geojson, polygons):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"))
+    params = cache_params(feature_geojson)
+    key = cache.make_key(params)
+    assert cache.get(key, params) is None
+    cache.set(key, polygons)
+    assert len(cache.get(key, params)["features"]) == 3
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["entries"] == 1
+
+def test_key_is_canonical(tmp_path, feature_geojson):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"))
+    ring = feature_geojson["geometry"]["coordinates"][0]
+    shifted_ring = ring[1:] + [ring[1]]
+    shifted_feature = {"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": [shifted_ring]}}
+    assert cache.make_key(cache_params(feature_geojson)) == cache.make_key(cache_params(shifted_feature))
+    assert cache.make_key(cache_params(feature_geojson)) != cache.make_key(cache_params(feature_geojson, 1986))
+
+@pytest.mark.parametrize("option, value", [("engine", "iterative"), ("area_engine", "projected"), ("edge_mask", True)])
+def test_key_reader_options(tmp_path, feature_geojson, option, value):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"))
+    reader_options = {"engine": "vectorized", "area_engine": "rows", "edge_mask": False}
+    key = cache.make_key(cache_params(feature_geojson), reader_options)
+    assert key == cache.make_key(cache_params(feature_geojson), dict(reader_options))
+    assert key != cache.make_key(cache_params(feature_geojson), {**reader_options, option: value})
+
+def test_lru_eviction(tmp_path, feature_geojson, polygons):
+    entry_size = len(ResultCache.encode(polygons))
+    cache = ResultCache(str(tmp_path / "cache.sqlite"), max_size_bytes=entry_size * 2)
+    keys = [cache.make_key(cache_params(feature_geojson, year)) for year in (1985, 1986, 1987)]
+    cache.set(keys[0], polygons)
+    cache.set(keys[1], polygons)
+    cache.get(keys[0], cache_params(feature_geojson))
+    cache.set(keys[2], polygons)
+    assert cache.stats()["entries"] == 2
+    assert cache.get(keys[1], cache_params(feature_geojson)) is None
+    assert cache.get(keys[0], cache_params(feature_geojson)) is not None
@@ -16,3 +16,8 @@ def test_with_all_sat():
     os.environ["ENABLE_LANDSAT"] = "True"
     config = AppConfig()
     assert isinstance(config, AppConfig)
+
+def test_local_url_mapbiomas(monkeypatch, tmp_path):
+    monkeypatch.setenv("URL_MAPBIOMAS", f"file://{tmp_path}/")
+    config = AppConfig()
+    assert config.get_url_mapbiomas(2022) == f"{tmp_path}/brasil_coverage_2022.tif"
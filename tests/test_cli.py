@@ -0,0 +1,135 @@
+import json
+import struct
+import sqlite3
+import pytest
+import shapely
+from contextlib import closing
+from shapely.geometry import shape
+import cli
+from conftest import get_free_port
+from model.block_cache import BlockCache
+
+
+@pytest.fixture
+def feature_geojson():
+    with open("tests/data/polygon_feature.geojson") as test_data:
+        return json.load(test_data)
+
+
+@pytest.fixture
+def ndjson_input(tmp_path, feature_geojson):
+    path = tmp_path / "features.ndjson"
+    with open(path, "w") as features:
+        for feature_id in ("farm-a", "farm-b"):
+            feature = {"type": "Feature", "id": feature_id, "properties": {}, "geometry": feature_geojson}
+            features.write(json.dumps(feature) + "\n")
+    return str(path)
+
+
+def read_output(path):
+    with open(path) as output:
+        return [json.loads(line) for line in output]
+
+
+def test_parse_years():
+    assert cli.parse_years(["1985-1987", "2000,1986"]) == [1985, 1986, 1987, 2000]
+
+
+def test_read_geopackage(tmp_path, feature_geojson):
+    path = str(tmp_path / "features.gpkg")
+    geometry_wkb = shapely.to_wkb(shape(feature_geojson), byte_order=1)
+    blob = b"GP\x00\x01" + struct.pack("<i", 4326) + geometry_wkb
+    with closing(sqlite3.connect(path)) as connection, connection:
+        connection.execute("CREATE TABLE gpkg_contents (table_name TEXT, data_type TEXT)")
+        connection.execute("CREATE TABLE gpkg_geometry_columns (table_name TEXT, column_name TEXT, srs_id INTEGER)")
+        connection.execute("INSERT INTO gpkg_contents VALUES ('farms', 'features')")
+        connection.execute("INSERT INTO gpkg_geometry_columns VALUES ('farms', 'geom', 4326)")
+        connection.execute("CREATE TABLE farms (fid INTEGER PRIMARY KEY, geom BLOB, name TEXT)")
+        connection.execute("INSERT INTO farms VALUES (7, ?, 'farm')", (blob,))
+
+    features = list(cli.read_features(path))
+    assert len(features) == 1
+    assert features[0]["id"] == 7
+    assert features[0]["properties"]["name"] == "farm"
+    assert shape(features[0]["geometry"]).equals(shape(feature_geojson))
+
+
+def test_extract_resume(mocker, tmp_path, ndjson_input, synthetic_coverage_dir):
+    mocker.patch.object(cli.app_config_data, "url_mapbiomas", synthetic_coverage_dir)
+    output_path = str(tmp_path / "output.ndjson")
+    argv = ["extract", ndjson_input, "--years", "1985-1986", "--output", output_path, "--workers", "2"]
+
+    assert cli.main(argv) == 4
+    features = read_output(output_path)
+    assert {feature["properties"]["feature_id"] for feature in features} == {"farm-a", "farm-b"}
+    assert {feature["properties"]["year"] for feature in features} == {1985, 1986}
+
+    # simulate a run interrupted after the first job, with a partial write
+    with open(f"{output_path}.checkpoint") as checkpoint:
+        first_job = checkpoint.readline()
+    with open(f"{output_path}.checkpoint", "w") as checkpoint:
+        checkpoint.write(first_job)
+    with open(output_path, "a") as output:
+        output.write('{"type": "Feat')
+
+    assert cli.main(argv) == 3
+    resumed = read_output(output_path)
+    key = lambda feature: (feature["properties"]["feature_id"], feature["properties"]["year"])
+    assert sorted(map(key, resumed)) == sorted(map(key, features))
+    assert cli.main(argv) == 0
+
+
+def test_extract_existing_output(mocker, tmp_path, feature_geojson, synthetic_coverage_dir):
+    mocker.patch.object(cli.app_config_data, "url_mapbiomas", synthetic_coverage_dir)
+    input_path = str(tmp_path / "features.ndjson")
+    with open(input_path, "w") as features:
+        features.write(json.dumps({"type": "Feature", "properties": None, "geometry": feature_geojson}) + "\n")
+    output_path = str(tmp_path / "output.ndjson")
+    with open(output_path, "w") as output:
+        output.write("not from a previous run\n")
+    argv = ["extract", input_path, "--years", "1985", "--output", output_path]
+
+    with pytest.raises(SystemExit):
+        cli.main(argv)
+    with open(output_path) as output:
+        assert output.read() == "not from a previous run\n"
+
+    assert cli.main([*argv, "--overwrite"]) == 1
+    assert {feature["properties"]["feature_id"] for feature in read_output(output_path)} == {"0"}
+
+
+def test_extract_repeated_ids(mocker, caplog, tmp_path, feature_geojson, synthetic_coverage_dir):
+    mocker.patch.object(cli.app_config_data, "url_mapbiomas", synthetic_coverage_dir)
+    input_path = str(tmp_path / "features.ndjson")
+    with open(input_path, "w") as features:
+        for feature_id in (None, None, None, "farm-a", "farm-a"):
+            feature = {"type": "Feature", "id": feature_id, "properties": {}, "geometry": feature_geojson}
+            features.write(json.dumps(feature) + "\n")
+    output_path = str(tmp_path / "output.ndjson")
+    argv = ["extract", input_path, "--years", "1985", "--output", output_path, "--workers", "2"]
+
+    assert cli.main(argv) == 5
+    assert "id farm-a is repeated" in caplog.text
+    feature_ids = sorted({feature["properties"]["feature_id"] for feature in read_output(output_path)})
+    assert feature_ids == ["0", "1", "2", "farm-a"]
+    with open(f"{output_path}.checkpoint") as checkpoint:
+        assert sorted(int(line.split("\t")[0]) for line in checkpoint) == [0, 1, 2, 3, 4]
+    assert cli.main(argv) == 0
+
+
+def test_prefetch(mocker, tmp_path, ndjson_input, coverage_server):
+    mocker.patch.object(cli.app_config_data, "url_mapbiomas", coverage_server)
+    cache_path = str(tmp_path / "blocks.sqlite")
+    argv = ["prefetch", ndjson_input, "--years", "1985-1986", "--cache-path", cache_path, "--port", str(get_free_port())]
+
+    assert cli.main(argv) > 0
+    assert BlockCache(cache_path).stats()["files"] == 2
+
+
+def test_build_pyramid(mocker, tmp_path, synthetic_coverage_dir):
+    mocker.patch.object(cli.app_config_data, "url_mapbiomas", synthetic_coverage_dir)
+    argv = ["build-pyramid", "--years", "1985-1986", "--output-dir", str(tmp_path), "--block-size", "16"]
+
+    assert cli.main(argv) == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["brasil_coverage_1985.npz", "brasil_coverage_1986.npz"]
+    assert cli.main(argv) == 0
@@ -0,0 +1,11 @@
+import sys
+import json
+import pytest
+import subprocess
+from bench_import import HEAVY_MODULES
+
+@pytest.mark.parametrize("module", ["main", "cli"])
+def test_startup_without_heavy_modules(module):
+    code = f"import {module}, sys, json; print(json.dumps(sorted(set(sys.modules) & set({HEAVY_MODULES!r}))))"
+    process = subprocess.run([sys.executable, "-c", code], cwd="src", capture_output=True, text=True, check=True)
+    assert json.loads(process.stdout.splitlines()[-1]) == []